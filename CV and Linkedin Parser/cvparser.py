@@ -1,8 +1,9 @@
 import os
 import json
 import re
+import threading
 import time
-from typing import List, Optional
+from typing import Dict, List, Optional
 from pathlib import Path
 from datetime import datetime
 
@@ -17,9 +18,67 @@ from langchain_ollama import OllamaLLM
 from pdfminer.high_level import extract_text
 import docx2txt
 
+from llm_limiter import LLMOverloadedError, get_limiter
+from ollama_manager import OLLAMA_KEEP_ALIVE, LoadCallback, model_manager
+from prompt_compaction import compact_text, count_tokens, RESUME_TOKEN_BUDGET
+from usage_tracker import UsageCallback
+
 # Configuration
-MODEL_NAME = "llama3.1:latest"
-OLLAMA_BASE_URL = "http://localhost:11434"
+MODEL_NAME = os.getenv("OLLAMA_MODEL", "llama3.1:latest")
+OLLAMA_BASE_URL = os.getenv("OLLAMA_BASE_URL", "http://localhost:11434")
+
+# Ollama context window sizes; each call uses the smallest one that fits.
+CONTEXT_BUCKETS = (2048, 4096, 8192, 16384, 32768)
+CONTEXT_MARGIN = 1.1  # headroom for the approximate local tokenizer
+PARSE_OUTPUT_TOKENS = 1500  # room for the extracted JSON
+
+_llm_clients: Dict[int, OllamaLLM] = {}
+_llm_lock = threading.Lock()
+
+# One call extracts the whole resume
+RESUME_PROMPT_TEMPLATE = """
+Extract information from the resume text and return ONLY a valid JSON object.
+
+JSON Format:
+{{
+    "name": "Full Name",
+    "email": "email@domain.com",
+    "phone": "phone number",
+    "location": "City, Country",
+    "summary": "Professional summary",
+    "technical_skills": ["Python", "Java", "React"],
+    "soft_skills": ["Leadership", "Communication"],
+    "education": [
+        {{
+            "institution": "University Name",
+            "degree": "Bachelor/Master",
+            "field_of_study": "Computer Science",
+            "graduation_year": "2020"
+        }}
+    ],
+    "work_experience": [
+        {{
+            "company": "Company Name",
+            "position": "Job Title",
+            "duration": "Start Date – End Date",
+            "description": "Job responsibilities"
+        }}
+    ],
+    "projects": [
+        {{
+            "name": "Project Name",
+            "description": "Project description",
+            "technologies": "Technologies used",
+            "duration": "Timeline"
+        }}
+    ],
+    "years_of_experience": null,
+    "certifications": ["Certification 1"]
+}}
+
+Resume Text:
+{resume_text}
+"""
 
 # Pydantic Models
 class Education(BaseModel):
@@ -54,9 +113,38 @@ class CompleteResume(BaseModel):
     years_of_experience: Optional[str] = None
     certifications: List[str] = Field(default_factory=list)
 
-def get_llm():
-    """Get the LLM instance."""
-    return OllamaLLM(model=MODEL_NAME, temperature=0.1, base_url=OLLAMA_BASE_URL)
+def pick_num_ctx(prompt_tokens: int, output_tokens: int = 0) -> int:
+    """Get the smallest context bucket that fits the prompt and expected output."""
+    needed = int((prompt_tokens + output_tokens) * CONTEXT_MARGIN)
+    for bucket in CONTEXT_BUCKETS:
+        if needed <= bucket:
+            return bucket
+    return CONTEXT_BUCKETS[-1]
+
+def parse_num_ctx() -> int:
+    """The largest context a parse needs: the prompt with a resume at its token budget, plus the output."""
+    return pick_num_ctx(count_tokens(RESUME_PROMPT_TEMPLATE) + RESUME_TOKEN_BUDGET, PARSE_OUTPUT_TOKENS)
+
+def get_llm(prompt_tokens: int = 0, output_tokens: int = 0):
+    """Get the LLM instance for the prompt, reusing one client per context size.
+
+    The size is the model's pinned num_ctx (at least the bucket the prompt
+    needs), so calls never make Ollama reload the model with another one.
+    """
+    num_ctx = model_manager.num_ctx_for(MODEL_NAME, pick_num_ctx(prompt_tokens, output_tokens))
+    with _llm_lock:
+        llm = _llm_clients.get(num_ctx)
+        if llm is None:
+            llm = OllamaLLM(
+                model=MODEL_NAME,
+                temperature=0.1,
+                base_url=OLLAMA_BASE_URL,
+                num_ctx=num_ctx,
+                keep_alive=OLLAMA_KEEP_ALIVE,
+                callbacks=[UsageCallback("ollama", MODEL_NAME, count_tokens), LoadCallback(MODEL_NAME)],
+            )
+            _llm_clients[num_ctx] = llm
+        return llm
 
 def clean_json_response(response: str) -> str:
     """Clean and extract JSON from LLM response."""
@@ -103,54 +191,11 @@ def calculate_years_of_experience(work_experiences: List[dict]) -> str:
 
 def extract_complete_resume_info(resume_text: str) -> CompleteResume:
     """Extract all resume information in a single API call."""
-    
-    prompt_template = """
-Extract information from the resume text and return ONLY a valid JSON object.
-
-JSON Format:
-{{
-    "name": "Full Name",
-    "email": "email@domain.com",
-    "phone": "phone number",
-    "location": "City, Country",
-    "summary": "Professional summary",
-    "technical_skills": ["Python", "Java", "React"],
-    "soft_skills": ["Leadership", "Communication"],
-    "education": [
-        {{
-            "institution": "University Name",
-            "degree": "Bachelor/Master",
-            "field_of_study": "Computer Science",
-            "graduation_year": "2020"
-        }}
-    ],
-    "work_experience": [
-        {{
-            "company": "Company Name",
-            "position": "Job Title",
-            "duration": "Start Date – End Date",
-            "description": "Job responsibilities"
-        }}
-    ],
-    "projects": [
-        {{
-            "name": "Project Name",
-            "description": "Project description",
-            "technologies": "Technologies used",
-            "duration": "Timeline"
-        }}
-    ],
-    "years_of_experience": null,
-    "certifications": ["Certification 1"]
-}}
-
-Resume Text:
-{resume_text}
-"""
-
     try:
-        llm = get_llm()
-        response = llm.invoke(prompt_template.format(resume_text=resume_text))
+        prompt = RESUME_PROMPT_TEMPLATE.format(resume_text=resume_text)
+        llm = get_llm(count_tokens(prompt), PARSE_OUTPUT_TOKENS)
+        with get_limiter("ollama", MODEL_NAME).slot():
+            response = llm.invoke(prompt)
         
         cleaned_response = clean_json_response(response)
         parsed_data = json.loads(cleaned_response)
@@ -162,6 +207,8 @@ Resume Text:
         
         return CompleteResume(**parsed_data)
         
+    except LLMOverloadedError:
+        raise
     except Exception as e:
         print(f"Error in extraction: {e}")
         return CompleteResume()
@@ -212,20 +259,27 @@ def process_resume_with_timing(file_path: str):
         print(f"❌ Error reading file: {e}")
         return None
     
-    # Step 2: LLM Processing
+    # Step 2: Prompt Compaction
+    compaction = compact_text(extracted_text, RESUME_TOKEN_BUDGET)
+    print(f"✂️  Prompt Compaction: {compaction.original_tokens} -> {compaction.compacted_tokens} tokens "
+          f"({compaction.tokens_saved} saved{', truncated' if compaction.truncated else ''})")
+    
+    # Step 3: LLM Processing
     llm_start_time = time.time()
     try:
-        resume = extract_complete_resume_info(extracted_text)
+        resume = extract_complete_resume_info(compaction.text)
         llm_end_time = time.time()
         llm_time = llm_end_time - llm_start_time
         
         print(f"🤖 LLM Processing: {llm_time:.2f} seconds")
         
+    except LLMOverloadedError:
+        raise
     except Exception as e:
         print(f"❌ Error in LLM processing: {e}")
         return None
     
-    # Step 3: Save Results
+    # Step 4: Save Results
     save_start_time = time.time()
     try:
         output_file = f"Results/{Path(file_path).stem}_extracted.json"
@@ -255,7 +309,9 @@ def process_resume_with_timing(file_path: str):
         'llm_time': llm_time,
         'save_time': save_time,
         'total_time': total_time,
-        'text_length': len(extracted_text)
+        'text_length': len(extracted_text),
+        'prompt_tokens': compaction.compacted_tokens,
+        'prompt_tokens_saved': compaction.tokens_saved
     }
 
 def print_resume_summary(resume: CompleteResume):
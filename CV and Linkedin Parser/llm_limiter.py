@@ -0,0 +1,381 @@
+import asyncio
+import math
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager, contextmanager
+from contextvars import ContextVar
+from typing import Deque, Dict, List, Optional, Tuple
+
+LLM_INITIAL_CONCURRENCY = int(os.getenv("LLM_INITIAL_CONCURRENCY", "4"))
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "32"))
+LLM_MAX_QUEUE = int(os.getenv("LLM_MAX_QUEUE", "32"))
+LLM_QUEUE_TIMEOUT_SECONDS = float(os.getenv("LLM_QUEUE_TIMEOUT_SECONDS", "30"))
+
+# Priority lanes and their weighted-fair-queuing weights, e.g. "interactive:8,batch:1".
+LLM_LANES: Dict[str, float] = {
+    name.strip(): float(weight)
+    for name, weight in (
+        item.split(":") for item in os.getenv("LLM_LANES", "interactive:8,batch:1").split(",") if item.strip()
+    )
+}
+DEFAULT_LANE = "interactive"
+# Latency baseline for calls that do not name their kind
+DEFAULT_KIND = "default"
+# Most backend limiters kept; idle ones are dropped, least recently used first, past this.
+LLM_LIMITER_REGISTRY_SIZE = int(os.getenv("LLM_LIMITER_REGISTRY_SIZE", "64"))
+
+# Lane for LLM calls made from the current request; set by batch endpoints.
+current_lane: ContextVar[str] = ContextVar("llm_lane", default=DEFAULT_LANE)
+
+
+@contextmanager
+def use_lane(lane: str):
+    """Run the enclosed LLM calls (including ones in threadpool workers) in `lane`."""
+    if lane not in LLM_LANES:
+        raise ValueError(f"Unknown LLM lane '{lane}'. Valid lanes: {', '.join(LLM_LANES)}")
+    token = current_lane.set(lane)
+    try:
+        yield
+    finally:
+        current_lane.reset(token)
+
+
+class LLMOverloadedError(Exception):
+    """Raised when an LLM backend's queue is full or the wait timed out."""
+
+    def __init__(self, backend: str, retry_after: int, lane: str = DEFAULT_LANE):
+        super().__init__(f"LLM backend {backend} is at capacity for {lane} work, retry after {retry_after}s")
+        self.backend = backend
+        self.retry_after = retry_after
+        self.lane = lane
+
+
+class _Waiter:
+    __slots__ = ("event", "future", "loop", "granted", "enqueued_at")
+
+    def __init__(self, event=None, future=None, loop=None):
+        self.event = event
+        self.future = future
+        self.loop = loop
+        self.granted = False
+        self.enqueued_at = time.perf_counter()
+
+
+def _resolve(future: asyncio.Future):
+    if not future.done():
+        future.set_result(True)
+
+
+class _Lane:
+    """Queue and wait-time statistics for one priority lane."""
+
+    def __init__(self, name: str, weight: float):
+        self.name = name
+        self.weight = weight
+        self.queue: Deque[_Waiter] = deque()
+        self.virtual_time = 0.0
+        self.granted = 0
+        self.shed = 0
+        self.waits: Deque[float] = deque(maxlen=500)
+        self.wait_total = 0.0
+
+    def record_wait(self, seconds: float):
+        self.granted += 1
+        self.wait_total += seconds
+        self.waits.append(seconds)
+
+    def snapshot(self) -> Dict:
+        waits = sorted(self.waits)
+
+        def pct(p: float) -> Optional[float]:
+            return round(waits[min(len(waits) - 1, int(p * len(waits)))], 3) if waits else None
+
+        return {
+            "weight": self.weight,
+            "queued": len(self.queue),
+            "granted": self.granted,
+            "shed": self.shed,
+            "queue_wait_avg": round(self.wait_total / self.granted, 3) if self.granted else None,
+            "queue_wait_p50": pct(0.5),
+            "queue_wait_p95": pct(0.95),
+            "queue_wait_max": round(waits[-1], 3) if waits else None,
+        }
+
+
+class AdaptiveConcurrencyLimiter:
+    """AIMD concurrency limit for one (provider, model) backend.
+
+    Every completed call feeds its latency back: while latency stays within
+    `latency_tolerance` times the long-run baseline the limit grows by one
+    per window of successful calls (additive increase); latency inflation or
+    an error multiplies it by `backoff` (multiplicative decrease).
+
+    Latency baselines are kept per kind of call (`slot(kind=...)`), since a
+    short objective and a full letter on the same model differ by far more
+    than the tolerance. The limit is cut at most once per round trip: calls
+    that started before the last decrease ran at the old limit, so their
+    latency or failure does not cut it again.
+
+    Callers over the limit wait in a bounded queue per priority lane. Free
+    slots are handed out by weighted fair queuing across lanes, so a flood
+    of batch work only gets its weight's share of the backend. Callers are
+    shed with LLMOverloadedError when their lane's queue is full or the
+    wait times out.
+
+    Usable from threads (`slot`) and coroutines (`aslot`).
+    """
+
+    def __init__(
+        self,
+        name: str,
+        initial_limit: int = LLM_INITIAL_CONCURRENCY,
+        min_limit: int = 1,
+        max_limit: int = LLM_MAX_CONCURRENCY,
+        max_queue: int = LLM_MAX_QUEUE,
+        queue_timeout: float = LLM_QUEUE_TIMEOUT_SECONDS,
+        latency_tolerance: float = 2.0,
+        backoff: float = 0.75,
+        lanes: Optional[Dict[str, float]] = None,
+    ):
+        self.name = name
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.latency_tolerance = latency_tolerance
+        self.backoff = backoff
+
+        self._lock = threading.Lock()
+        self._lanes = {lane: _Lane(lane, weight) for lane, weight in (lanes or LLM_LANES).items()}
+        self._virtual_time = 0.0
+        self._limit = float(max(min_limit, min(initial_limit, max_limit)))
+        self.in_flight = 0
+        self.recent_latency: Optional[float] = None  # across kinds, for Retry-After
+        self._latency: Dict[str, List[float]] = {}  # kind -> [baseline, recent]
+        self._last_decrease = float("-inf")
+
+        self.completed = 0
+        self.errors = 0
+        self.decreases = 0
+
+    @property
+    def limit(self) -> int:
+        return max(self.min_limit, int(self._limit))
+
+    def _lane(self, lane: Optional[str]) -> _Lane:
+        lane = lane or current_lane.get()
+        try:
+            return self._lanes[lane]
+        except KeyError:
+            raise ValueError(f"Unknown LLM lane '{lane}'. Valid lanes: {', '.join(self._lanes)}")
+
+    def _queued(self) -> int:
+        return sum(len(lane.queue) for lane in self._lanes.values())
+
+    def retry_after(self) -> int:
+        """Rough seconds until a slot frees up, for the Retry-After header."""
+        latency = self.recent_latency or 5.0
+        return max(1, math.ceil(latency * (self._queued() + 1) / self.limit))
+
+    def _overloaded(self, lane: _Lane) -> LLMOverloadedError:
+        lane.shed += 1
+        return LLMOverloadedError(self.name, self.retry_after(), lane.name)
+
+    # -- admission -----------------------------------------------------------
+
+    def _try_enter(self, lane: _Lane, waiter: _Waiter) -> bool:
+        """Take a slot or enqueue the waiter. Must hold the lock."""
+        if self.in_flight < self.limit and not self._queued():
+            self.in_flight += 1
+            lane.record_wait(0.0)
+            return True
+        if len(lane.queue) >= self.max_queue:
+            raise self._overloaded(lane)
+        if not lane.queue:
+            # A lane returning from idle starts at the current virtual time
+            # instead of cashing in credit for the time it was empty.
+            lane.virtual_time = max(lane.virtual_time, self._virtual_time)
+        lane.queue.append(waiter)
+        return False
+
+    def _grant_next(self):
+        """Hand free slots to queued waiters by weighted fair queuing. Must hold the lock."""
+        while self.in_flight < self.limit:
+            active = [lane for lane in self._lanes.values() if lane.queue]
+            if not active:
+                return
+            lane = min(active, key=lambda l: l.virtual_time)
+            waiter = lane.queue.popleft()
+            self._virtual_time = lane.virtual_time
+            lane.virtual_time += 1.0 / lane.weight
+            lane.record_wait(time.perf_counter() - waiter.enqueued_at)
+            waiter.granted = True
+            self.in_flight += 1
+            if waiter.future is not None:
+                waiter.loop.call_soon_threadsafe(_resolve, waiter.future)
+            else:
+                waiter.event.set()
+
+    def _give_up(self, lane: _Lane, waiter: _Waiter) -> bool:
+        """Remove a waiter that stopped waiting. Returns True if it got a slot meanwhile. Must hold the lock."""
+        if waiter.granted:
+            return True
+        lane.queue.remove(waiter)
+        return False
+
+    def acquire(self, lane: Optional[str] = None):
+        lane = self._lane(lane)
+        waiter = _Waiter(event=threading.Event())
+        with self._lock:
+            if self._try_enter(lane, waiter):
+                return
+        if not waiter.event.wait(self.queue_timeout):
+            with self._lock:
+                if not self._give_up(lane, waiter):
+                    raise self._overloaded(lane)
+
+    async def acquire_async(self, lane: Optional[str] = None):
+        lane = self._lane(lane)
+        loop = asyncio.get_running_loop()
+        waiter = _Waiter(future=loop.create_future(), loop=loop)
+        with self._lock:
+            if self._try_enter(lane, waiter):
+                return
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter.future), self.queue_timeout)
+        except asyncio.TimeoutError:
+            with self._lock:
+                if not self._give_up(lane, waiter):
+                    raise self._overloaded(lane)
+        except asyncio.CancelledError:
+            with self._lock:
+                if self._give_up(lane, waiter):
+                    self.in_flight -= 1
+                    self._grant_next()
+            raise
+
+    def release(self, latency: Optional[float] = None, ok: Optional[bool] = True, kind: str = DEFAULT_KIND):
+        """Free a slot. `ok=None` releases without feeding the control loop."""
+        with self._lock:
+            self.in_flight -= 1
+            if ok is not None:
+                self._update_limit(latency, ok, kind)
+            self._grant_next()
+
+    # -- AIMD control loop ---------------------------------------------------
+
+    def _update_limit(self, latency: Optional[float], ok: bool, kind: str):
+        now = time.perf_counter()
+        started = now - latency if latency is not None else now
+        if not ok:
+            self.errors += 1
+            self._decrease(started, now)
+            return
+
+        self.completed += 1
+        if latency is None:
+            return
+        self.recent_latency = latency if self.recent_latency is None else 0.7 * self.recent_latency + 0.3 * latency
+        stats = self._latency.get(kind)
+        if stats is None:
+            self._latency[kind] = [latency, latency]
+            return
+        stats[1] = 0.7 * stats[1] + 0.3 * latency
+        if stats[1] > stats[0] * self.latency_tolerance:
+            self._decrease(started, now)
+            # Let the baseline follow slowly so a permanent shift is accepted.
+            stats[0] = 0.9 * stats[0] + 0.1 * latency
+        else:
+            stats[0] = 0.95 * stats[0] + 0.05 * latency
+            self._limit = min(float(self.max_limit), self._limit + 1.0 / self._limit)
+
+    def _decrease(self, started: float, now: float):
+        """Cut the limit, unless the call started before the last cut (once per round trip)."""
+        if started < self._last_decrease:
+            return
+        self._last_decrease = now
+        self.decreases += 1
+        self._limit = max(float(self.min_limit), self._limit * self.backoff)
+
+    # -- context managers ----------------------------------------------------
+
+    @contextmanager
+    def slot(self, lane: Optional[str] = None, kind: str = DEFAULT_KIND):
+        """Hold a slot for one LLM call; `kind` names the call's latency baseline, e.g. the endpoint."""
+        self.acquire(lane)
+        start = time.perf_counter()
+        ok = False
+        try:
+            yield
+            ok = True
+        finally:
+            self.release(time.perf_counter() - start, ok, kind)
+
+    @asynccontextmanager
+    async def aslot(self, lane: Optional[str] = None, kind: str = DEFAULT_KIND):
+        await self.acquire_async(lane)
+        start = time.perf_counter()
+        ok: Optional[bool] = False
+        try:
+            yield
+            ok = True
+        except (asyncio.CancelledError, GeneratorExit):
+            ok = None  # the caller went away; says nothing about the backend
+            raise
+        finally:
+            self.release(time.perf_counter() - start, ok, kind)
+
+    def snapshot(self) -> Dict:
+        with self._lock:
+            return {
+                "limit": self.limit,
+                "in_flight": self.in_flight,
+                "queued": self._queued(),
+                "recent_latency": round(self.recent_latency, 3) if self.recent_latency else None,
+                "latency_by_kind": {
+                    kind: {"baseline": round(baseline, 3), "recent": round(recent, 3)}
+                    for kind, (baseline, recent) in self._latency.items()
+                },
+                "completed": self.completed,
+                "errors": self.errors,
+                "shed": sum(lane.shed for lane in self._lanes.values()),
+                "decreases": self.decreases,
+                "lanes": {name: lane.snapshot() for name, lane in self._lanes.items()},
+            }
+
+
+_limiters: "OrderedDict[Tuple[str, str], AdaptiveConcurrencyLimiter]" = OrderedDict()
+_limiters_lock = threading.Lock()
+
+
+def get_limiter(provider: str, model: str) -> AdaptiveConcurrencyLimiter:
+    """Return the process-wide limiter for a (provider, model) backend.
+
+    Past LLM_LIMITER_REGISTRY_SIZE backends, the least recently used idle
+    limiter is dropped; one with calls in flight or queued is never dropped,
+    so its slots keep being enforced.
+    """
+    key = (provider, model)
+    with _limiters_lock:
+        limiter = _limiters.get(key)
+        if limiter is not None:
+            _limiters.move_to_end(key)
+            return limiter
+        limiter = AdaptiveConcurrencyLimiter(f"{provider}:{model}")
+        _limiters[key] = limiter
+        excess = len(_limiters) - LLM_LIMITER_REGISTRY_SIZE
+        for old_key, old in list(_limiters.items()):
+            if excess <= 0:
+                break
+            if old is not limiter and not old.in_flight and not old._queued():
+                del _limiters[old_key]
+                excess -= 1
+        return limiter
+
+
+def limiter_snapshots() -> Dict[str, Dict]:
+    with _limiters_lock:
+        limiters = list(_limiters.values())
+    return {limiter.name: limiter.snapshot() for limiter in limiters}
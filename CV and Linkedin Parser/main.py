@@ -1,5 +1,6 @@
 from fastapi import FastAPI, File, UploadFile, HTTPException, Form, BackgroundTasks, Request, Depends
 from fastapi.responses import JSONResponse
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel, Field
 from typing import Optional, List, Dict, Any, Literal
@@ -23,6 +24,11 @@ from slowapi.errors import RateLimitExceeded
 # Import your existing parsers
 import cvparser1  # Manual parser
 import cvparser   # LLM-based parser
+from llm_limiter import LLMOverloadedError, limiter_snapshots, use_lane
+from ollama_manager import model_manager
+from prompt_compaction import compaction_stats
+from http_caching import conditional_json
+from usage_tracker import api_key_id, usage_scope, usage_tracker
 
 # Configure logging with UTF-8 encoding fix
 logging.basicConfig(
@@ -152,6 +158,8 @@ class ProcessingMetadata(BaseModel):
     request_id: str
     cached: bool = False
     file_hash: Optional[str] = None
+    prompt_tokens: Optional[int] = None
+    prompt_tokens_saved: Optional[int] = None
 
 class CVParseResponse(BaseModel):
     success: bool
@@ -197,6 +205,10 @@ async def lifespan(app: FastAPI):
     os.makedirs("Results", exist_ok=True)
     os.makedirs("temp", exist_ok=True)
     
+    # Preload the Ollama model, at the context size every parse fits in, and keep it resident
+    model_manager.num_ctx_for(cvparser.MODEL_NAME, cvparser.parse_num_ctx())
+    model_manager.start()
+    
     # Check LLM availability
     try:
         llm = cvparser.get_llm()
@@ -213,6 +225,7 @@ async def lifespan(app: FastAPI):
     yield
     
     logger.info("Shutting down CV Parser API...")
+    model_manager.stop()
 
 # Initialize FastAPI app
 app = FastAPI(
@@ -242,7 +255,7 @@ async def rate_limit_middleware(request: Request, call_next):
     client_ip = get_remote_address(request)
     
     # Skip rate limiting for documentation and health endpoints
-    skip_paths = ["/health", "/", "/docs", "/redoc", "/openapi.json", "/favicon.ico"]
+    skip_paths = ["/health", "/metrics", "/", "/docs", "/redoc", "/openapi.json", "/favicon.ico"]
     if request.url.path in skip_paths:
         response = await call_next(request)
         return response
@@ -273,6 +286,12 @@ async def rate_limit_middleware(request: Request, call_next):
     
     return response
 
+# Charge LLM tokens to the endpoint and API key, including threadpool work the request starts
+@app.middleware("http")
+async def attribute_usage(request: Request, call_next):
+    with usage_scope(request.url.path, api_key_id(request.headers)):
+        return await call_next(request)
+
 # Utility functions
 def generate_request_id() -> str:
     """Generate unique request ID."""
@@ -439,6 +458,18 @@ async def health_check():
             "success_rate": round((app_state.successful_requests / max(app_state.total_requests, 1)) * 100, 2),
             "cache_size": len(file_cache.cache)
         },
+        "prompt_compaction": compaction_stats.snapshot(),
+        "timestamp": datetime.now().isoformat()
+    }
+
+@app.get("/metrics", tags=["Health"])
+async def metrics():
+    """LLM serving metrics: model warm-keeping, prompt compaction and token usage"""
+    return {
+        "ollama": model_manager.snapshot(),
+        "llm_limiters": limiter_snapshots(),
+        "prompt_compaction": compaction_stats.snapshot(),
+        "token_usage": await asyncio.to_thread(usage_tracker.snapshot),
         "timestamp": datetime.now().isoformat()
     }
 
@@ -592,7 +623,7 @@ async def parse_cv(
             logger.info(f"[{request_id}] Using LLM parser")
             
             try:
-                result = cvparser.process_resume_with_timing(temp_file_path)
+                result = await run_in_threadpool(cvparser.process_resume_with_timing, temp_file_path)
                 if not result:
                     raise Exception("LLM parser returned no result")
                 
@@ -606,6 +637,8 @@ async def parse_cv(
                     llm_time=timing_info["llm_time"],
                     save_time=timing_info["save_time"],
                     text_length=timing_info["text_length"],
+                    prompt_tokens=timing_info.get("prompt_tokens"),
+                    prompt_tokens_saved=timing_info.get("prompt_tokens_saved"),
                     file_size=file_size,
                     processed_at=datetime.now().isoformat(),
                     request_id=request_id,
@@ -613,6 +646,18 @@ async def parse_cv(
                     file_hash=file_hash
                 )
                 
+            except LLMOverloadedError as e:
+                logger.warning(f"[{request_id}] LLM at capacity: {e}")
+                raise HTTPException(
+                    status_code=503,
+                    detail={
+                        "error_code": "LLM_OVERLOADED",
+                        "message": "LLM service is at capacity. Please retry later or use method=manual.",
+                        "retry_after_seconds": e.retry_after,
+                        "request_id": request_id
+                    },
+                    headers={"Retry-After": str(e.retry_after)}
+                )
             except Exception as e:
                 logger.error(f"[{request_id}] LLM parsing failed: {e}")
                 raise HTTPException(
@@ -759,49 +804,51 @@ async def parse_cv_batch(
     successful_count = 0
     failed_count = 0
     
-    for i, file in enumerate(files):
-        try:
-            # Reset file pointer
-            await file.seek(0)
+    # Batch uploads queue for the LLM behind interactive single-CV requests
+    with use_lane("batch"):
+        for i, file in enumerate(files):
+            try:
+                # Reset file pointer
+                await file.seek(0)
             
-            # Process each file individually - this will raise HTTPException on error
-            result = await parse_cv(request, background_tasks, file, method, save_result=True)
+                # Process each file individually - this will raise HTTPException on error
+                result = await parse_cv(request, background_tasks, file, method, save_result=True)
             
-            results.append({
-                "filename": file.filename,
-                "status": "success",
-                "request_id": result.request_id,
-                "data": result.data,
-                "processing_time": result.metadata.total_time if result.metadata else 0,
-                "cached": result.metadata.cached if result.metadata else False
-            })
-            successful_count += 1
+                results.append({
+                    "filename": file.filename,
+                    "status": "success",
+                    "request_id": result.request_id,
+                    "data": result.data,
+                    "processing_time": result.metadata.total_time if result.metadata else 0,
+                    "cached": result.metadata.cached if result.metadata else False
+                })
+                successful_count += 1
             
-        except HTTPException as he:
-            # Log the error but continue processing other files
-            logger.error(f"[{request_id}] Failed to process {file.filename}: HTTP {he.status_code} - {he.detail}")
+            except HTTPException as he:
+                # Log the error but continue processing other files
+                logger.error(f"[{request_id}] Failed to process {file.filename}: HTTP {he.status_code} - {he.detail}")
             
-            results.append({
-                "filename": file.filename,
-                "status": "error",
-                "error_code": he.detail.get("error_code", "HTTP_ERROR") if isinstance(he.detail, dict) else "HTTP_ERROR",
-                "error_message": he.detail.get("message", str(he.detail)) if isinstance(he.detail, dict) else str(he.detail),
-                "http_status": he.status_code
-            })
-            failed_count += 1
+                results.append({
+                    "filename": file.filename,
+                    "status": "error",
+                    "error_code": he.detail.get("error_code", "HTTP_ERROR") if isinstance(he.detail, dict) else "HTTP_ERROR",
+                    "error_message": he.detail.get("message", str(he.detail)) if isinstance(he.detail, dict) else str(he.detail),
+                    "http_status": he.status_code
+                })
+                failed_count += 1
             
-        except Exception as e:
-            # Handle unexpected errors
-            logger.error(f"[{request_id}] Unexpected error processing {file.filename}: {e}")
+            except Exception as e:
+                # Handle unexpected errors
+                logger.error(f"[{request_id}] Unexpected error processing {file.filename}: {e}")
             
-            results.append({
-                "filename": file.filename,
-                "status": "error",
-                "error_code": "INTERNAL_SERVER_ERROR",
-                "error_message": f"Unexpected error: {str(e)}",
-                "http_status": 500
-            })
-            failed_count += 1
+                results.append({
+                    "filename": file.filename,
+                    "status": "error",
+                    "error_code": "INTERNAL_SERVER_ERROR",
+                    "error_message": f"Unexpected error: {str(e)}",
+                    "http_status": 500
+                })
+                failed_count += 1
     
     # Determine overall success based on results
     overall_success = successful_count > 0
@@ -878,8 +925,8 @@ async def get_result(request: Request, request_id: str):
 @app.get("/supported-formats", tags=["Info"])
 @limiter.limit("60/minute")
 async def get_supported_formats(request: Request):
-    """Get comprehensive API information"""
-    return {
+    """Get comprehensive API information (ETag-validated; 304 when unchanged)"""
+    return conditional_json(request, {
         "supported_formats": [
             {
                 "extension": ".pdf",
@@ -948,6 +995,7 @@ async def get_supported_formats(request: Request):
             "FILE_SAVE_ERROR": "Cannot save uploaded file to temporary storage",
             "MANUAL_PARSING_FAILED": "Rule-based parser encountered an error",
             "LLM_UNAVAILABLE": "AI service is not available",
+            "LLM_OVERLOADED": "AI service is at capacity, retry after the Retry-After header",
             "LLM_PARSING_FAILED": "AI parser encountered an error",
             "BATCH_SIZE_EXCEEDED": "Too many files in batch request",
             "MISSING_FILENAME": "Uploaded file missing filename",
@@ -957,7 +1005,7 @@ async def get_supported_formats(request: Request):
             "RATE_LIMIT_EXCEEDED": "Too many requests from IP address",
             "INTERNAL_SERVER_ERROR": "Unexpected server error"
         }
-    }
+    }, cache_control="public, max-age=60")
 
 # =============================================================================
 # ERROR HANDLERS
@@ -975,7 +1023,8 @@ async def http_exception_handler(request: Request, exc: HTTPException):
             error_code=exc.detail.get("error_code", "HTTP_ERROR") if isinstance(exc.detail, dict) else "HTTP_ERROR",
             request_id=exc.detail.get("request_id", "unknown") if isinstance(exc.detail, dict) else "unknown",
             timestamp=datetime.now().isoformat()
-        ).dict()
+        ).dict(),
+        headers=getattr(exc, "headers", None)
     )
 
 @app.exception_handler(RateLimitExceeded)
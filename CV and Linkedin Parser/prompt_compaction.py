@@ -0,0 +1,280 @@
+import os
+import re
+import threading
+import unicodedata
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import Dict, List, Optional
+
+# The tokenizer, normalization and `compact_text` are shared with the cover
+# letter service's copy of this module and must be kept identical to it;
+# that copy adds endpoint budgets and passage selection.
+
+# Local tokenizer: a BPE-style pre-tokenizer split, where every word piece
+# costs roughly one token per four characters. It tracks the llama3 / cl100k
+# tokenizers closely enough for budgeting without pulling in a tokenizer
+# dependency or downloading vocabularies at runtime.
+_TOKEN_PIECE_RE = re.compile(r"[A-Za-z]+|\d{1,3}|[^\sA-Za-z\d]+|\s+")
+
+_BULLET_RE = re.compile(r"^\s*(?:[•●▪■□◦‣∙·►▶➢➤✓✔❖◆◇○\*]|-(?=\s)|–(?=\s)|—(?=\s))+\s*")
+# "Page 3", "Page 3 of 5": a page label wherever it is
+_PAGE_LABEL_RE = re.compile(r"^\s*page\s*\d+(?:\s*(?:of|/)\s*\d+)?\s*$", re.IGNORECASE)
+# "3 of 5", "3/5", "- 3 -", "3": a page number only at the top or bottom of a page
+_PAGE_NUMBER_RE = re.compile(r"^\s*(?:\d+\s*(?:of|/)\s*\d+|[-–—]\s*\d+\s*[-–—]|\d{1,3})\s*$")
+# Lines at each end of a page that can be a running header or footer
+_PAGE_EDGE_LINES = 2
+_SENTENCE_SPLIT_RE = re.compile(r"(?<=[.!?])\s+(?=[A-Z0-9])")
+_WORD_RE = re.compile(r"[a-z0-9][a-z0-9+#.]*")
+
+# Section headings ranked by how much they matter to the prompt. Sections
+# with a low weight are the first to go when a field is over budget.
+SECTION_WEIGHTS = {
+    "summary": 3.0, "profile": 3.0, "objective": 2.0,
+    "experience": 4.0, "employment": 4.0, "work history": 4.0,
+    "skills": 4.0, "technical skills": 4.0,
+    "education": 2.5, "certifications": 2.5, "projects": 3.0,
+    "achievements": 3.0, "awards": 1.5, "publications": 1.0,
+    "languages": 1.0, "volunteer": 1.0, "additional information": 1.0,
+    "interests": 0.5, "hobbies": 0.5, "references": 0.2,
+}
+
+STOPWORDS = {
+    "a", "an", "and", "are", "as", "at", "be", "by", "for", "from", "in", "is",
+    "it", "of", "on", "or", "our", "that", "the", "to", "we", "with", "you",
+    "your", "will", "this", "have", "has", "who", "all",
+}
+
+# Token budget for the resume text sent to the LLM parser.
+RESUME_TOKEN_BUDGET = int(os.getenv("CV_PROMPT_TOKEN_BUDGET", "3000"))
+
+
+def count_tokens(text: str) -> int:
+    """Count tokens in text with the local approximate tokenizer."""
+    if not text:
+        return 0
+    total = 0
+    for piece in _TOKEN_PIECE_RE.findall(text):
+        if piece.isspace():
+            total += piece.count("\n")
+        else:
+            total += max(1, (len(piece) + 3) // 4)
+    return total
+
+
+@dataclass
+class CompactionResult:
+    text: str
+    original_tokens: int
+    compacted_tokens: int
+    truncated: bool = False
+
+    @property
+    def tokens_saved(self) -> int:
+        return self.original_tokens - self.compacted_tokens
+
+
+class CompactionStats:
+    """Thread-safe running totals of what compaction saved."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.original_tokens = 0
+        self.compacted_tokens = 0
+        self.truncations = 0
+
+    def record(self, result: CompactionResult):
+        with self._lock:
+            self.calls += 1
+            self.original_tokens += result.original_tokens
+            self.compacted_tokens += result.compacted_tokens
+            self.truncations += int(result.truncated)
+
+    def snapshot(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "calls": self.calls,
+                "original_tokens": self.original_tokens,
+                "compacted_tokens": self.compacted_tokens,
+                "tokens_saved": self.original_tokens - self.compacted_tokens,
+                "truncations": self.truncations,
+            }
+
+
+compaction_stats = CompactionStats()
+
+
+def _normalize_line(line: str) -> str:
+    line = _BULLET_RE.sub("- ", line) if _BULLET_RE.match(line) else line
+    return re.sub(r"[ \t]+", " ", line).strip()
+
+
+def _dedupe_key(line: str) -> str:
+    return re.sub(r"[^a-z0-9@+]", "", line.lower())
+
+
+def _split_pages(lines: List[str]) -> List[List[str]]:
+    """Split lines into pages at form feeds (as PDF extraction emits) and page labels; the labels are dropped."""
+    pages: List[List[str]] = [[]]
+    for line in lines:
+        if line == "\f" or _PAGE_LABEL_RE.match(line):
+            pages.append([])
+        else:
+            pages[-1].append(line)
+    return pages
+
+
+def _page_edges(page: List[str]) -> set:
+    """Indices of the first and last few non-blank lines of a page."""
+    filled = [i for i, line in enumerate(page) if line]
+    return set(filled[:_PAGE_EDGE_LINES] + filled[-_PAGE_EDGE_LINES:])
+
+
+@lru_cache(maxsize=256)
+def normalize_text(text: str) -> str:
+    """Normalize whitespace and bullets, and drop page furniture.
+
+    Page furniture is page labels, page numbers at the top or bottom of a
+    page, and running headers and footers: lines at a page edge that recur
+    at the edges of other pages, kept once. Body lines are never
+    deduplicated, since CVs legitimately repeat job titles and bullets.
+
+    Memoized: a bulk run compacts the same CV (or job description) once per
+    pairing, and only the budget truncation depends on the other side.
+    """
+    if not text:
+        return ""
+    text = unicodedata.normalize("NFKC", text).replace("\r\n", "\n").replace("\r", "\n")
+    raw_lines = [line if line == "\f" else _normalize_line(line) for line in text.replace("\f", "\n\f\n").split("\n")]
+    pages = [(page, _page_edges(page)) for page in _split_pages(raw_lines)]
+
+    edge_pages: Dict[str, int] = {}
+    for page, edges in pages:
+        for key in {_dedupe_key(page[i]) for i in edges}:
+            edge_pages[key] = edge_pages.get(key, 0) + 1
+
+    seen = set()
+    lines: List[str] = []
+    for page, edges in pages:
+        for i, line in enumerate(page):
+            if not line:
+                if lines and lines[-1]:
+                    lines.append("")
+                continue
+            key = _dedupe_key(line)
+            if not key:
+                continue
+            if i in edges:
+                if _PAGE_NUMBER_RE.match(line):
+                    continue
+                if edge_pages[key] > 1 and key in seen:
+                    continue
+                seen.add(key)
+            lines.append(line)
+
+    return "\n".join(lines).strip()
+
+
+def _terms(text: str) -> List[str]:
+    return [w for w in _WORD_RE.findall(text.lower()) if w not in STOPWORDS and len(w) > 1]
+
+
+def _is_heading(line: str) -> bool:
+    stripped = line.strip().rstrip(":")
+    if not stripped or len(stripped) > 40 or stripped.endswith("."):
+        return False
+    lowered = stripped.lower()
+    return any(name in lowered for name in SECTION_WEIGHTS)
+
+
+def _split_sections(text: str) -> List[List[str]]:
+    sections: List[List[str]] = [[]]
+    for line in text.split("\n"):
+        if _is_heading(line) and sections[-1]:
+            sections.append([line])
+        else:
+            sections[-1].append(line)
+    return [s for s in sections if any(l.strip() for l in s)]
+
+
+def _section_weight(section: List[str]) -> float:
+    heading = section[0].strip().rstrip(":").lower()
+    for name, weight in SECTION_WEIGHTS.items():
+        if name in heading:
+            return weight
+    return 2.0
+
+
+def _relevance(text: str, query_terms: set) -> float:
+    terms = _terms(text)
+    if not terms or not query_terms:
+        return 0.0
+    return sum(1 for t in terms if t in query_terms) / len(terms)
+
+
+def _fit_units(units: List[str], scores: List[float], max_tokens: int, keep_first: bool, joiner: str) -> str:
+    """Drop the lowest scoring units until the joined text fits the budget."""
+    keep = list(range(len(units)))
+    dropped = []
+    for idx in sorted(keep, key=lambda i: scores[i]):
+        if count_tokens(joiner.join(units[i] for i in keep)) <= max_tokens:
+            break
+        if (keep_first and idx == 0) or len(keep) == 1:
+            continue
+        keep.remove(idx)
+        dropped.append(idx)
+
+    # Dropping a large unit can overshoot; put back whatever still fits.
+    for idx in sorted(dropped, key=lambda i: -scores[i]):
+        candidate = sorted(keep + [idx])
+        if count_tokens(joiner.join(units[i] for i in candidate)) <= max_tokens:
+            keep = candidate
+    return joiner.join(units[i] for i in keep)
+
+
+def _truncate_to_budget(text: str, max_tokens: int, query: Optional[str]) -> str:
+    query_terms = set(_terms(query or ""))
+
+    sections = _split_sections(text)
+    if len(sections) > 1:
+        blocks = ["\n".join(s).strip() for s in sections]
+        scores = [_section_weight(s) * (1.0 + _relevance(b, query_terms)) for s, b in zip(sections, blocks)]
+        # The block before the first heading holds the contact details.
+        text = _fit_units(blocks, scores, max_tokens, keep_first=True, joiner="\n\n")
+        if count_tokens(text) <= max_tokens:
+            return text
+
+    sentences = [s.strip() for s in _SENTENCE_SPLIT_RE.split(text.replace("\n", " \n ")) if s.strip()]
+    if len(sentences) > 1:
+        total = len(sentences)
+        scores = [_relevance(s, query_terms) + 0.1 * (1 - i / total) for i, s in enumerate(sentences)]
+        text = _fit_units(sentences, scores, max_tokens, keep_first=False, joiner=" ")
+        text = re.sub(r" ?\n ?", "\n", text)
+
+    # Last resort: hard cut on whitespace.
+    while count_tokens(text) > max_tokens and " " in text:
+        text = text[: int(len(text) * 0.9)].rsplit(" ", 1)[0]
+    return text.strip()
+
+
+def compact_text(text: str, max_tokens: Optional[int] = None, query: Optional[str] = None) -> CompactionResult:
+    """Compact a prompt field and enforce an optional token budget.
+
+    `query` (usually the job description) is used to decide which sections
+    or sentences are least relevant when the text has to be truncated.
+    """
+    original_tokens = count_tokens(text or "")
+    compacted = normalize_text(text or "")
+    truncated = False
+    if max_tokens and count_tokens(compacted) > max_tokens:
+        compacted = _truncate_to_budget(compacted, max_tokens, query)
+        truncated = True
+
+    result = CompactionResult(
+        text=compacted,
+        original_tokens=original_tokens,
+        compacted_tokens=count_tokens(compacted),
+        truncated=truncated,
+    )
+    compaction_stats.record(result)
+    return result
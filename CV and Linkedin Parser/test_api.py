@@ -352,6 +352,24 @@ class CVParserAPITester:
         except Exception as e:
             self.log_test("Large File", False, f"Error: {str(e)}")
     
+    def test_model_stays_warm(self, file_path: str):
+        """Test that LLM parses run at the pinned num_ctx, so Ollama never reloads the model for a request"""
+        test_name = f"Model Stays Warm - {Path(file_path).name}"
+        try:
+            before = self.session.get(f"{self.base_url}/metrics").json()["ollama"]
+            with open(file_path, 'rb') as f:
+                files = {'file': (Path(file_path).name, f, 'application/pdf')}
+                response = self.session.post(f"{self.base_url}/parse-cv", files=files, data={'method': 'auto'})
+            after = self.session.get(f"{self.base_url}/metrics").json()["ollama"]
+
+            reloads = after["cold_starts_by_reason"].get("request", 0) - before["cold_starts_by_reason"].get("request", 0)
+            if response.status_code == 200 and reloads == 0:
+                self.log_test(test_name, True, f"No request-path reloads; pinned num_ctx: {after['raised_num_ctx'] or after['num_ctx']}")
+            else:
+                self.log_test(test_name, False, f"Status {response.status_code}, {reloads} request-path reload(s)")
+        except Exception as e:
+            self.log_test(test_name, False, f"Error: {str(e)}")
+
     def run_all_tests(self, test_files: List[str] = None):
         """Run comprehensive test suite"""
         print("🧪 Starting CV Parser API Test Suite")
@@ -470,6 +488,7 @@ class CVParserAPITester:
         print("-" * 30)
         
         if existing_files:
+            self.test_model_stays_warm(existing_files[0])
             self.test_rate_limiting(existing_files[0])
         
         # 7. Test Summary
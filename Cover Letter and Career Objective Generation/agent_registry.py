@@ -0,0 +1,62 @@
+import os
+import threading
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple, Type, TypeVar
+
+T = TypeVar("T")
+
+# Most agents kept; the least recently used is dropped past this. Requests
+# choose the model, so the registry must not grow with every name sent.
+AGENT_REGISTRY_SIZE = int(os.getenv("AGENT_REGISTRY_SIZE", "64"))
+# Comma-separated model names requests may use; empty allows any.
+LLM_ALLOWED_MODELS = {m.strip() for m in os.getenv("LLM_ALLOWED_MODELS", "").split(",") if m.strip()}
+
+# Agents hold their LLM client (and its HTTP connection pool) and the
+# compiled prompt chain; they are stateless across calls, so one instance
+# per configuration is shared by every request.
+_agents: "OrderedDict[Tuple[type, str, str, float, Optional[str]], object]" = OrderedDict()
+_agents_lock = threading.Lock()
+_stats = {"hits": 0, "builds": 0, "evictions": 0}
+
+
+def get_agent(
+    agent_cls: Type[T],
+    llm_name: str,
+    model_name: str,
+    temperature: float = 0.1,
+    base_url: Optional[str] = None,
+) -> T:
+    """Return the process-wide agent for a configuration, building it on first use.
+
+    Construction errors (unknown provider, missing API key, a model not in
+    LLM_ALLOWED_MODELS) propagate as ValueError and nothing is cached, so a
+    fixed environment is picked up on the next call.
+    """
+    if LLM_ALLOWED_MODELS and model_name not in LLM_ALLOWED_MODELS:
+        raise ValueError(f"Model '{model_name}' is not allowed. Allowed models: {', '.join(sorted(LLM_ALLOWED_MODELS))}")
+    key = (agent_cls, llm_name, model_name, temperature, base_url)
+    with _agents_lock:
+        agent = _agents.get(key)
+        if agent is not None:
+            _agents.move_to_end(key)
+            _stats["hits"] += 1
+            return agent
+        agent = agent_cls(llm_name=llm_name, model_name=model_name, temperature=temperature, base_url=base_url)
+        _agents[key] = agent
+        _stats["builds"] += 1
+        while len(_agents) > AGENT_REGISTRY_SIZE:
+            _agents.popitem(last=False)
+            _stats["evictions"] += 1
+        return agent
+
+
+def registry_snapshot() -> Dict:
+    with _agents_lock:
+        return {
+            "agents": sorted(
+                f"{cls.__name__}:{llm}:{model}@{temp}" + (f" ({url})" if url else "")
+                for cls, llm, model, temp, url in _agents
+            ),
+            "max_agents": AGENT_REGISTRY_SIZE,
+            **_stats,
+        }
@@ -0,0 +1,267 @@
+from dataclasses import dataclass
+from typing import Dict, Optional
+
+from langchain_openai import ChatOpenAI
+from dotenv import load_dotenv
+import asyncio
+import json
+import logging
+import os
+import threading
+
+import career_objective_agent
+import cover_letter_agent
+from agent_registry import get_agent
+from career_objective_agent import CareerObjectiveAgent
+from cover_letter_agent import CoverLetterAgent, trim_after_signature
+from llm_clients import CONTEXT_BUCKETS, get_ollama_llm, pick_num_ctx
+from llm_limiter import LLMOverloadedError, get_limiter
+from output_limits import TRAILER_STOP_SEQUENCES, output_stats
+from prompt_compaction import compact_fields, count_tokens
+from prompt_prefix import build_prompt, prefix_key, prefix_stats
+from usage_tracker import UsageCallback
+
+load_dotenv()
+os.environ["OPENAI_API_KEY"] = os.getenv("OPENAI_API_KEY") or os.getenv("openaikey", "")
+
+logger = logging.getLogger(__name__)
+
+# Output token ceiling for the letter and the objective plus their JSON
+# object; also the room reserved for them when sizing num_ctx.
+MAX_OUTPUT_TOKENS = cover_letter_agent.MAX_OUTPUT_TOKENS + career_objective_agent.MAX_OUTPUT_TOKENS + 32
+
+FIELDS = ("cover_letter", "career_objective")
+
+
+def _guidelines(prompt: str) -> str:
+    """A single-output system prompt without its 'return only ...' instruction."""
+    return prompt.split("IMPORTANT:")[0].strip()
+
+
+# The guidelines are the single-output agents' own, so the two stay in step.
+SYSTEM_PROMPT = (
+    "\nYou write both documents of a job application for one candidate and one job: a cover letter and a career objective.\n"
+    + "\n=== COVER LETTER ===\n" + _guidelines(cover_letter_agent.SYSTEM_PROMPT)
+    + "\n\n=== CAREER OBJECTIVE ===\n" + _guidelines(career_objective_agent.SYSTEM_PROMPT)
+    + """
+
+IMPORTANT: Return ONLY a JSON object with exactly two string fields and nothing before or after it:
+{{"cover_letter": "<the full cover letter, paragraphs separated by \\n\\n>", "career_objective": "<the career objective>"}}
+"""
+)
+
+FEW_SHOTS = (
+    "\nCover letter format:"
+    + cover_letter_agent.FEW_SHOTS.split("Cover Letter:", 1)[1]
+    + "\nCareer objective example:\n"
+    + career_objective_agent.FEW_SHOTS.split("Example 2:", 1)[0].split("Career Objective:", 1)[1].strip()
+    + "\n"
+)
+
+PROMPT_PREFIX = SYSTEM_PROMPT + FEW_SHOTS
+
+
+def parse_application(text: str) -> Optional[Dict[str, str]]:
+    """Both documents from the model's answer, or None unless it is a JSON object with both fields."""
+    start, end = text.find("{"), text.rfind("}")
+    if start < 0 or end < start:
+        return None
+    try:
+        # strict=False accepts raw newlines inside the letter string
+        data = json.loads(text[start:end + 1], strict=False)
+    except ValueError:
+        return None
+    if not isinstance(data, dict):
+        return None
+    result = {}
+    for field in FIELDS:
+        value = data.get(field)
+        if not isinstance(value, str) or not value.strip():
+            return None
+        result[field] = value.strip()
+    result["career_objective"] = " ".join(result["career_objective"].split())
+    return result
+
+
+class ApplicationStats:
+    """Thread-safe totals for combined generations."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.fallbacks = 0
+
+    def record(self, ok: bool):
+        with self._lock:
+            self.calls += 1
+            self.fallbacks += int(not ok)
+
+    def snapshot(self) -> Dict[str, int]:
+        with self._lock:
+            return {"calls": self.calls, "fallbacks": self.fallbacks}
+
+
+application_stats = ApplicationStats()
+
+
+@dataclass
+class ApplicationAgent:
+    """Cover letter and career objective for the same candidate and job in one LLM call.
+
+    The CV, job description and company context are sent once instead of
+    once per document. If the answer is not a JSON object with both fields,
+    the two single-output agents are used instead.
+    """
+
+    llm_name: str  # "openai" or "ollama"
+    model_name: str
+    temperature: float = 0.1
+    base_url: Optional[str] = None  # Ollama server; defaults to OLLAMA_BASE_URL
+
+    def __post_init__(self):
+        if self.llm_name == "openai":
+            api_key = os.getenv("OPENAI_API_KEY") or os.getenv("openaikey")
+            if not api_key:
+                raise ValueError("OpenAI API key not found. Set OPENAI_API_KEY environment variable.")
+
+            self.llm = ChatOpenAI(
+                model=self.model_name,
+                temperature=self.temperature,
+                openai_api_key=api_key,
+                max_tokens=MAX_OUTPUT_TOKENS,
+                stream_usage=True,
+                callbacks=[UsageCallback("openai", self.model_name)],
+                model_kwargs={"prompt_cache_key": prefix_key(PROMPT_PREFIX)},
+            )
+        elif self.llm_name == "ollama":
+            self.llm = get_ollama_llm(
+                self.model_name, self.temperature, CONTEXT_BUCKETS[0], self.base_url, MAX_OUTPUT_TOKENS
+            )
+        else:
+            raise ValueError("llm_name must be 'openai' or 'ollama'")
+
+        self.prompt = build_prompt(
+            PROMPT_PREFIX,
+            "Job Title: {job_title}\nCompany Name: {company_name}\nJob Description: {job_desc}\n"
+            "CV Text: {cv_text}\nCandidate Info: {candidate_info}\nCurrent Objective: {current_objective}\n\nJSON:\n",
+        )
+        self.chain = self.prompt | self.llm.bind(stop=TRAILER_STOP_SEQUENCES)
+
+    @property
+    def backend(self) -> str:
+        """Limiter key for the server this agent talks to."""
+        return f"{self.llm_name}@{self.base_url}" if self.base_url else self.llm_name
+
+    def _chain_for(self, inputs: Dict[str, str]):
+        """Pick the chain whose Ollama context window fits this prompt."""
+        if self.llm_name != "ollama":
+            return self.chain
+        prompt_tokens = count_tokens(self.prompt.format(**inputs))
+        num_ctx = pick_num_ctx(prompt_tokens, MAX_OUTPUT_TOKENS)
+        llm = get_ollama_llm(self.model_name, self.temperature, num_ctx, self.base_url, MAX_OUTPUT_TOKENS)
+        return self.prompt | llm.bind(stop=TRAILER_STOP_SEQUENCES)
+
+    def _prepare_inputs(
+        self,
+        cv_text: str,
+        job_title: str,
+        company_name: str,
+        job_desc: str,
+        candidate_info: Dict[str, str],
+        current_objective: Optional[str] = None,
+    ) -> Dict[str, str]:
+        ci_str = "\n".join(f"{k}: {v}" for k, v in candidate_info.items() if v)
+        fields = compact_fields("application", cv_text, job_desc)
+        saved = sum(r.tokens_saved for r in fields.values())
+        logger.info(f"Prompt compaction saved {saved} tokens for application")
+        return {
+            "job_title": job_title,
+            "company_name": company_name,
+            "job_desc": fields["job_desc"].text,
+            "cv_text": fields["cv_text"].text,
+            "candidate_info": ci_str,
+            "current_objective": current_objective or "None",
+        }
+
+    def _single_agents(self):
+        return (
+            get_agent(CoverLetterAgent, self.llm_name, self.model_name, self.temperature, self.base_url),
+            get_agent(CareerObjectiveAgent, self.llm_name, self.model_name, self.temperature, self.base_url),
+        )
+
+    def _parse(self, result) -> Optional[Dict[str, str]]:
+        # A truncated object does not parse, so it falls back to separate generation
+        output_stats.record("application", result, MAX_OUTPUT_TOKENS)
+        text = result.content if hasattr(result, "content") else str(result)
+        application = parse_application(text)
+        if application is None:
+            logger.warning("Combined answer was not a JSON object with both documents, generating separately")
+        else:
+            # Like a single letter, cut after the signature
+            letter = trim_after_signature(application["cover_letter"])
+            if letter.strip() != application["cover_letter"]:
+                output_stats.record_trim("application", MAX_OUTPUT_TOKENS)
+            application["cover_letter"] = letter.strip()
+        application_stats.record(ok=application is not None)
+        return application
+
+    def generate(
+        self,
+        cv_text: str,
+        job_title: str,
+        company_name: str,
+        job_desc: str,
+        candidate_info: Dict[str, str],
+        current_objective: Optional[str] = None,
+    ) -> Dict[str, str]:
+        """Returns `cover_letter` and `career_objective`; a failed document is a "❌ Error ..." string."""
+        try:
+            inputs = self._prepare_inputs(cv_text, job_title, company_name, job_desc, candidate_info, current_objective)
+            with get_limiter(self.backend, self.model_name).slot(kind="application"):
+                result = self._chain_for(inputs).invoke(inputs)
+            prefix_stats.record("application", self.prompt, inputs, result)
+            application = self._parse(result)
+            if application:
+                return application
+        except LLMOverloadedError:
+            raise
+        except Exception as e:
+            logger.warning(f"Combined generation failed, generating separately: {str(e)}")
+            application_stats.record(ok=False)
+
+        letter_agent, objective_agent = self._single_agents()
+        return {
+            "cover_letter": letter_agent.generate(cv_text, job_title, company_name, job_desc, candidate_info),
+            "career_objective": objective_agent.generate(cv_text, job_title, company_name, job_desc, current_objective),
+        }
+
+    async def agenerate(
+        self,
+        cv_text: str,
+        job_title: str,
+        company_name: str,
+        job_desc: str,
+        candidate_info: Dict[str, str],
+        current_objective: Optional[str] = None,
+    ) -> Dict[str, str]:
+        """Async `generate`; cancelling the coroutine cancels the LLM call."""
+        try:
+            inputs = self._prepare_inputs(cv_text, job_title, company_name, job_desc, candidate_info, current_objective)
+            async with get_limiter(self.backend, self.model_name).aslot(kind="application"):
+                result = await self._chain_for(inputs).ainvoke(inputs)
+            prefix_stats.record("application", self.prompt, inputs, result)
+            application = self._parse(result)
+            if application:
+                return application
+        except LLMOverloadedError:
+            raise
+        except Exception as e:
+            logger.warning(f"Combined generation failed, generating separately: {str(e)}")
+            application_stats.record(ok=False)
+
+        letter_agent, objective_agent = self._single_agents()
+        letter, objective = await asyncio.gather(
+            letter_agent.agenerate(cv_text, job_title, company_name, job_desc, candidate_info),
+            objective_agent.agenerate(cv_text, job_title, company_name, job_desc, current_objective),
+        )
+        return {"cover_letter": letter, "career_objective": objective}
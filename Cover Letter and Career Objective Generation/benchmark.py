@@ -0,0 +1,264 @@
+"""Micro-benchmarks for per-request overhead outside the LLM call and for prompt size.
+
+Usage: python benchmark.py [iterations] [--generate] [--prefix-cache]
+
+No LLM server is needed; OpenAI clients are built with a placeholder key
+when none is configured and never send a request. `--generate` also
+compares career objectives written from the selected CV passages with ones
+written from the whole CV, and `--prefix-cache` measures prompt-cache reuse
+and time to first token; both need Ollama running llama3.1.
+"""
+import json
+import os
+import statistics
+import sys
+import time
+
+os.environ.setdefault("OPENAI_API_KEY", "sk-benchmark-placeholder")
+
+from agent_registry import get_agent
+from application_agent import ApplicationAgent
+from career_objective_agent import CareerObjectiveAgent
+from cover_letter_agent import CoverLetterAgent
+import cover_letter_agent
+import prompt_compaction
+from ollama_manager import OLLAMA_BASE_URL, OLLAMA_KEEP_ALIVE
+from prompt_compaction import TOKEN_BUDGETS, compact_text, count_tokens, select_passages
+
+# An extracted PDF resume, much longer than the sample profiles' CVs.
+LONG_CV_FILE = os.path.join("..", "CV and Linkedin Parser", "demoresume_extracted.txt")
+
+BACKENDS = [("ollama", "llama3.1:latest"), ("openai", "gpt-4o-mini")]
+
+
+def timed(fn, iterations: int):
+    samples = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - start) * 1000)
+    samples.sort()
+    return statistics.mean(samples), samples[len(samples) // 2], samples[int(len(samples) * 0.99)]
+
+
+def report(name: str, stats):
+    mean, p50, p99 = stats
+    print(f"{name:<48} mean {mean:8.3f} ms   p50 {p50:8.3f} ms   p99 {p99:8.3f} ms")
+
+
+def bench_agent_construction(iterations: int):
+    print("Agent setup per request")
+    for agent_cls in (CoverLetterAgent, CareerObjectiveAgent):
+        for llm_name, model_name in BACKENDS:
+            label = f"{agent_cls.__name__} {llm_name}"
+            before = timed(lambda: agent_cls(llm_name=llm_name, model_name=model_name), iterations)
+            after = timed(lambda: get_agent(agent_cls, llm_name, model_name), iterations)
+            report(f"{label}: new instance", before)
+            report(f"{label}: registry", after)
+            print(f"{'':<48} {before[0] / after[0]:.0f}x less overhead")
+
+
+def bench_objective_batching(batch_sizes=(1, 3, 5, 10)):
+    """Prompt tokens per career objective, one job per prompt vs K jobs per prompt."""
+    print("Career objective prompt tokens per objective")
+    with open("user_profiles.json") as f:
+        user = json.load(f)[0]
+    with open("jobs.json") as f:
+        jobs = [
+            {"job_title": j.get("title", ""), "company_name": j.get("company_name", ""), "job_desc": j.get("description", "")}
+            for j in json.load(f)[: max(batch_sizes)]
+        ]
+    agent = get_agent(CareerObjectiveAgent, "openai", "gpt-4o-mini")
+    single = [count_tokens(agent.prompt.format(**agent._prepare_inputs(user["cv_text"], **job))) for job in jobs]
+    baseline = statistics.mean(single)
+    print(f"{'1 job per prompt':<48} {baseline:8.0f} tokens/objective")
+    for size in batch_sizes[1:]:
+        inputs = agent._prepare_batch_inputs(user["cv_text"], jobs[:size])
+        per_objective = count_tokens(agent.batch_prompt.format(**inputs)) / size
+        print(f"{f'{size} jobs per prompt':<48} {per_objective:8.0f} tokens/objective   {baseline / per_objective:.1f}x fewer")
+
+
+def bench_combined_application():
+    """Prompt tokens for a cover letter plus objective: two prompts vs one combined prompt."""
+    print("Cover letter + career objective prompt tokens")
+    with open("user_profiles.json") as f:
+        user = json.load(f)[0]
+    with open("jobs.json") as f:
+        job = json.load(f)[0]
+    fields = {"cv_text": user["cv_text"], "job_title": job.get("title", ""),
+              "company_name": job.get("company_name", ""), "job_desc": job.get("description", "")}
+    info = {"Name": user["name"], "Email": user["email"]}
+    letter = get_agent(CoverLetterAgent, "openai", "gpt-4o-mini")
+    objective = get_agent(CareerObjectiveAgent, "openai", "gpt-4o-mini")
+    combined = get_agent(ApplicationAgent, "openai", "gpt-4o-mini")
+    separate = (
+        count_tokens(letter.prompt.format(**letter._prepare_inputs(candidate_info=info, **fields)))
+        + count_tokens(objective.prompt.format(**objective._prepare_inputs(**fields)))
+    )
+    together = count_tokens(combined.prompt.format(**combined._prepare_inputs(candidate_info=info, **fields)))
+    print(f"{'two prompts':<48} {separate:8d} tokens")
+    print(f"{'one combined prompt':<48} {together:8d} tokens   {separate / together:.1f}x fewer")
+
+
+def _benchmark_cvs():
+    with open("user_profiles.json") as f:
+        cvs = [(u["user_id"], u["cv_text"]) for u in json.load(f)]
+    if os.path.exists(LONG_CV_FILE):
+        with open(LONG_CV_FILE) as f:
+            cvs.append(("demoresume", f.read()))
+    return cvs
+
+
+def _job_term_coverage(text: str, job_terms: set) -> float:
+    return len(job_terms & set(prompt_compaction._bm25_terms(text))) / len(job_terms) if job_terms else 1.0
+
+
+def bench_passage_selection(jobs_per_cv: int = 10):
+    """CV tokens and job-term recall: whole compacted CV vs BM25-selected passages."""
+    print("CV context per prompt: whole CV vs selected passages")
+    with open("jobs.json") as f:
+        jobs = [j.get("description", "") for j in json.load(f)[:jobs_per_cv]]
+    for endpoint in ("cover_letter", "career_objective"):
+        budget = TOKEN_BUDGETS[endpoint]
+        for cv_id, cv_text in _benchmark_cvs():
+            full_tokens, selected_tokens, recall = [], [], []
+            for job_desc in jobs:
+                full = compact_text(cv_text, budget["cv_text"], query=job_desc).text
+                selected = select_passages(cv_text, job_desc, budget["cv_passages"]).text
+                # Job terms the CV can speak to, and how many survive selection
+                job_terms = set(prompt_compaction._bm25_terms(job_desc)) & set(prompt_compaction._bm25_terms(full))
+                full_tokens.append(count_tokens(full))
+                selected_tokens.append(count_tokens(selected))
+                recall.append(_job_term_coverage(selected, job_terms))
+            full_mean, selected_mean = statistics.mean(full_tokens), statistics.mean(selected_tokens)
+            print(
+                f"{f'{endpoint} {cv_id}':<48} {full_mean:6.0f} -> {selected_mean:6.0f} tokens"
+                f" ({1 - selected_mean / full_mean:4.0%} smaller)   job-term recall {statistics.mean(recall):4.0%}"
+            )
+
+
+def bench_passage_selection_outputs(pairs: int = 5, model_name: str = "llama3.1:latest"):
+    """Career objectives from whole vs selected CVs: latency and job terms mentioned."""
+    print("Career objectives: whole CV vs selected passages (Ollama)")
+    with open("jobs.json") as f:
+        jobs = json.load(f)[:pairs]
+    cv_text = dict(_benchmark_cvs()).get("demoresume") or _benchmark_cvs()[0][1]
+    agent = get_agent(CareerObjectiveAgent, "ollama", model_name)
+    for selection in (False, True):
+        prompt_compaction.CV_PASSAGE_SELECTION = selection
+        latencies, coverage = [], []
+        for job in jobs:
+            job_desc = job.get("description", "")
+            start = time.perf_counter()
+            objective = agent.generate(cv_text, job.get("title", ""), job.get("company_name", ""), job_desc)
+            latencies.append(time.perf_counter() - start)
+            coverage.append(_job_term_coverage(objective, set(prompt_compaction._bm25_terms(job_desc))))
+        label = "selected passages" if selection else "whole CV"
+        print(f"{label:<48} {statistics.mean(latencies):6.2f} s/objective   job terms in output {statistics.mean(coverage):4.0%}")
+    prompt_compaction.CV_PASSAGE_SELECTION = True
+
+
+def _sample_pairs(limit: int):
+    with open("user_profiles.json") as f:
+        users = json.load(f)
+    with open("jobs.json") as f:
+        jobs = json.load(f)
+    pairs = [(u, j) for j in jobs for u in users]
+    return pairs[:limit]
+
+
+def _cover_letter_fields(agent, user, job):
+    info = {"Name": user.get("name", ""), "Email": user.get("email", "")}
+    return agent._prepare_inputs(user["cv_text"], job.get("title", ""), job.get("company_name", ""),
+                                 job.get("description", ""), info)
+
+
+def bench_prefix_stability(pairs: int = 40):
+    """Whether the system message is byte-identical across calls, and its share of the prompt."""
+    print("Static prompt prefix (system message) across sample user/job pairs")
+    agent = get_agent(CoverLetterAgent, "openai", "gpt-4o-mini")
+    prefixes, shares = set(), []
+    for user, job in _sample_pairs(pairs):
+        system, human = agent.prompt.format_messages(**_cover_letter_fields(agent, user, job))
+        prefixes.add(system.content)
+        prefix_tokens = count_tokens(system.content)
+        shares.append(prefix_tokens / (prefix_tokens + count_tokens(human.content)))
+    print(f"{'distinct system messages':<48} {len(prefixes):8d}")
+    print(f"{'prompt tokens in the static prefix':<48} {statistics.mean(shares):8.0%}")
+
+
+def bench_paragraph_revision(pairs: int = 20):
+    """Output and prompt tokens: regenerating the whole letter vs rewriting one body paragraph."""
+    from main import candidate_info_for
+    from template_drafts import render_cover_letter_draft
+
+    print("Cover letter edit: full regeneration vs one-paragraph revision (template drafts as the letters)")
+    agent = get_agent(CoverLetterAgent, "openai", "gpt-4o-mini")
+    full_out, para_out, full_in, para_in = [], [], [], []
+    for user, job in _sample_pairs(pairs):
+        letter = render_cover_letter_draft(user, job, candidate_info_for(user))
+        paragraphs = cover_letter_agent.split_paragraphs(letter)
+        # The longest paragraph: the usual target, and the least favourable case
+        index = max(range(len(paragraphs)), key=lambda i: count_tokens(paragraphs[i]))
+        inputs = agent._prepare_revision_inputs(letter, index, None, job.get("title", ""), job.get("company_name", ""),
+                                                job.get("description", ""), user["cv_text"])
+        full_out.append(count_tokens(letter))
+        para_out.append(count_tokens(paragraphs[index]))
+        full_in.append(count_tokens(agent.prompt.format(**_cover_letter_fields(agent, user, job))))
+        para_in.append(count_tokens(agent.revision_prompt.format(**inputs)))
+    for name, full, part in (("output tokens", full_out, para_out), ("prompt tokens", full_in, para_in)):
+        print(f"{name:<48} {statistics.mean(full):8.0f} -> {statistics.mean(part):6.0f}   "
+              f"{statistics.mean(full) / statistics.mean(part):.1f}x fewer")
+
+
+def bench_prefix_cache(pairs: int = 10, model_name: str = "llama3.1:latest", num_ctx: int = 4096):
+    """Ollama prompt tokens prefilled and time to first token: one flat prompt vs a pinned system message."""
+    import ollama
+
+    print("Cover letters on Ollama: flat prompt (before) vs system-message prefix (after)")
+    client = ollama.Client(host=OLLAMA_BASE_URL, timeout=300)
+    agent = get_agent(CoverLetterAgent, "ollama", model_name)
+    options = {"num_ctx": num_ctx, "temperature": 0.1, "num_predict": 16}
+    for mode in ("before", "after"):
+        ttft, evaluated, prefill = [], [], []
+        for user, job in _sample_pairs(pairs):
+            system, human = agent.prompt.format_messages(**_cover_letter_fields(agent, user, job))
+            start = time.perf_counter()
+            if mode == "before":
+                stream = client.generate(model=model_name, prompt=cover_letter_agent.PROMPT_PREFIX + "\n\n" + human.content,
+                                         stream=True, options=options, keep_alive=OLLAMA_KEEP_ALIVE)
+            else:
+                messages = [{"role": "system", "content": system.content}, {"role": "user", "content": human.content}]
+                stream = client.chat(model=model_name, messages=messages, stream=True,
+                                     options=options, keep_alive=OLLAMA_KEEP_ALIVE)
+            first = None
+            for chunk in stream:
+                if first is None:
+                    first = time.perf_counter() - start
+                last = chunk
+            ttft.append(first * 1000)
+            evaluated.append(last.prompt_eval_count or 0)
+            prefill.append((last.prompt_eval_duration or 0) / 1e6)
+        # The first call of each mode prefills everything; the rest show reuse
+        warm = slice(1, None) if len(evaluated) > 1 else slice(None)
+        full = evaluated[0]
+        hit_rate = statistics.mean(e < full - count_tokens(system.content) // 2 for e in evaluated[warm])
+        print(
+            f"{mode:<48} TTFT {statistics.mean(ttft[warm]):7.0f} ms   prefill {statistics.mean(prefill[warm]):7.0f} ms"
+            f"   prompt tokens prefilled {statistics.mean(evaluated[warm]):6.0f}/{full}   prefix hits {hit_rate:4.0%}"
+        )
+
+
+if __name__ == "__main__":
+    args = [a for a in sys.argv[1:] if not a.startswith("--")]
+    iterations = int(args[0]) if args else 200
+    bench_agent_construction(iterations)
+    bench_objective_batching()
+    bench_combined_application()
+    bench_passage_selection()
+    bench_prefix_stability()
+    bench_paragraph_revision()
+    if "--generate" in sys.argv:
+        bench_passage_selection_outputs()
+    if "--prefix-cache" in sys.argv:
+        bench_prefix_cache()
@@ -0,0 +1,147 @@
+import argparse
+import asyncio
+import json
+import logging
+import os
+import re
+from typing import Dict, List
+
+from precomputed_store import PrecomputedStore
+from prompt_compaction import count_tokens, normalize_text, split_passages
+
+logger = logging.getLogger(__name__)
+
+# Use the brief instead of the raw cv_text for stored users (quick and bulk endpoints).
+CANDIDATE_BRIEFS = os.getenv("CANDIDATE_BRIEFS", "1") == "1"
+CANDIDATE_BRIEFS_FILE = os.getenv("CANDIDATE_BRIEFS_FILE", "candidate_briefs.db")
+# Bump when the brief format changes so every stored brief is rebuilt.
+BRIEF_VERSION = "1"
+MAX_ACHIEVEMENTS = 8
+
+_DATE_RANGE_RE = re.compile(
+    r"\b(?:(?:jan|feb|mar|apr|may|jun|jul|aug|sep|oct|nov|dec)[a-z]*\.?\s+)?(?:19|20)\d{2}\s*[-–—]\s*"
+    r"(?:(?:(?:jan|feb|mar|apr|may|jun|jul|aug|sep|oct|nov|dec)[a-z]*\.?\s+)?(?:19|20)\d{2}|present|current|now)\b",
+    re.IGNORECASE,
+)
+# Money, percentages, "15+" and counts, but not years
+_QUANTIFIED_RE = re.compile(r"[£$€]\s?\d|\d\s*%|\d\+|\b(?!(?:19|20)\d{2}\b)\d{2,}[\d,]*\b")
+_CERTIFICATION_RE = re.compile(r"certif|licen[cs]e", re.IGNORECASE)
+_AWARD_RE = re.compile(r"\baward|\bprize\b|\bwinner\b", re.IGNORECASE)
+_DEGREE_RE = re.compile(r"\b(?:bachelor|master|ph\.?d|doctor|degree|diploma|mba|b\.?sc|m\.?sc|b\.?a|m\.?a)\b", re.IGNORECASE)
+_CONTACT_RE = re.compile(r"@|www\.|https?://|\||\+?\d[\d ()-]{7,}\d")
+_LABEL_RE = re.compile(r"^(?:certifications?|awards?(?:/activities)?|skills)\s*:\s*", re.IGNORECASE)
+
+
+def _as_list(value) -> List[str]:
+    if not value:
+        return []
+    if isinstance(value, str):
+        return [v.strip() for v in value.split(",") if v.strip()]
+    return [str(v).strip() for v in value if str(v).strip()]
+
+
+def build_brief(user: Dict) -> str:
+    """Rule-based candidate brief: headline, roles, quantified achievements, skills, certifications.
+
+    Uses the profile's structured fields where present and pulls the rest
+    from `cv_text`. Passages that fit none of the sections (interests,
+    generic soft-skill claims) are left out.
+    """
+    passages = [
+        (heading, _LABEL_RE.sub("", passage.lstrip("- ").strip()))
+        for heading, passage in split_passages(normalize_text(user.get("cv_text", "")))
+        if not _CONTACT_RE.search(passage)
+    ]
+    # The first passage, plus the job title when it opens with a bare name
+    headline_parts = []
+    for heading, passage in passages:
+        if heading is not None or (headline_parts and len(headline_parts[-1].split()) >= 5):
+            break
+        headline_parts.append(passage)
+    headline = " - ".join(headline_parts)
+    roles: List[str] = []
+    achievements: List[str] = []
+    education: List[str] = [user["education"]] if user.get("education") else []
+    skills = _as_list(user.get("skills"))
+    certifications = _as_list(user.get("certifications"))
+
+    for heading, text in passages[len(headline_parts):]:
+        section = (heading or "").lower()
+        if "education" in section:
+            # Degrees and dated entries; coursework and thesis titles are left out
+            if not user.get("education") and (_DEGREE_RE.search(text) or _DATE_RANGE_RE.search(text)):
+                education.append(text.rstrip("."))
+        elif _CERTIFICATION_RE.search(text):
+            if not any(text.lower() in c.lower() or c.lower() in text.lower() for c in certifications):
+                certifications.append(text)
+        elif "skill" in section:
+            skills += [s for s in _as_list(text) if s.lower() not in {k.lower() for k in skills}]
+        elif _DATE_RANGE_RE.search(text):
+            roles.append(text)
+        elif (_QUANTIFIED_RE.search(text) or _AWARD_RE.search(text)) and len(achievements) < MAX_ACHIEVEMENTS:
+            achievements.append(text)
+
+    lines = []
+    if headline:
+        lines.append(f"Headline: {headline}")
+    if user.get("current_title") and user["current_title"].lower() not in headline.lower():
+        years = user.get("experience_years")
+        lines.append(f"Current title: {user['current_title']}" + (f" ({years} years)" if years else ""))
+    if education:
+        lines.append(f"Education: {'; '.join(education)}")
+    for label, items in (("Roles", roles), ("Achievements", achievements)):
+        if items:
+            lines.append(f"{label}:")
+            lines += [f"- {item}" for item in items]
+    if skills:
+        lines.append(f"Skills: {', '.join(skills)}")
+    if certifications:
+        lines.append(f"Certifications: {'; '.join(certifications)}")
+    return "\n".join(lines)
+
+
+class BriefStore(PrecomputedStore):
+    """Candidate briefs keyed by user id and profile hash.
+
+    `python candidate_briefs.py` builds them all ahead of time.
+    """
+
+    def __init__(self, path: str = CANDIDATE_BRIEFS_FILE):
+        super().__init__(path, build_brief, "user_id", BRIEF_VERSION)
+
+    def brief_for(self, user: Dict) -> str:
+        return self.get(user)
+
+    def snapshot(self) -> Dict:
+        return {"enabled": CANDIDATE_BRIEFS, **super().snapshot()}
+
+
+brief_store = BriefStore()
+
+
+async def cv_context(user: Dict) -> str:
+    """What the prompts get as the CV for a stored user: the brief, or the raw cv_text.
+
+    A brief in memory is returned at once; reading the SQLite file or
+    building a brief runs in a worker thread, off the event loop.
+    """
+    if not CANDIDATE_BRIEFS:
+        return user.get("cv_text", "")
+    brief = brief_store.cached(user)
+    return brief if brief is not None else await asyncio.to_thread(brief_store.brief_for, user)
+
+
+if __name__ == "__main__":
+    from data_store import USERS_FILE
+
+    parser = argparse.ArgumentParser(description="Build candidate briefs for every user profile")
+    parser.add_argument("--users", default=USERS_FILE)
+    parser.add_argument("--out", default=CANDIDATE_BRIEFS_FILE)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    with open(args.users) as f:
+        users = json.load(f)
+    built = BriefStore(args.out).precompute(users)
+    raw = sum(count_tokens(u.get("cv_text", "")) for u in users)
+    briefs = sum(count_tokens(build_brief(u)) for u in users)
+    print(f"Built {built} briefs for {len(users)} users; {raw} CV tokens -> {briefs} brief tokens")
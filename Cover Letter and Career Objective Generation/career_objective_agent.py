@@ -1,15 +1,35 @@
 from dataclasses import dataclass
-from typing import Dict, Optional
+from typing import AsyncIterator, Dict, List, Optional
 
-from langchain_core.prompts import PromptTemplate
 from langchain_openai import ChatOpenAI
-from langchain_ollama import OllamaLLM 
 from dotenv import load_dotenv
+import asyncio
+import json
+import logging
 import os
+import threading
+
+from llm_clients import CONTEXT_BUCKETS, get_ollama_llm, pick_num_ctx
+from llm_limiter import LLMOverloadedError, get_limiter
+from output_limits import TRAILER_STOP_SEQUENCES, output_stats, token_ceiling
+from prompt_compaction import TOKEN_BUDGETS, compact_cv, compact_fields, compact_text, count_tokens
+from prompt_prefix import build_prompt, prefix_key, prefix_stats
+from usage_tracker import UsageCallback
 
 load_dotenv()
 os.environ["OPENAI_API_KEY"] = os.getenv("OPENAI_API_KEY") or os.getenv("openaikey", "")
 
+logger = logging.getLogger(__name__)
+
+# Output token ceiling for an objective (50-80 words); also the room
+# reserved for it when sizing num_ctx.
+MAX_OUTPUT_TOKENS = token_ceiling(80)
+# Per job in a batched answer: the objective plus its JSON object
+BATCH_ITEM_OUTPUT_TOKENS = MAX_OUTPUT_TOKENS + 16
+# Jobs per batched prompt (see `generate_batch`). Larger batches save more
+# prompt tokens but make a malformed answer, and its fallback, more likely.
+OBJECTIVE_BATCH_SIZE = int(os.getenv("OBJECTIVE_BATCH_SIZE", "5"))
+
 SYSTEM_PROMPT = """
 You are a professional career counselor and expert resume writer specializing in crafting compelling career objectives.
 Write a powerful, targeted career objective that aligns the candidate's experience with the specific job opportunity.
@@ -63,11 +83,70 @@ Career Objective:
 Strategic marketing specialist with 4 years of experience in digital campaign management and Google Analytics certification seeking a Marketing Manager position at Brand Solutions to utilize my proven track record of increasing lead generation by 60% and managing $100K budgets while driving comprehensive marketing strategies that accelerate brand growth and market penetration.
 """
 
+# Identical on every call, so it goes first as the system message and the
+# server's prompt cache can reuse it (see prompt_prefix.py).
+PROMPT_PREFIX = SYSTEM_PROMPT + FEW_SHOTS
+
+BATCH_INSTRUCTIONS = """
+Now write one career objective for EACH of the {count} jobs below, all for the candidate whose CV follows.
+Follow the guidelines above for every objective; each must name its own job title and company.
+Return ONLY a JSON array with exactly {count} objects, one per job and in the same order as the jobs, like:
+[{{"job": 1, "objective": "..."}}, {{"job": 2, "objective": "..."}}]
+"""
+
+
+def parse_objectives(text: str, count: int) -> Optional[List[str]]:
+    """Objectives from a batched answer, or None unless it holds exactly `count` in job order."""
+    start, end = text.find("["), text.rfind("]")
+    if start < 0 or end < start:
+        return None
+    try:
+        items = json.loads(text[start:end + 1])
+    except ValueError:
+        return None
+    if not isinstance(items, list) or len(items) != count:
+        return None
+    objectives = []
+    for position, item in enumerate(items, 1):
+        if isinstance(item, dict):
+            if str(item.get("job")) != str(position):
+                return None
+            item = item.get("objective")
+        if not isinstance(item, str) or not item.strip():
+            return None
+        objectives.append(" ".join(item.split()))
+    return objectives
+
+
+class BatchStats:
+    """Thread-safe totals for batched objective prompts."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.batches = 0
+        self.objectives = 0
+        self.fallbacks = 0
+
+    def record(self, size: int, ok: bool):
+        with self._lock:
+            self.batches += 1
+            self.objectives += size if ok else 0
+            self.fallbacks += int(not ok)
+
+    def snapshot(self) -> Dict[str, int]:
+        with self._lock:
+            return {"batches": self.batches, "objectives": self.objectives, "fallbacks": self.fallbacks}
+
+
+batch_stats = BatchStats()
+
+
 @dataclass
 class CareerObjectiveAgent:
     llm_name: str  # "openai" or "ollama"
     model_name: str
     temperature: float = 0.1
+    base_url: Optional[str] = None  # Ollama server; defaults to OLLAMA_BASE_URL
 
     def __post_init__(self):
         if self.llm_name == "openai":
@@ -78,21 +157,75 @@ class CareerObjectiveAgent:
             self.llm = ChatOpenAI(
                 model=self.model_name, 
                 temperature=self.temperature,
-                openai_api_key=api_key
+                openai_api_key=api_key,
+                max_tokens=MAX_OUTPUT_TOKENS,
+                stream_usage=True,
+                callbacks=[UsageCallback("openai", self.model_name)],
+                model_kwargs={"prompt_cache_key": prefix_key(PROMPT_PREFIX)},
             )
         elif self.llm_name == "ollama":
-            self.llm = OllamaLLM(model=self.model_name, temperature=self.temperature)
+            self.llm = get_ollama_llm(
+                self.model_name, self.temperature, CONTEXT_BUCKETS[0], self.base_url, MAX_OUTPUT_TOKENS
+            )
         else:
             raise ValueError("llm_name must be 'openai' or 'ollama'")
 
-        template = (
-            SYSTEM_PROMPT
-            + FEW_SHOTS
-            + "\n\nJob Title: {job_title}\nCompany Name: {company_name}\nJob Description: {job_desc}\n"
-            + "CV Text: {cv_text}\nCurrent Objective: {current_objective}\n\nCareer Objective:\n"
+        self.prompt = build_prompt(
+            PROMPT_PREFIX,
+            "Job Title: {job_title}\nCompany Name: {company_name}\nJob Description: {job_desc}\n"
+            "CV Text: {cv_text}\nCurrent Objective: {current_objective}\n\nCareer Objective:\n",
         )
-        prompt = PromptTemplate.from_template(template)
-        self.chain = prompt | self.llm
+        self.chain = self.prompt | self.llm.bind(stop=TRAILER_STOP_SEQUENCES)
+        # The system prompt, examples and CV are sent once for a whole batch of
+        # jobs; the system message is the same one, so it shares the prompt cache
+        self.batch_prompt = build_prompt(
+            PROMPT_PREFIX,
+            "{instructions}\nCV Text: {cv_text}\nCurrent Objective: {current_objective}\n\n{jobs}\nJSON:\n",
+        )
+
+    @property
+    def backend(self) -> str:
+        """Limiter key for the server this agent talks to."""
+        return f"{self.llm_name}@{self.base_url}" if self.base_url else self.llm_name
+
+    def _chain_for(self, inputs: Dict[str, str]):
+        """Pick the chain whose Ollama context window fits this prompt."""
+        if self.llm_name != "ollama":
+            return self.chain
+        prompt_tokens = count_tokens(self.prompt.format(**inputs))
+        num_ctx = pick_num_ctx(prompt_tokens, MAX_OUTPUT_TOKENS)
+        llm = get_ollama_llm(self.model_name, self.temperature, num_ctx, self.base_url, MAX_OUTPUT_TOKENS)
+        return self.prompt | llm.bind(stop=TRAILER_STOP_SEQUENCES)
+
+    def _batch_chain_for(self, inputs: Dict[str, str], count: int):
+        # No stop sequences: the answer is a JSON array
+        max_tokens = BATCH_ITEM_OUTPUT_TOKENS * count
+        if self.llm_name != "ollama":
+            return self.batch_prompt | self.llm.bind(max_tokens=max_tokens)
+        prompt_tokens = count_tokens(self.batch_prompt.format(**inputs))
+        num_ctx = pick_num_ctx(prompt_tokens, max_tokens)
+        return self.batch_prompt | get_ollama_llm(self.model_name, self.temperature, num_ctx, self.base_url, max_tokens)
+
+    def _prepare_inputs(
+        self,
+        cv_text: str,
+        job_title: str,
+        company_name: str,
+        job_desc: str,
+        current_objective: Optional[str] = None,
+    ) -> Dict[str, str]:
+        # Format current objective
+        current_obj = current_objective if current_objective else "None"
+        fields = compact_fields("career_objective", cv_text, job_desc)
+        saved = sum(r.tokens_saved for r in fields.values())
+        logger.info(f"Prompt compaction saved {saved} tokens for career objective")
+        return {
+            "job_title": job_title,
+            "company_name": company_name,
+            "job_desc": fields["job_desc"].text,
+            "cv_text": fields["cv_text"].text,
+            "current_objective": current_obj,
+        }
 
     def generate(
         self,
@@ -103,25 +236,181 @@ class CareerObjectiveAgent:
         current_objective: Optional[str] = None,
     ) -> str:
         try:
-            # Format current objective
-            current_obj = current_objective if current_objective else "None"
-            
-            result = self.chain.invoke(
-                {
-                    "job_title": job_title,
-                    "company_name": company_name,
-                    "job_desc": job_desc,
-                    "cv_text": cv_text,
-                    "current_objective": current_obj,
-                }
-            )
-            
-            # Handle different return types from different LLMs
-            if hasattr(result, 'content'):
-                return result.content.strip()
-            elif isinstance(result, str):
-                return result.strip()
-            else:
-                return str(result).strip()
+            inputs = self._prepare_inputs(cv_text, job_title, company_name, job_desc, current_objective)
+            with get_limiter(self.backend, self.model_name).slot(kind="career_objective"):
+                result = self._chain_for(inputs).invoke(inputs)
+            prefix_stats.record("career_objective", self.prompt, inputs, result)
+            return self._objective_text(result)
+        except LLMOverloadedError:
+            raise
+        except Exception as e:
+            return self.error_text(e)
+
+    async def agenerate(
+        self,
+        cv_text: str,
+        job_title: str,
+        company_name: str,
+        job_desc: str,
+        current_objective: Optional[str] = None,
+    ) -> str:
+        """Async `generate`; cancelling the coroutine cancels the LLM call."""
+        try:
+            inputs = self._prepare_inputs(cv_text, job_title, company_name, job_desc, current_objective)
+            async with get_limiter(self.backend, self.model_name).aslot(kind="career_objective"):
+                result = await self._chain_for(inputs).ainvoke(inputs)
+            prefix_stats.record("career_objective", self.prompt, inputs, result)
+            return self._objective_text(result)
+        except LLMOverloadedError:
+            raise
         except Exception as e:
-            return f"❌ Error generating career objective: {str(e)}"
\ No newline at end of file
+            return self.error_text(e)
+
+    def _prepare_batch_inputs(
+        self,
+        cv_text: str,
+        jobs: List[Dict[str, str]],
+        current_objective: Optional[str] = None,
+    ) -> Dict[str, str]:
+        budget = TOKEN_BUDGETS["career_objective"]
+        descriptions = [compact_text(job["job_desc"], budget["job_desc"]).text for job in jobs]
+        cv = compact_cv("career_objective", cv_text, "\n".join(descriptions))
+        blocks = [
+            f"Job {i}:\nJob Title: {job['job_title']}\nCompany Name: {job['company_name']}\nJob Description: {desc}\n"
+            for i, (job, desc) in enumerate(zip(jobs, descriptions), 1)
+        ]
+        return {
+            "instructions": BATCH_INSTRUCTIONS.format(count=len(jobs)),
+            "cv_text": cv.text,
+            "current_objective": current_objective or "None",
+            "jobs": "\n".join(blocks),
+        }
+
+    def _chunks(self, jobs: List[Dict[str, str]]) -> List[List[Dict[str, str]]]:
+        size = max(1, OBJECTIVE_BATCH_SIZE)
+        return [jobs[i:i + size] for i in range(0, len(jobs), size)]
+
+    def generate_batch(
+        self,
+        cv_text: str,
+        jobs: List[Dict[str, str]],
+        current_objective: Optional[str] = None,
+    ) -> List[str]:
+        """Career objectives for one candidate and several jobs, in job order.
+
+        Each job is a dict with `job_title`, `company_name` and `job_desc`.
+        Up to OBJECTIVE_BATCH_SIZE jobs share one prompt, which asks for a
+        JSON array. A batch whose answer is not an array of the right length
+        and order falls back to one `generate` call per job.
+        """
+        objectives: List[str] = []
+        for chunk in self._chunks(jobs):
+            parsed = None
+            if len(chunk) > 1:
+                try:
+                    inputs = self._prepare_batch_inputs(cv_text, chunk, current_objective)
+                    with get_limiter(self.backend, self.model_name).slot(kind=f"career_objective_batch:{len(chunk)}"):
+                        result = self._batch_chain_for(inputs, len(chunk)).invoke(inputs)
+                    prefix_stats.record("career_objective_batch", self.batch_prompt, inputs, result)
+                    parsed = self._parse_batch(result, len(chunk))
+                except LLMOverloadedError:
+                    raise
+                except Exception as e:
+                    logger.warning(f"Batched career objectives failed, generating individually: {str(e)}")
+                    batch_stats.record(len(chunk), ok=False)
+            objectives += parsed or [self.generate(cv_text, current_objective=current_objective, **job) for job in chunk]
+        return objectives
+
+    async def agenerate_batch(
+        self,
+        cv_text: str,
+        jobs: List[Dict[str, str]],
+        current_objective: Optional[str] = None,
+    ) -> List[str]:
+        """Async `generate_batch`; the batches run concurrently."""
+        async def run(chunk: List[Dict[str, str]]) -> List[str]:
+            if len(chunk) > 1:
+                try:
+                    inputs = self._prepare_batch_inputs(cv_text, chunk, current_objective)
+                    async with get_limiter(self.backend, self.model_name).aslot(kind=f"career_objective_batch:{len(chunk)}"):
+                        result = await self._batch_chain_for(inputs, len(chunk)).ainvoke(inputs)
+                    prefix_stats.record("career_objective_batch", self.batch_prompt, inputs, result)
+                    parsed = self._parse_batch(result, len(chunk))
+                    if parsed:
+                        return parsed
+                except LLMOverloadedError:
+                    raise
+                except Exception as e:
+                    logger.warning(f"Batched career objectives failed, generating individually: {str(e)}")
+                    batch_stats.record(len(chunk), ok=False)
+            return list(await asyncio.gather(
+                *(self.agenerate(cv_text, current_objective=current_objective, **job) for job in chunk)
+            ))
+
+        results = await asyncio.gather(*(run(chunk) for chunk in self._chunks(jobs)))
+        return [objective for chunk in results for objective in chunk]
+
+    def _parse_batch(self, result, count: int) -> Optional[List[str]]:
+        # A truncated array does not parse, so it falls back like any malformed answer
+        output_stats.record("career_objective_batch", result, BATCH_ITEM_OUTPUT_TOKENS * count)
+        objectives = parse_objectives(self._to_text(result), count)
+        if objectives is None:
+            logger.warning(f"Batched answer was not a JSON array of {count} objectives, generating individually")
+        batch_stats.record(count, ok=objectives is not None)
+        return objectives
+
+    def finalize(self, result) -> str:
+        """The career objective from a finished generation (a result or the sum of its streamed chunks), as `agenerate` returns it."""
+        return self._objective_text(result)
+
+    @staticmethod
+    def error_text(error: Exception) -> str:
+        return f"❌ Error generating career objective: {str(error)}"
+
+    def _objective_text(self, result) -> str:
+        """The objective; one cut off at the token ceiling ends at its last full sentence."""
+        text = self._to_text(result)
+        if output_stats.record("career_objective", result, MAX_OUTPUT_TOKENS):
+            end = max(text.rfind(mark) for mark in ".!?")
+            if end > 0:
+                text = text[:end + 1]
+        return text
+
+    @staticmethod
+    def _to_text(result) -> str:
+        # Handle different return types from different LLMs
+        if hasattr(result, 'content'):
+            return result.content.strip()
+        elif isinstance(result, str):
+            return result.strip()
+        else:
+            return str(result).strip()
+
+    async def astream_chunks(
+        self,
+        cv_text: str,
+        job_title: str,
+        company_name: str,
+        job_desc: str,
+        current_objective: Optional[str] = None,
+    ) -> AsyncIterator:
+        """Stream the raw LLM chunks; `finalize` turns their sum into the career objective. Errors propagate to the caller."""
+        inputs = self._prepare_inputs(cv_text, job_title, company_name, job_desc, current_objective)
+        async with get_limiter(self.backend, self.model_name).aslot(kind="career_objective"):
+            async for chunk in self._chain_for(inputs).astream(inputs):
+                if getattr(chunk, "usage_metadata", None):
+                    prefix_stats.record("career_objective", self.prompt, inputs, chunk)
+                yield chunk
+
+    async def astream(
+        self,
+        cv_text: str,
+        job_title: str,
+        company_name: str,
+        job_desc: str,
+        current_objective: Optional[str] = None,
+    ) -> AsyncIterator[str]:
+        """Stream the career objective as text chunks. Errors propagate to the caller."""
+        async for chunk in self.astream_chunks(cv_text, job_title, company_name, job_desc, current_objective):
+            output_stats.record("career_objective", chunk, MAX_OUTPUT_TOKENS)
+            yield chunk.content if hasattr(chunk, "content") else str(chunk)
@@ -1,15 +1,32 @@
 from dataclasses import dataclass
-from typing import Dict
+from typing import AsyncIterator, Dict, List, Optional
 
-from langchain_core.prompts import PromptTemplate
 from langchain_openai import ChatOpenAI
-from langchain_ollama import OllamaLLM 
 from dotenv import load_dotenv
+import logging
 import os
+import re
+
+from llm_clients import CONTEXT_BUCKETS, get_ollama_llm, pick_num_ctx
+from output_limits import TRAILER_STOP_SEQUENCES, finish_reason, output_stats, token_ceiling
+from llm_limiter import LLMOverloadedError, get_limiter
+from prompt_compaction import compact_fields, count_tokens
+from prompt_prefix import build_prompt, prefix_key, prefix_stats
+from usage_tracker import UsageCallback
+from streaming import PreambleStripper
 
 load_dotenv()
 os.environ["OPENAI_API_KEY"] = os.getenv("OPENAI_API_KEY") or os.getenv("openaikey", "")
 
+logger = logging.getLogger(__name__)
+
+# Output token ceiling for a letter of one page (about 400 words); also the
+# room reserved for it when sizing num_ctx.
+MAX_OUTPUT_TOKENS = token_ceiling(400)
+# The same for one rewritten paragraph (see `revise_paragraph`).
+REVISION_MAX_OUTPUT_TOKENS = token_ceiling(120)
+REVISION_STOP_SEQUENCES = ["\n\nNote:", "\nParagraph after:", "\n---"]
+
 SYSTEM_PROMPT = """
 You are a professional career storyteller and expert cover letter writer.
 Write a compelling, tailored cover letter connecting the candidate's experience to the job.
@@ -55,11 +72,98 @@ Sincerely,
 [Candidate Name]
 """
 
+# Identical on every call, so it goes first as the system message and the
+# server's prompt cache can reuse it (see prompt_prefix.py).
+PROMPT_PREFIX = SYSTEM_PROMPT + FEW_SHOTS
+
+REVISION_PROMPT = """
+You are an expert cover letter editor. Rewrite ONE paragraph of an existing cover letter.
+The paragraphs before and after it are given so the rewrite fits between them: keep their tone and tense, and do not repeat what they already say.
+Use only facts from the paragraph, the CV and the job description; never invent employers, numbers or qualifications.
+Follow the guidance if any is given. Otherwise make the paragraph more specific to the job and more engaging, at about the same length.
+
+IMPORTANT: Return ONLY the rewritten paragraph as plain text. No heading, quotes, or explanation before or after it.
+"""
+
+_PARAGRAPH_BREAK_RE = re.compile(r"\n[ \t]*\n")
+# A complimentary close and the name under it; the letter ends there
+_SIGNATURE_RE = re.compile(
+    r"^[ \t]*(?:(?:yours )?sincerely|yours (?:faithfully|truly)|(?:best|kind|warm(?:est)?) regards|regards|respectfully)"
+    r",?[ \t]*\n[ \t]*\S[^\n]*",
+    re.IGNORECASE | re.MULTILINE,
+)
+
+
+def split_paragraphs(letter: str) -> List[str]:
+    """A letter's blank-line separated paragraphs; the contact block and the salutation count as paragraphs."""
+    return [p.strip() for p in _PARAGRAPH_BREAK_RE.split(letter.strip()) if p.strip()]
+
+
+def trim_after_signature(letter: str) -> str:
+    """The letter up to its first signature block, without repeated signatures or notes after it."""
+    match = _SIGNATURE_RE.search(letter)
+    return letter[:match.end()] if match else letter
+
+
+class LetterStreamCutter:
+    """Cuts a streamed letter where `trim_after_signature` and the stop sequences would.
+
+    `feed` returns the text that is safe to send: a tail that could be the
+    start of a stop sequence is held back until the next chunk. Once a stop
+    sequence or a complete signature line arrives, `done` is set and the
+    rest of the generation is not needed.
+    """
+
+    def __init__(self, stops: List[str] = TRAILER_STOP_SEQUENCES):
+        self.stops = stops
+        self.text = ""
+        self.sent = 0
+        self.done = False
+
+    def _end(self, final: bool) -> int:
+        end = min([i for i in (self.text.find(stop) for stop in self.stops) if i >= 0] or [len(self.text)])
+        self.done = end < len(self.text)
+        match = _SIGNATURE_RE.search(self.text[:end])
+        # The name line is complete once text follows it
+        if match and (final or match.end() < end):
+            self.done = True
+            return match.end()
+        if not self.done and not final:
+            for k in range(min(max(map(len, self.stops)) - 1, end), 0, -1):
+                if any(stop.startswith(self.text[end - k:end]) for stop in self.stops):
+                    return end - k
+        return end
+
+    def feed(self, chunk: str) -> str:
+        if self.done:
+            return ""
+        self.text += chunk
+        end = self._end(final=False)
+        visible, self.sent = self.text[self.sent:end], max(self.sent, end)
+        return visible
+
+    def flush(self) -> str:
+        end = self._end(final=True)
+        visible, self.sent = self.text[self.sent:end], max(self.sent, end)
+        return visible
+
+    @property
+    def trimmed(self) -> bool:
+        """Whether text past the end of the letter was held back."""
+        return bool(self.text[self.sent:].strip())
+
+
+def replace_paragraph(letter: str, index: int, paragraph: str) -> str:
+    paragraphs = split_paragraphs(letter)
+    paragraphs[index] = paragraph
+    return "\n\n".join(paragraphs)
+
 @dataclass
 class CoverLetterAgent:
     llm_name: str  # "openai" or "ollama"
     model_name: str
     temperature: float = 0.1
+    base_url: Optional[str] = None  # Ollama server; defaults to OLLAMA_BASE_URL
 
     def __post_init__(self):
         if self.llm_name == "openai":
@@ -71,21 +175,70 @@ class CoverLetterAgent:
             self.llm = ChatOpenAI(
                 model=self.model_name, 
                 temperature=self.temperature,
-                openai_api_key=api_key
+                openai_api_key=api_key,
+                max_tokens=MAX_OUTPUT_TOKENS,
+                stream_usage=True,
+                callbacks=[UsageCallback("openai", self.model_name)],
+                model_kwargs={"prompt_cache_key": prefix_key(PROMPT_PREFIX)},
             )
         elif self.llm_name == "ollama":
-            self.llm = OllamaLLM(model=self.model_name, temperature=self.temperature)
+            self.llm = get_ollama_llm(
+                self.model_name, self.temperature, CONTEXT_BUCKETS[0], self.base_url, MAX_OUTPUT_TOKENS
+            )
         else:
             raise ValueError("llm_name must be 'openai' or 'ollama'")
 
-        template = (
-            SYSTEM_PROMPT
-            + FEW_SHOTS
-            + "\n\nJob Title: {job_title}\nCompany Name: {company_name}\nJob Description: {job_desc}\n"
-            + "CV Text: {cv_text}\nCandidate Info: {candidate_info}\n\nCover Letter:\n"
+        self.prompt = build_prompt(
+            PROMPT_PREFIX,
+            "Job Title: {job_title}\nCompany Name: {company_name}\nJob Description: {job_desc}\n"
+            "CV Text: {cv_text}\nCandidate Info: {candidate_info}\n\nCover Letter:\n",
+        )
+        self.chain = self.prompt | self.llm.bind(stop=TRAILER_STOP_SEQUENCES)
+        self.revision_prompt = build_prompt(
+            REVISION_PROMPT,
+            "Job Title: {job_title}\nCompany Name: {company_name}\nJob Description: {job_desc}\nCV Text: {cv_text}\n\n"
+            "Paragraph before:\n{previous}\n\nParagraph to rewrite:\n{paragraph}\n\nParagraph after:\n{next}\n\n"
+            "Guidance: {guidance}\n\nRewritten paragraph:\n",
         )
-        prompt = PromptTemplate.from_template(template)
-        self.chain = prompt | self.llm
+        # Ollama revisions get their own client with the smaller ceiling in `_revision_chain_for`
+        revision_options = {"stop": REVISION_STOP_SEQUENCES}
+        if self.llm_name == "openai":
+            revision_options.update(prompt_cache_key=prefix_key(REVISION_PROMPT), max_tokens=REVISION_MAX_OUTPUT_TOKENS)
+        self.revision_chain = self.revision_prompt | self.llm.bind(**revision_options)
+
+    @property
+    def backend(self) -> str:
+        """Limiter key for the server this agent talks to."""
+        return f"{self.llm_name}@{self.base_url}" if self.base_url else self.llm_name
+
+    def _chain_for(self, inputs: Dict[str, str]):
+        """Pick the chain whose Ollama context window fits this prompt."""
+        if self.llm_name != "ollama":
+            return self.chain
+        prompt_tokens = count_tokens(self.prompt.format(**inputs))
+        num_ctx = pick_num_ctx(prompt_tokens, MAX_OUTPUT_TOKENS)
+        llm = get_ollama_llm(self.model_name, self.temperature, num_ctx, self.base_url, MAX_OUTPUT_TOKENS)
+        return self.prompt | llm.bind(stop=TRAILER_STOP_SEQUENCES)
+
+    def _prepare_inputs(
+        self,
+        cv_text: str,
+        job_title: str,
+        company_name: str,
+        job_desc: str,
+        candidate_info: Dict[str, str],
+    ) -> Dict[str, str]:
+        ci_str = "\n".join(f"{k}: {v}" for k, v in candidate_info.items() if v)
+        fields = compact_fields("cover_letter", cv_text, job_desc)
+        saved = sum(r.tokens_saved for r in fields.values())
+        logger.info(f"Prompt compaction saved {saved} tokens for cover letter")
+        return {
+            "job_title": job_title,
+            "company_name": company_name,
+            "job_desc": fields["job_desc"].text,
+            "cv_text": fields["cv_text"].text,
+            "candidate_info": ci_str,
+        }
 
     def generate(
         self,
@@ -96,23 +249,201 @@ class CoverLetterAgent:
         candidate_info: Dict[str, str],
     ) -> str:
         try:
-          
-            ci_str = "\n".join(f"{k}: {v}" for k, v in candidate_info.items() if v)
-            result = self.chain.invoke(
-                {
-                    "job_title": job_title,
-                    "company_name": company_name,
-                    "job_desc": job_desc,
-                    "cv_text": cv_text,
-                    "candidate_info": ci_str,
-                }
-            )
-            # Handle different return types from different LLMs
-            if hasattr(result, 'content'):
-                return result.content
-            elif isinstance(result, str):
-                return result
-            else:
-                return str(result)
+            inputs = self._prepare_inputs(cv_text, job_title, company_name, job_desc, candidate_info)
+            with get_limiter(self.backend, self.model_name).slot(kind="cover_letter"):
+                result = self._chain_for(inputs).invoke(inputs)
+            prefix_stats.record("cover_letter", self.prompt, inputs, result)
+            return self._letter_text(result)
+        except LLMOverloadedError:
+            raise
+        except Exception as e:
+            return self.error_text(e)
+
+    async def agenerate(
+        self,
+        cv_text: str,
+        job_title: str,
+        company_name: str,
+        job_desc: str,
+        candidate_info: Dict[str, str],
+    ) -> str:
+        """Async `generate`; cancelling the coroutine cancels the LLM call."""
+        try:
+            inputs = self._prepare_inputs(cv_text, job_title, company_name, job_desc, candidate_info)
+            async with get_limiter(self.backend, self.model_name).aslot(kind="cover_letter"):
+                result = await self._chain_for(inputs).ainvoke(inputs)
+            prefix_stats.record("cover_letter", self.prompt, inputs, result)
+            return self._letter_text(result)
+        except LLMOverloadedError:
+            raise
+        except Exception as e:
+            return self.error_text(e)
+
+    def finalize(self, result) -> str:
+        """The cover letter from a finished generation (a result or the sum of its streamed chunks), as `agenerate` returns it."""
+        return self._letter_text(result)
+
+    @staticmethod
+    def error_text(error: Exception) -> str:
+        return f"❌ Error generating cover letter: {str(error)}"
+
+    def _letter_text(self, result) -> str:
+        """The finished letter, cut after its signature; counts truncated and trimmed generations."""
+        output_stats.record("cover_letter", result, MAX_OUTPUT_TOKENS)
+        text = self._to_text(result)
+        letter = trim_after_signature(text)
+        if letter.strip() != text.strip():
+            output_stats.record_trim("cover_letter", MAX_OUTPUT_TOKENS)
+        return letter
+
+    @staticmethod
+    def _to_text(result) -> str:
+        # Handle different return types from different LLMs
+        if hasattr(result, 'content'):
+            return result.content
+        elif isinstance(result, str):
+            return result
+        else:
+            return str(result)
+
+    async def astream_chunks(
+        self,
+        cv_text: str,
+        job_title: str,
+        company_name: str,
+        job_desc: str,
+        candidate_info: Dict[str, str],
+    ) -> AsyncIterator:
+        """Stream the raw LLM chunks; `finalize` turns their sum into the cover letter. Errors propagate to the caller."""
+        inputs = self._prepare_inputs(cv_text, job_title, company_name, job_desc, candidate_info)
+        async with get_limiter(self.backend, self.model_name).aslot(kind="cover_letter"):
+            async for chunk in self._chain_for(inputs).astream(inputs):
+                if getattr(chunk, "usage_metadata", None):
+                    prefix_stats.record("cover_letter", self.prompt, inputs, chunk)
+                yield chunk
+
+    async def astream(
+        self,
+        cv_text: str,
+        job_title: str,
+        company_name: str,
+        job_desc: str,
+        candidate_info: Dict[str, str],
+    ) -> AsyncIterator[str]:
+        """Stream the cover letter as text chunks, ending where `agenerate` would cut it. Errors propagate to the caller.
+
+        The LLM call is closed as soon as the signature or a trailer stop
+        sequence arrives, so the client gets no text past the letter.
+        """
+        cutter = LetterStreamCutter()
+        finished = False
+        chunks = self.astream_chunks(cv_text, job_title, company_name, job_desc, candidate_info)
+        try:
+            async for chunk in chunks:
+                output_stats.record("cover_letter", chunk, MAX_OUTPUT_TOKENS)
+                finished = finished or bool(finish_reason(chunk))
+                text = cutter.feed(self._to_text(chunk))
+                if text:
+                    yield text
+                if cutter.done:
+                    break
+        finally:
+            await chunks.aclose()
+        tail = cutter.flush()
+        if tail:
+            yield tail
+        if cutter.done and not finished:
+            # Closed at the letter's end, before the backend sent its finish reason
+            output_stats.record("cover_letter", None, MAX_OUTPUT_TOKENS, reason="stop")
+        if cutter.trimmed:
+            output_stats.record_trim("cover_letter", MAX_OUTPUT_TOKENS)
+
+    def _revision_chain_for(self, inputs: Dict[str, str]):
+        if self.llm_name != "ollama":
+            return self.revision_chain
+        prompt_tokens = count_tokens(self.revision_prompt.format(**inputs))
+        num_ctx = pick_num_ctx(prompt_tokens, REVISION_MAX_OUTPUT_TOKENS)
+        llm = get_ollama_llm(self.model_name, self.temperature, num_ctx, self.base_url, REVISION_MAX_OUTPUT_TOKENS)
+        return self.revision_prompt | llm.bind(stop=REVISION_STOP_SEQUENCES)
+
+    def _prepare_revision_inputs(
+        self,
+        letter: str,
+        index: int,
+        guidance: Optional[str],
+        job_title: str,
+        company_name: str,
+        job_desc: str,
+        cv_text: str,
+    ) -> Dict[str, str]:
+        paragraphs = split_paragraphs(letter)
+        if not 0 <= index < len(paragraphs):
+            raise ValueError(f"paragraph_index must be between 0 and {len(paragraphs) - 1}")
+        fields = compact_fields("cover_letter_revision", cv_text, job_desc)
+        return {
+            "job_title": job_title,
+            "company_name": company_name,
+            "job_desc": fields["job_desc"].text or "Not provided",
+            "cv_text": fields["cv_text"].text or "Not provided",
+            "previous": paragraphs[index - 1] if index > 0 else "(start of letter)",
+            "paragraph": paragraphs[index],
+            "next": paragraphs[index + 1] if index + 1 < len(paragraphs) else "(end of letter)",
+            "guidance": guidance or "None",
+        }
+
+    @staticmethod
+    def _to_paragraph(result) -> str:
+        """The model's paragraph without preamble, quotes or blank lines, so the letter keeps its paragraph count."""
+        stripper = PreambleStripper()
+        text = (stripper.feed(CoverLetterAgent._to_text(result)) + stripper.flush()).strip().strip('"').strip()
+        return " ".join(line.strip() for line in text.splitlines() if line.strip())
+
+    def revise_paragraph(
+        self,
+        letter: str,
+        index: int,
+        guidance: Optional[str] = None,
+        job_title: str = "",
+        company_name: str = "",
+        job_desc: str = "",
+        cv_text: str = "",
+    ) -> str:
+        """Rewrite paragraph `index` of `letter`, with its neighbours as context; returns the new paragraph.
+
+        Only the paragraph is generated, a fraction of the output tokens of
+        a whole letter. Raises ValueError for an index outside the letter.
+        """
+        inputs = self._prepare_revision_inputs(letter, index, guidance, job_title, company_name, job_desc, cv_text)
+        try:
+            with get_limiter(self.backend, self.model_name).slot(kind="cover_letter_revision"):
+                result = self._revision_chain_for(inputs).invoke(inputs)
+            prefix_stats.record("cover_letter_revision", self.revision_prompt, inputs, result)
+            output_stats.record("cover_letter_revision", result, REVISION_MAX_OUTPUT_TOKENS)
+            return self._to_paragraph(result)
+        except LLMOverloadedError:
+            raise
+        except Exception as e:
+            return f"❌ Error revising paragraph: {str(e)}"
+
+    async def arevise_paragraph(
+        self,
+        letter: str,
+        index: int,
+        guidance: Optional[str] = None,
+        job_title: str = "",
+        company_name: str = "",
+        job_desc: str = "",
+        cv_text: str = "",
+    ) -> str:
+        """Async `revise_paragraph`; cancelling the coroutine cancels the LLM call."""
+        inputs = self._prepare_revision_inputs(letter, index, guidance, job_title, company_name, job_desc, cv_text)
+        try:
+            async with get_limiter(self.backend, self.model_name).aslot(kind="cover_letter_revision"):
+                result = await self._revision_chain_for(inputs).ainvoke(inputs)
+            prefix_stats.record("cover_letter_revision", self.revision_prompt, inputs, result)
+            output_stats.record("cover_letter_revision", result, REVISION_MAX_OUTPUT_TOKENS)
+            return self._to_paragraph(result)
+        except LLMOverloadedError:
+            raise
         except Exception as e:
-            return f"❌ Error generating cover letter: {str(e)}"
\ No newline at end of file
+            return f"❌ Error revising paragraph: {str(e)}"
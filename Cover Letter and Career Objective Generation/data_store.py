@@ -0,0 +1,323 @@
+import asyncio
+import base64
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+from dataclasses import dataclass, field, replace
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from result_cache import record_hash
+
+logger = logging.getLogger(__name__)
+
+USERS_FILE = os.getenv("USER_PROFILES_FILE", "user_profiles.json")
+JOBS_FILE = os.getenv("JOBS_FILE", "jobs.json")
+# How often the data files are checked for changes (0 disables reloading).
+DATA_RELOAD_SECONDS = float(os.getenv("DATA_RELOAD_SECONDS", "2"))
+# "json" keeps both files in memory; "sqlite" serves them from an FTS5 database (see sqlite_store.py).
+DATA_BACKEND = os.getenv("DATA_BACKEND", "json")
+SQLITE_PATH = os.getenv("SQLITE_PATH", "data.db")
+
+_QUERY_TERM_RE = re.compile(r"\w+")
+
+
+def encode_cursor(kind: str, position: int) -> str:
+    """Opaque pagination cursor: `k` resumes after a key, `o` at an offset."""
+    return base64.urlsafe_b64encode(f"{kind}:{position}".encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: Optional[str]) -> Tuple[str, int]:
+    if not cursor:
+        return "k", -1
+    try:
+        kind, position = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode().split(":")
+        if kind not in ("k", "o"):
+            raise ValueError
+        return kind, int(position)
+    except ValueError:
+        raise ValueError("Invalid cursor")
+
+
+def parse_salary(value) -> Optional[float]:
+    try:
+        return float(str(value).replace(",", "").replace("£", "").replace("$", "").strip())
+    except (TypeError, ValueError):
+        return None
+
+
+def query_terms(q: Optional[str]) -> List[str]:
+    return _QUERY_TERM_RE.findall((q or "").lower())
+
+
+@dataclass(frozen=True)
+class JobFilters:
+    q: Optional[str] = None  # full-text over title and description
+    category: Optional[str] = None
+    contract_type: Optional[str] = None
+    location: Optional[str] = None  # substring match
+    salary_min: Optional[float] = None  # jobs paying at least this at the top of their range
+    salary_max: Optional[float] = None  # jobs starting at or below this
+
+    def matches(self, job: Dict) -> bool:
+        if self.category and str(job.get("category", "")).lower() != self.category.lower():
+            return False
+        if self.contract_type and str(job.get("contract_type", "")).lower() != self.contract_type.lower():
+            return False
+        if self.location and self.location.lower() not in str(job.get("location", "")).lower():
+            return False
+        if self.salary_min is not None:
+            top = parse_salary(job.get("salary_max")) or parse_salary(job.get("salary_min"))
+            if top is None or top < self.salary_min:
+                return False
+        if self.salary_max is not None:
+            bottom = parse_salary(job.get("salary_min")) or parse_salary(job.get("salary_max"))
+            if bottom is None or bottom > self.salary_max:
+                return False
+        if self.q:
+            text = f"{job.get('title', '')} {job.get('description', '')}".lower()
+            return all(term in text for term in query_terms(self.q))
+        return True
+
+
+def _page(records: Iterable[Tuple[int, Dict]], cursor: Optional[str], limit: Optional[int]) -> Tuple[List[Dict], Optional[str]]:
+    """Page through an in-memory list; the cursor is the position of the last record returned."""
+    _, after = decode_cursor(cursor)
+    last = after
+    page: List[Dict] = []
+    for position, record in records:
+        if position <= after:
+            continue
+        if limit is not None and len(page) == limit:
+            return page, encode_cursor("k", last)
+        page.append(record)
+        last = position
+    return page, None
+
+
+@dataclass(frozen=True)
+class Dataset:
+    """One consistent, read-only view of the user and job data.
+
+    Requests take a reference once and use it throughout, so a reload that
+    swaps in a new Dataset never shows them a mix of old and new records.
+    """
+
+    blocking = False  # queries never wait on I/O, see run_query
+
+    users: List[Dict] = field(default_factory=list)
+    jobs: List[Dict] = field(default_factory=list)
+    users_by_id: Dict[str, Dict] = field(default_factory=dict)
+    jobs_by_id: Dict[str, Dict] = field(default_factory=dict)
+    version: str = "empty"
+    job_digests: Dict[str, Tuple[str, str]] = field(default_factory=dict)  # job id -> (record hash, digest)
+
+    def user(self, user_id: str) -> Optional[Dict]:
+        return self.users_by_id.get(user_id)
+
+    def job(self, job_id: str) -> Optional[Dict]:
+        return self.jobs_by_id.get(job_id)
+
+    def job_digest(self, job: Dict) -> Optional[str]:
+        """The stored digest of this job, or None if it has none or the job changed since it was built."""
+        entry = self.job_digests.get(str(job.get("id")))
+        return entry[1] if entry and entry[0] == record_hash(job) else None
+
+    def count_users(self) -> int:
+        return len(self.users)
+
+    def count_jobs(self) -> int:
+        return len(self.jobs)
+
+    def query_users(self, q: Optional[str] = None, limit: Optional[int] = None, cursor: Optional[str] = None) -> Tuple[List[Dict], Optional[str]]:
+        """Users whose CV contains every term of `q`, one page at a time."""
+        terms = query_terms(q)
+        matching = (
+            (i, u) for i, u in enumerate(self.users)
+            if all(term in str(u.get("cv_text", "")).lower() for term in terms)
+        )
+        return _page(matching, cursor, limit)
+
+    def query_jobs(self, filters: JobFilters = JobFilters(), limit: Optional[int] = None, cursor: Optional[str] = None) -> Tuple[List[Dict], Optional[str]]:
+        """Jobs matching the filters, one page at a time."""
+        return _page(((i, j) for i, j in enumerate(self.jobs) if filters.matches(j)), cursor, limit)
+
+
+async def run_query(dataset, fn: Callable, *args, **kwargs):
+    """Call `fn` (a query on `dataset`) from async code; in a worker thread if the dataset reads from disk."""
+    if dataset.blocking:
+        return await asyncio.to_thread(fn, *args, **kwargs)
+    return fn(*args, **kwargs)
+
+
+def _index(records: List[Dict], key: str) -> Dict[str, Dict]:
+    index: Dict[str, Dict] = {}
+    for record in records:
+        record_id = record.get(key)
+        if record_id is not None:
+            index.setdefault(str(record_id), record)  # first record wins, like a linear scan
+    return index
+
+
+def _read_json_list(path: str) -> Tuple[List[Dict], str]:
+    with open(path, "rb") as f:
+        raw = f.read()
+    data = json.loads(raw)
+    if not isinstance(data, list):
+        raise ValueError(f"{path} must contain a JSON array")
+    return data, hashlib.sha1(raw).hexdigest()
+
+
+class DataStore:
+    """Holds the current Dataset and reloads it when the JSON files change.
+
+    A daemon thread polls the files' size and mtime. On a change both files
+    are parsed and indexed off to the side, and the finished Dataset is
+    swapped in with a single reference assignment. A file that fails to
+    parse (e.g. caught mid-write) keeps its previous records and is retried
+    on the next poll. Callbacks registered with `subscribe` run after each
+    swap, on the thread that reloaded.
+
+    With `build_job_digests`, each job's digest is kept next to it and
+    rebuilt, off to the side with the rest of the Dataset, only for jobs
+    that are new or changed.
+    """
+
+    backend = "json"
+
+    def __init__(self, users_path: str = USERS_FILE, jobs_path: str = JOBS_FILE, poll_interval: float = DATA_RELOAD_SECONDS):
+        self.users_path = users_path
+        self.jobs_path = jobs_path
+        self.poll_interval = poll_interval
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._signatures: Dict[str, Optional[Tuple[int, int]]] = {users_path: None, jobs_path: None}
+        self._hashes: Dict[str, str] = {}
+        self._subscribers: List[Callable] = []
+        self._build_digest: Optional[Callable[[Dict], str]] = None
+        self.reloads = 0
+        self.digests_built = 0
+        self.dataset = Dataset()
+        self.reload()
+
+    def _signature(self, path: str) -> Optional[Tuple[int, int]]:
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def _load(self, path: str, previous: List[Dict]) -> List[Dict]:
+        signature = self._signature(path)
+        try:
+            records, digest = _read_json_list(path)
+        except FileNotFoundError:
+            logger.error(f"File {path} not found")
+            return previous
+        except (ValueError, OSError) as e:
+            logger.error(f"Error loading {path}, keeping previous data: {str(e)}")
+            return previous
+        self._signatures[path] = signature
+        self._hashes[path] = digest
+        logger.info(f"Successfully loaded {len(records)} items from {path}")
+        return records
+
+    def reload(self) -> Dataset:
+        """Re-read both files and atomically publish the new Dataset."""
+        with self._lock:
+            current = self.dataset
+            users = self._load(self.users_path, current.users)
+            jobs = self._load(self.jobs_path, current.jobs)
+            version = hashlib.sha1(
+                f"{self._hashes.get(self.users_path, '')}:{self._hashes.get(self.jobs_path, '')}".encode()
+            ).hexdigest()[:16]
+            if version != current.version:
+                self.dataset = Dataset(
+                    users=users,
+                    jobs=jobs,
+                    users_by_id=_index(users, "user_id"),
+                    jobs_by_id=_index(jobs, "id"),
+                    version=version,
+                    job_digests=current.job_digests if jobs is current.jobs else self._digests(jobs, current.job_digests),
+                )
+                self.reloads += 1
+            dataset = self.dataset
+        if dataset is not current:
+            self._notify(dataset)
+        return dataset
+
+    def _digests(self, jobs: List[Dict], previous: Dict[str, Tuple[str, str]]) -> Dict[str, Tuple[str, str]]:
+        """Digests for `jobs`, reusing the previous ones of unchanged jobs. Must hold the lock."""
+        if self._build_digest is None:
+            return {}
+        digests: Dict[str, Tuple[str, str]] = {}
+        for job in jobs:
+            job_id, content_hash = str(job.get("id")), record_hash(job)
+            entry = previous.get(job_id)
+            if entry is None or entry[0] != content_hash:
+                entry = (content_hash, self._build_digest(job))
+                self.digests_built += 1
+            digests.setdefault(job_id, entry)
+        return digests
+
+    def build_job_digests(self, build: Callable[[Dict], str], version: str = "1"):
+        """Keep `build(job)` next to every job: built now, and on reloads only for new or changed jobs.
+
+        The JSON backend keeps digests in memory with the jobs, so `version`
+        only matters to stores that persist them.
+        """
+        with self._lock:
+            self._build_digest = build
+            self.dataset = replace(self.dataset, job_digests=self._digests(self.dataset.jobs, {}))
+
+    def subscribe(self, callback: Callable):
+        """Call `callback(dataset)` whenever a reload publishes a new Dataset."""
+        self._subscribers.append(callback)
+
+    def _notify(self, dataset):
+        for callback in self._subscribers:
+            try:
+                callback(dataset)
+            except Exception as e:
+                logger.error(f"Reload subscriber {callback!r} failed: {str(e)}")
+
+    def changed(self) -> bool:
+        return any(self._signature(path) != signature for path, signature in self._signatures.items())
+
+    def _run(self):
+        while not self._stop.wait(self.poll_interval):
+            if self.changed():
+                self.reload()
+
+    def start(self):
+        if self._thread is not None or self.poll_interval <= 0:
+            return
+        self._thread = threading.Thread(target=self._run, name="data-reloader", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def snapshot(self) -> Dict:
+        dataset = self.dataset
+        return {
+            "version": dataset.version,
+            "backend": self.backend,
+            "users": dataset.count_users(),
+            "jobs": dataset.count_jobs(),
+            "reloads": self.reloads,
+            "digests_built": self.digests_built,
+        }
+
+
+def open_data_store() -> DataStore:
+    if DATA_BACKEND == "sqlite":
+        from sqlite_store import SQLiteStore
+        return SQLiteStore(SQLITE_PATH)
+    return DataStore()
+
+
+data_store = open_data_store()
@@ -0,0 +1,218 @@
+import asyncio
+import json
+import logging
+import os
+import time
+from collections import deque
+from dataclasses import dataclass
+from typing import AsyncIterator, Callable, Deque, Dict, List, Optional
+
+from agent_registry import get_agent
+from llm_limiter import LLMOverloadedError
+
+logger = logging.getLogger(__name__)
+
+# Per-endpoint hedging policies as JSON, e.g.
+# {"generate": {"llm_name": "openai", "model_name": "gpt-4o-mini", "max_ratio": 0.05},
+#  "generate-quick": {"llm_name": "ollama", "model_name": "llama3.1:latest", "base_url": "http://ollama-2:11434"}}
+# Endpoints without a policy are never hedged.
+HEDGE_POLICIES_JSON = os.getenv("HEDGE_POLICIES", "")
+
+# Requests remembered per endpoint when enforcing the hedge budget.
+HEDGE_WINDOW = 200
+# Time-to-first-token samples kept per backend for the hedge delay.
+TTFT_WINDOW = 200
+
+
+@dataclass
+class HedgePolicy:
+    """Where and when to send a duplicate request for one endpoint."""
+
+    llm_name: str
+    model_name: str
+    base_url: Optional[str] = None  # another Ollama replica
+    max_ratio: float = 0.1  # at most this share of requests is hedged
+    percentile: float = 0.9  # hedge once the primary is slower than this TTFT percentile
+    initial_delay: float = 5.0  # hedge delay until min_samples TTFTs have been seen
+    min_samples: int = 20
+
+
+def load_policies(raw: str = HEDGE_POLICIES_JSON) -> Dict[str, HedgePolicy]:
+    if not raw.strip():
+        return {}
+    try:
+        return {endpoint: HedgePolicy(**config) for endpoint, config in json.loads(raw).items()}
+    except (ValueError, TypeError) as e:
+        logger.error(f"Invalid HEDGE_POLICIES, hedging disabled: {e}")
+        return {}
+
+
+class _EndpointStats:
+    def __init__(self):
+        self.window: Deque[int] = deque(maxlen=HEDGE_WINDOW)
+        self.requests = 0
+        self.hedged = 0
+        self.hedge_wins = 0
+        self.budget_denied = 0
+        self.failures = 0
+
+    def snapshot(self) -> Dict:
+        return {
+            "requests": self.requests,
+            "hedged": self.hedged,
+            "hedge_wins": self.hedge_wins,
+            "budget_denied": self.budget_denied,
+            "failures": self.failures,
+            "recent_hedge_ratio": round(sum(self.window) / len(self.window), 3) if self.window else 0.0,
+        }
+
+
+class _Attempt:
+    """One streamed call to a backend, consumed in its own task; the task returns the sum of the chunks."""
+
+    def __init__(self, hedger: "Hedger", backend: str, stream: Callable[[], AsyncIterator]):
+        self.hedger = hedger
+        self.backend = backend
+        self.first_token = asyncio.Event()
+        self.task = asyncio.create_task(self._consume(stream))
+
+    async def _consume(self, stream: Callable[[], AsyncIterator]):
+        start = time.perf_counter()
+        result = None
+        try:
+            async for chunk in stream():
+                if not self.first_token.is_set():
+                    self.hedger.record_ttft(self.backend, time.perf_counter() - start)
+                    self.first_token.set()
+                # Message chunks add up to one message, keeping the finish reason and usage
+                result = chunk if result is None else result + chunk
+            return "" if result is None else result
+        except asyncio.CancelledError:
+            if not self.first_token.is_set():
+                # Lower bound on the TTFT we gave up on; keeps the percentile honest.
+                self.hedger.record_ttft(self.backend, time.perf_counter() - start)
+            raise
+        finally:
+            # Also wakes waiters when the call failed before producing anything.
+            self.first_token.set()
+
+    @property
+    def failed(self) -> bool:
+        return self.task.done() and not self.task.cancelled() and self.task.exception() is not None
+
+
+async def _wait_first_token(attempts: List[_Attempt], timeout: Optional[float] = None) -> bool:
+    waiters = [asyncio.create_task(a.first_token.wait()) for a in attempts]
+    try:
+        done, _ = await asyncio.wait(waiters, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+        return bool(done)
+    finally:
+        for waiter in waiters:
+            waiter.cancel()
+
+
+class Hedger:
+    """Hedged LLM requests.
+
+    The request goes to the agent's own backend first. If no token has
+    arrived after the backend's observed TTFT percentile, a duplicate is
+    sent to the endpoint's secondary backend (another provider or Ollama
+    replica). Whichever produces a token first is kept and the other call is
+    cancelled. A sliding window caps hedges at `max_ratio` of the endpoint's
+    requests so a slow backend cannot double the load. The winner's answer
+    goes through the agent's `finalize` and errors become its `error_text`,
+    so a hedged answer looks like one from `agenerate`.
+    """
+
+    def __init__(self, policies: Optional[Dict[str, HedgePolicy]] = None):
+        self.policies = load_policies() if policies is None else policies
+        self._ttft: Dict[str, Deque[float]] = {}
+        self._stats: Dict[str, _EndpointStats] = {}
+
+    def policy_for(self, endpoint: str, agent) -> Optional[HedgePolicy]:
+        """The endpoint's policy, unless its secondary is the agent's own backend or the agent cannot stream."""
+        policy = self.policies.get(endpoint)
+        if policy is None or not hasattr(agent, "astream_chunks"):
+            return None
+        if (policy.llm_name, policy.model_name, policy.base_url) == (agent.llm_name, agent.model_name, agent.base_url):
+            return None
+        return policy
+
+    def record_ttft(self, backend: str, seconds: float):
+        self._ttft.setdefault(backend, deque(maxlen=TTFT_WINDOW)).append(seconds)
+
+    def hedge_delay(self, backend: str, policy: HedgePolicy) -> float:
+        samples = sorted(self._ttft.get(backend, ()))
+        if len(samples) < policy.min_samples:
+            return policy.initial_delay
+        return samples[min(len(samples) - 1, int(policy.percentile * len(samples)))]
+
+    def _may_hedge(self, stats: _EndpointStats, policy: HedgePolicy) -> bool:
+        return (sum(stats.window) + 1) / (len(stats.window) + 1) <= policy.max_ratio
+
+    async def generate(self, endpoint: str, agent, **kwargs) -> str:
+        """Run `agent.astream_chunks(**kwargs)`, hedged per the endpoint's policy, and finalize the winner's answer."""
+        policy = self.policy_for(endpoint, agent)
+        stats = self._stats.setdefault(endpoint, _EndpointStats())
+        stats.requests += 1
+        primary_key = f"{agent.backend}:{agent.model_name}"
+
+        def secondary_stream() -> AsyncIterator[str]:
+            secondary = get_agent(type(agent), policy.llm_name, policy.model_name, agent.temperature, policy.base_url)
+            return secondary.astream_chunks(**kwargs)
+
+        attempts = [_Attempt(self, primary_key, lambda: agent.astream_chunks(**kwargs))]
+        try:
+            hedged = False
+            if policy is not None and not await _wait_first_token(attempts, self.hedge_delay(primary_key, policy)):
+                if self._may_hedge(stats, policy):
+                    hedged = True
+                    stats.hedged += 1
+                    secondary_key = f"{policy.llm_name}@{policy.base_url}" if policy.base_url else policy.llm_name
+                    attempts.append(_Attempt(self, f"{secondary_key}:{policy.model_name}", secondary_stream))
+                    logger.info(f"Hedging {endpoint} request to {policy.llm_name}:{policy.model_name}")
+                else:
+                    stats.budget_denied += 1
+            stats.window.append(int(hedged))
+
+            winner = await self._first_to_answer(attempts)
+            for attempt in attempts:
+                if attempt is not winner:
+                    attempt.task.cancel()
+            if winner is not attempts[0]:
+                stats.hedge_wins += 1
+            return agent.finalize(await winner.task)
+        except (asyncio.CancelledError, LLMOverloadedError):
+            raise
+        except Exception as e:
+            stats.failures += 1
+            return agent.error_text(e)
+        finally:
+            for attempt in attempts:
+                if not attempt.task.done():
+                    attempt.task.cancel()
+
+    async def _first_to_answer(self, attempts: List[_Attempt]) -> _Attempt:
+        """The first attempt to produce a token; failed attempts are skipped while others remain."""
+        pending = list(attempts)
+        while True:
+            for attempt in [a for a in pending if a.first_token.is_set()]:
+                if not attempt.failed:
+                    return attempt
+                pending.remove(attempt)
+                if not pending:
+                    return attempt  # everything failed; awaiting it re-raises the error
+            await _wait_first_token(pending)
+
+    def snapshot(self) -> Dict:
+        return {
+            "policies": {endpoint: vars(policy) for endpoint, policy in self.policies.items()},
+            "endpoints": {endpoint: stats.snapshot() for endpoint, stats in self._stats.items()},
+            "ttft": {
+                backend: {"samples": len(samples), "p90": round(sorted(samples)[int(0.9 * (len(samples) - 1))], 3)}
+                for backend, samples in self._ttft.items()
+            },
+        }
+
+
+hedger = Hedger()
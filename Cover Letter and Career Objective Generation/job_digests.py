@@ -0,0 +1,206 @@
+import argparse
+import json
+import logging
+import os
+import re
+import threading
+from typing import Dict, List, Tuple
+
+from prompt_compaction import count_tokens, normalize_text
+
+logger = logging.getLogger(__name__)
+
+# Use the digest instead of the raw description for stored jobs (quick and bulk endpoints).
+JOB_DIGESTS = os.getenv("JOB_DIGESTS", "1") == "1"
+# Bump when the digest format changes so every stored digest is rebuilt.
+DIGEST_VERSION = "1"
+MAX_RESPONSIBILITIES = 6
+MAX_REQUIREMENTS = 4
+MAX_VALUES = 2
+MAX_SKILLS = 15
+
+_SENTENCE_RE = re.compile(r"(?<=[.!?])\s+(?=[A-Z])")
+# "We are seeking a ...", "Join our team as ..." restate the title
+_INTRO_RE = re.compile(r"^(?:we (?:are|'re) (?:seeking|looking|hiring)|we need|join (?:our|us))\b", re.IGNORECASE)
+_DUTY_LEAD_RE = re.compile(
+    r"^(?:you will|you'll|the \w+(?: \w+){0,3} will|(?:the|this) (?:role|position) involves|responsibilities include|"
+    r"your role (?:is|will be) to)\s+(?:be responsible for\s+)?",
+    re.IGNORECASE,
+)
+_REQUIREMENT_RE = re.compile(
+    r"\b(?:required|requires?|essential|must|crucial|preferred|degree|qualifi\w*|certifi\w*|licen[cs]e|"
+    r"experience (?:with|in|of)|knowledge of|understanding of|proficien\w*|familiar\w*|background)\b|\d\+?\s*years",
+    re.IGNORECASE,
+)
+_VALUES_RE = re.compile(
+    r"\b(?:values?|culture|mission|divers\w*|inclusi\w*|innovat\w*|passion\w*|growth|impact|benefits?|offers?|"
+    r"opportunit\w*|flexib\w*|community|sustainab\w*)\b",
+    re.IGNORECASE,
+)
+# Verbs that open a new duty in "You will design ..., build ..., and present ..." lists
+_DUTY_VERBS = (
+    "analyze|apply|assist|automate|build|coach|collaborate|communicate|conduct|configure|contribute|cook|coordinate|"
+    "create|define|deliver|deploy|design|develop|document|drive|engage|ensure|establish|evaluate|handle|identify|"
+    "implement|improve|integrate|lead|maintain|make|manage|meet|mentor|monitor|optimize|oversee|own|participate|partner|"
+    "perform|plan|prepare|present|prioritize|provide|research|resolve|respond|review|schedule|support|test|track|"
+    "train|troubleshoot|work|write"
+)
+# "..., building X, managing Y" when the duties are listed as gerunds
+_DUTY_GERUNDS = "|".join(f"{verb[:-1] if verb.endswith('e') else verb}ing" for verb in _DUTY_VERBS.split("|"))
+_DUTY_SPLIT_RE = re.compile(rf",\s+(?:and\s+)?(?=(?:{_DUTY_VERBS})\b)|;\s+(?:and\s+)?", re.IGNORECASE)
+_GERUND_SPLIT_RE = re.compile(rf",\s+(?:and\s+)?(?=(?:{_DUTY_GERUNDS})\b)|;\s+(?:and\s+)?", re.IGNORECASE)
+# Purpose and manner tails ("... to identify patterns", "... through clear storytelling")
+_DUTY_TAIL_RE = re.compile(r"\s+(?:to|in order to|so that|that|which|through|for|across)\s+.*$")
+_SKILL_TOKEN_RE = re.compile(r"(?<![\w.+#/-])(?:[A-Za-z][\w.+#/-]*[\w+#]|[A-Z])")
+_SKILL_STOPWORDS = {
+    "a", "an", "and", "or", "the", "our", "we", "you", "your", "this", "with", "for", "in", "of", "to", "as", "ability",
+    "strong", "excellent", "advanced", "experience", "knowledge", "understanding", "team", "teams", "role", "company",
+}
+
+
+def _sentences(text: str) -> List[str]:
+    return [s.strip() for s in _SENTENCE_RE.split(normalize_text(text).replace("\n", " ")) if s.strip()]
+
+
+def _duties(sentence: str) -> List[str]:
+    """The separate duties of one responsibilities sentence, without their purpose tails."""
+    duties = []
+    sentence = _DUTY_LEAD_RE.sub("", sentence.rstrip("."))
+    split = _GERUND_SPLIT_RE if sentence.split(" ", 1)[0].endswith("ing") else _DUTY_SPLIT_RE
+    for clause in split.split(sentence):
+        clause = clause.strip()
+        head = " ".join(clause.split()[:3])
+        tail = _DUTY_TAIL_RE.sub("", clause[len(head):]) if len(clause) > len(head) else ""
+        if head:
+            duties.append((head + tail).strip(" ,"))
+    return duties
+
+
+def _skills(sentences: List[str], exclude: set) -> List[str]:
+    """Tool, language and method names: tokens with inner capitals, digits or symbols, or capitalized mid-sentence."""
+    skills: List[str] = []
+    seen = set()
+    for sentence in sentences:
+        previous = -2
+        for i, match in enumerate(_SKILL_TOKEN_RE.finditer(sentence)):
+            token = match.group()
+            lowered = token.lower()
+            if lowered in _SKILL_STOPWORDS or lowered in exclude or lowered in seen:
+                continue
+            technical = any(c.isdigit() or c in ".+#/" for c in token) or any(c.isupper() for c in token[1:])
+            named = token[0].isupper() and i > 0
+            if not (technical or named):
+                continue
+            seen.add(lowered)
+            # Adjacent names are one skill ("Power BI")
+            if previous == i - 1 and sentence[previous_end:match.start()] == " ":
+                skills[-1] = f"{skills[-1]} {token}"
+            else:
+                skills.append(token)
+            previous, previous_end = i, match.end()
+    return skills[:MAX_SKILLS]
+
+
+def _sections(sentences: List[str]) -> Tuple[List[str], List[str], List[str]]:
+    """Split a description's sentences into requirements, duties and company values."""
+    requirements: List[str] = []
+    responsibilities: List[str] = []
+    values: List[str] = []
+    for sentence in sentences:
+        if _INTRO_RE.search(sentence):
+            if _VALUES_RE.search(sentence):
+                values.append(sentence)
+        elif _REQUIREMENT_RE.search(sentence) and not _DUTY_LEAD_RE.search(sentence):
+            requirements.append(sentence)
+        elif _VALUES_RE.search(sentence) and not _DUTY_LEAD_RE.search(sentence):
+            values.append(sentence)
+        else:
+            responsibilities += _duties(sentence)
+    return requirements, responsibilities, values
+
+
+def job_duties(job: Dict) -> List[str]:
+    """The job's duties as short verb phrases ("analyze large datasets using Python, R, and SQL")."""
+    return _sections(_sentences(job.get("description", job.get("job_desc", "")) or ""))[1]
+
+
+def build_digest(job: Dict) -> str:
+    """Rule-based job digest: must-have skills, key requirements, responsibilities, company values.
+
+    The job title and company name are already in every prompt, so the
+    digest leaves them out. When the description is too short for a digest
+    to save anything, the description itself is returned.
+    """
+    description = job.get("description", job.get("job_desc", "")) or ""
+    sentences = _sentences(description)
+    requirements, responsibilities, values = _sections(sentences)
+    exclude = {w.lower() for w in re.findall(r"\w+", f"{job.get('title', '')} {job.get('company_name', '')}")}
+    skills = _skills(sentences, exclude)
+
+    lines = []
+    if skills:
+        lines.append(f"Must-have skills: {', '.join(skills)}")
+    if requirements or job.get("education"):
+        lines.append("Key requirements:")
+        lines += [f"- {r}" for r in requirements[:MAX_REQUIREMENTS]]
+        if job.get("education"):
+            lines.append(f"- {job['education']}")
+    if responsibilities:
+        lines.append("Responsibilities:")
+        lines += [f"- {r}" for r in responsibilities[:MAX_RESPONSIBILITIES]]
+    if values:
+        lines.append("Company values:")
+        lines += [f"- {v}" for v in values[:MAX_VALUES]]
+    digest = "\n".join(lines)
+    return digest if digest and count_tokens(digest) < count_tokens(description) else description
+
+
+class DigestStats:
+    """Thread-safe counts of digests read from the data store and built on the spot."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.stored = 0
+        self.built = 0
+
+    def record(self, stored: bool):
+        with self._lock:
+            if stored:
+                self.stored += 1
+            else:
+                self.built += 1
+
+    def snapshot(self) -> Dict:
+        with self._lock:
+            return {"enabled": JOB_DIGESTS, "stored": self.stored, "built_on_request": self.built}
+
+
+digest_stats = DigestStats()
+
+
+def job_context(job: Dict, dataset) -> str:
+    """What the prompts get as the job description for a stored job: the digest, or the raw description.
+
+    The digest comes from `dataset`, which keeps one next to each job (see
+    `DataStore.build_job_digests`); a job without one is digested on the spot.
+    """
+    if not JOB_DIGESTS:
+        return job.get("description", job.get("job_desc", ""))
+    digest = dataset.job_digest(job)
+    digest_stats.record(stored=digest is not None)
+    return digest if digest is not None else build_digest(job)
+
+
+if __name__ == "__main__":
+    from data_store import JOBS_FILE
+
+    parser = argparse.ArgumentParser(description="Show what the job digests save on a jobs file")
+    parser.add_argument("--jobs", default=JOBS_FILE)
+    args = parser.parse_args()
+    with open(args.jobs) as f:
+        jobs = json.load(f)
+    raw = sum(count_tokens(j.get("description", "")) for j in jobs)
+    digests = [build_digest(j) for j in jobs]
+    shorter = sum(d != j.get("description", "") for d, j in zip(digests, jobs))
+    print(f"{shorter} of {len(jobs)} jobs get a digest; {raw} description tokens -> "
+          f"{sum(count_tokens(d) for d in digests)} digest tokens")
@@ -0,0 +1,79 @@
+import logging
+import os
+import threading
+from collections import OrderedDict
+from typing import Optional, Tuple
+
+from langchain_ollama import ChatOllama
+
+from ollama_manager import OLLAMA_BASE_URL, OLLAMA_KEEP_ALIVE, LoadCallback, model_manager
+from prompt_compaction import count_tokens
+from usage_tracker import UsageCallback
+
+logger = logging.getLogger(__name__)
+
+# Context window sizes Ollama calls are rounded up to. Keeping the set small
+# means each model is only ever loaded with a handful of KV-cache sizes.
+CONTEXT_BUCKETS = (2048, 4096, 8192, 16384, 32768)
+
+# Headroom for the approximate local tokenizer.
+CONTEXT_MARGIN = 1.1
+
+# Most Ollama clients kept; the least recently used is dropped past this.
+OLLAMA_CLIENT_CACHE_SIZE = int(os.getenv("OLLAMA_CLIENT_CACHE_SIZE", "64"))
+
+_ollama_clients: "OrderedDict[Tuple[str, float, int, str, Optional[int]], ChatOllama]" = OrderedDict()
+_ollama_lock = threading.Lock()
+
+
+def pick_num_ctx(prompt_tokens: int, output_tokens: int) -> int:
+    """Return the smallest context bucket that fits the prompt plus the expected output."""
+    needed = int((prompt_tokens + output_tokens) * CONTEXT_MARGIN)
+    for bucket in CONTEXT_BUCKETS:
+        if needed <= bucket:
+            return bucket
+    logger.warning(f"Prompt needs ~{needed} tokens, above the largest context bucket {CONTEXT_BUCKETS[-1]}")
+    return CONTEXT_BUCKETS[-1]
+
+
+def get_ollama_llm(
+    model_name: str,
+    temperature: float,
+    num_ctx: int,
+    base_url: Optional[str] = None,
+    num_predict: Optional[int] = None,
+) -> ChatOllama:
+    """Return the shared Ollama client for a model, temperature, context bucket, server and output ceiling.
+
+    It uses the chat API, so a prompt's system message reaches the model as
+    a system turn at the start of the context. Ollama keeps the KV cache of
+    the last prompt per loaded model and only prefills what follows the
+    longest common prefix, so a byte-identical system message is not
+    prefilled again. Changing num_ctx reloads the model and drops that cache,
+    so on OLLAMA_BASE_URL `num_ctx` is only a minimum: the model's pinned
+    size is used (see `OllamaModelManager.num_ctx_for`). `num_predict` (the
+    output token ceiling) does not reload.
+    """
+    base_url = base_url or OLLAMA_BASE_URL
+    if base_url == OLLAMA_BASE_URL:
+        # One context size per model on the managed server, so requests never make Ollama reload it
+        num_ctx = model_manager.num_ctx_for(model_name, num_ctx)
+    key = (model_name, temperature, num_ctx, base_url, num_predict)
+    with _ollama_lock:
+        llm = _ollama_clients.get(key)
+        if llm is not None:
+            _ollama_clients.move_to_end(key)
+        else:
+            llm = ChatOllama(
+                model=model_name,
+                temperature=temperature,
+                num_ctx=num_ctx,
+                num_predict=num_predict,
+                keep_alive=OLLAMA_KEEP_ALIVE,
+                base_url=base_url,
+                callbacks=[UsageCallback("ollama", model_name, count_tokens), LoadCallback(model_name)],
+            )
+            _ollama_clients[key] = llm
+            while len(_ollama_clients) > OLLAMA_CLIENT_CACHE_SIZE:
+                _ollama_clients.popitem(last=False)
+        return llm
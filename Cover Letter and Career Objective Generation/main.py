@@ -1,14 +1,36 @@
-from fastapi import FastAPI, Request, HTTPException, Depends
+from fastapi import FastAPI, Request, HTTPException, Depends, Query
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, StreamingResponse
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
-from pydantic import BaseModel, validator
-from typing import Optional
-from cover_letter_agent import CoverLetterAgent
-from career_objective_agent import CareerObjectiveAgent
-import time
+from pydantic import BaseModel, root_validator, validator
+from typing import List, Optional, Tuple
+from cover_letter_agent import CoverLetterAgent, replace_paragraph, split_paragraphs
+from career_objective_agent import OBJECTIVE_BATCH_SIZE, CareerObjectiveAgent, batch_stats
+from application_agent import ApplicationAgent, application_stats
+from agent_registry import get_agent, registry_snapshot
+from candidate_briefs import brief_store, cv_context
+from job_digests import DIGEST_VERSION, JOB_DIGESTS, build_digest, digest_stats, job_context
+from prompt_prefix import prefix_stats
+from data_store import JobFilters, data_store, run_query
+from hedging import hedger
+from http_caching import cache_headers, etag_matches, make_etag, not_modified
+from llm_limiter import LLMOverloadedError, limiter_snapshots, use_lane
+from ollama_manager import model_manager
+from output_limits import output_stats
+from prompt_compaction import compaction_stats
+from refinements import refinement_store
+from result_cache import result_cache, result_key
+from streaming import stream_ndjson, stream_sse
+from template_drafts import render_cover_letter_draft
+from token_rate_limit import ENDPOINT_COSTS, TOKEN_RATE_LIMIT, TokenCharge, current_charge, token_buckets
+from usage_tracker import api_key_id, tally_request_tokens, usage_scope, usage_tracker
+import asyncio
 import json
+import os
+import time
 import re
 import logging
+from contextlib import asynccontextmanager
 from datetime import datetime
 from slowapi import Limiter, _rate_limit_exceeded_handler
 from slowapi.util import get_remote_address
@@ -21,12 +43,34 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# How often a running generation checks whether its client is still connected.
+DISCONNECT_POLL_SECONDS = 0.5
+# Bulk endpoints: most generations per request, and how many of them may
+# wait on the LLM limiter at once (kept under LLM_MAX_QUEUE so one bulk
+# request cannot fill the batch lane's queue and get itself shed).
+BULK_MAX_ITEMS = int(os.getenv("BULK_MAX_ITEMS", "50"))
+BULK_MAX_IN_FLIGHT = int(os.getenv("BULK_MAX_IN_FLIGHT", "8"))
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Preload Ollama models and keep them resident between requests
+    model_manager.start()
+    # Digest every job now; reloads then digest only new or changed jobs
+    if JOB_DIGESTS:
+        await asyncio.to_thread(data_store.build_job_digests, build_digest, DIGEST_VERSION)
+    # Reload users and jobs when the JSON files change
+    data_store.start()
+    yield
+    data_store.stop()
+    model_manager.stop()
+
 # Rate limiter
 limiter = Limiter(key_func=get_remote_address)
 app = FastAPI(
     title="Cover Letter & Career Objective Generator API", 
     version="1.0.0",
-    description="Professional AI-powered cover letter and career objective generation"
+    description="Professional AI-powered cover letter and career objective generation",
+    lifespan=lifespan
 )
 app.state.limiter = limiter
 app.add_exception_handler(RateLimitExceeded, _rate_limit_exceeded_handler)
@@ -43,26 +87,6 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Load data files with error handling
-def load_json_file(filename):
-    try:
-        with open(filename, 'r', encoding='utf-8') as file:
-            data = json.load(file)
-            logger.info(f"Successfully loaded {len(data)} items from {filename}")
-            return data
-    except FileNotFoundError:
-        logger.error(f"File {filename} not found")
-        return []
-    except json.JSONDecodeError as e:
-        logger.error(f"Invalid JSON in {filename}: {str(e)}")
-        return []
-    except Exception as e:
-        logger.error(f"Error loading {filename}: {str(e)}")
-        return []
-
-user_profiles = load_json_file('user_profiles.json')
-jobs = load_json_file('jobs.json')
-
 # Input validation and sanitization
 def sanitize_text(text: str) -> str:
     """Remove potentially harmful content from user input"""
@@ -148,11 +172,74 @@ class CareerObjectiveRequest(BaseModel):
             raise ValueError('llm_name must be either "openai" or "ollama"')
         return v
 
+class ApplicationRequest(CoverLetterRequest):
+    """Cover letter and career objective for the same job, generated together"""
+    current_objective: Optional[str] = None
+
+    @validator('current_objective')
+    def validate_current_objective(cls, v):
+        if v and len(v) > 1000:
+            raise ValueError('Current objective too long (max 1000 characters)')
+        return sanitize_text(v) if v else None
+
+class CoverLetterRevisionRequest(BaseModel):
+    """One paragraph of an existing cover letter to rewrite; paragraphs are separated by blank lines"""
+    cover_letter: str
+    paragraph_index: int
+    guidance: Optional[str] = None  # e.g. "mention my Kubernetes work", "shorter"
+    job_title: str
+    company_name: str
+    job_desc: Optional[str] = None
+    cv_text: Optional[str] = None
+    llm_name: str = "ollama"
+    model_name: str = "llama3.1:latest"
+
+    @validator('cover_letter')
+    def validate_cover_letter(cls, v):
+        if not v or len(v.strip()) < 5:
+            raise ValueError('Field must be at least 5 characters long')
+        if len(v) > 10000:
+            raise ValueError('Cover letter too long (max 10000 characters)')
+        return v.strip()
+
+    @validator('paragraph_index')
+    def validate_paragraph_index(cls, v):
+        if v < 0:
+            raise ValueError('paragraph_index must not be negative')
+        return v
+
+    @validator('guidance')
+    def validate_guidance(cls, v):
+        if v and len(v) > 500:
+            raise ValueError('Guidance too long (max 500 characters)')
+        return sanitize_text(v) if v else None
+
+    @validator('job_title', 'company_name')
+    def validate_text_fields(cls, v):
+        if not v or len(v.strip()) < 2:
+            raise ValueError('Field must be at least 2 characters long')
+        if len(v) > 5000:
+            raise ValueError('Field too long (max 5000 characters)')
+        return sanitize_text(v)
+
+    @validator('job_desc', 'cv_text')
+    def validate_context_fields(cls, v):
+        if v and len(v) > 5000:
+            raise ValueError('Field too long (max 5000 characters)')
+        return sanitize_text(v) if v else None
+
+    @validator('llm_name')
+    def validate_llm_name(cls, v):
+        if v not in ['openai', 'ollama']:
+            raise ValueError('llm_name must be either "openai" or "ollama"')
+        return v
+
 class QuickCoverLetterRequest(BaseModel):
     user_id: str
     job_id: str
     llm_name: str = "ollama"
     model_name: str = "llama3.1:latest"
+    regenerate: bool = False  # bypass the result cache and store a fresh variant
 
     @validator('user_id', 'job_id')
     def validate_ids(cls, v):
@@ -171,6 +258,7 @@ class QuickCareerObjectiveRequest(BaseModel):
     job_id: str
     llm_name: str = "ollama"
     model_name: str = "llama3.1:latest"
+    regenerate: bool = False  # bypass the result cache and store a fresh variant
 
     @validator('user_id', 'job_id')
     def validate_ids(cls, v):
@@ -184,14 +272,83 @@ class QuickCareerObjectiveRequest(BaseModel):
             raise ValueError('llm_name must be either "openai" or "ollama"')
         return v
 
+class BulkQuickRequest(BaseModel):
+    """One user against many jobs (`user_id` + `job_ids`), or one job against many users (`job_id` + `user_ids`)"""
+    user_id: Optional[str] = None
+    job_ids: Optional[List[str]] = None
+    job_id: Optional[str] = None
+    user_ids: Optional[List[str]] = None
+    llm_name: str = "ollama"
+    model_name: str = "llama3.1:latest"
+    regenerate: bool = False
+
+    @validator('user_id', 'job_id')
+    def validate_ids(cls, v):
+        if v is not None and not re.match(r'^[a-zA-Z0-9_-]+$', v):
+            raise ValueError('Invalid ID format')
+        return v
+
+    @validator('job_ids', 'user_ids')
+    def validate_id_lists(cls, v):
+        if v is None:
+            return v
+        if not 1 <= len(v) <= BULK_MAX_ITEMS:
+            raise ValueError(f'must contain between 1 and {BULK_MAX_ITEMS} IDs')
+        if any(not i or not re.match(r'^[a-zA-Z0-9_-]+$', i) for i in v):
+            raise ValueError('Invalid ID format')
+        return list(dict.fromkeys(v))  # drop duplicates, keep order
+
+    @validator('llm_name')
+    def validate_llm_name(cls, v):
+        if v not in ['openai', 'ollama']:
+            raise ValueError('llm_name must be either "openai" or "ollama"')
+        return v
+
+    @root_validator(skip_on_failure=True)
+    def validate_shape(cls, values):
+        one_user = values.get('user_id') is not None and values.get('job_ids') is not None
+        one_job = values.get('job_id') is not None and values.get('user_ids') is not None
+        provided = sum(values.get(k) is not None for k in ('user_id', 'job_ids', 'job_id', 'user_ids'))
+        if provided != 2 or not (one_user or one_job):
+            raise ValueError('Provide either user_id with job_ids, or job_id with user_ids')
+        return values
+
+    def pairs(self) -> List[Tuple[str, str]]:
+        """(user_id, job_id) for every generation in the request"""
+        if self.user_id is not None:
+            return [(self.user_id, job_id) for job_id in self.job_ids]
+        return [(user_id, self.job_id) for user_id in self.user_ids]
+
 # Response models
 class CoverLetterResponse(BaseModel):
     cover_letter: str
     processing_time: Optional[float] = None
+    cached: bool = False
 
 class CareerObjectiveResponse(BaseModel):
     career_objective: str
     processing_time: Optional[float] = None
+    cached: bool = False
+
+class ApplicationResponse(BaseModel):
+    cover_letter: str
+    career_objective: str
+    processing_time: Optional[float] = None
+    cached: bool = False
+
+class CoverLetterRevisionResponse(BaseModel):
+    cover_letter: str  # the whole letter with the paragraph replaced
+    paragraph_index: int
+    paragraph: str  # the rewritten paragraph
+    processing_time: Optional[float] = None
+
+class DraftResponse(BaseModel):
+    cover_letter: str  # the template draft until the refinement is ready
+    draft: bool  # whether cover_letter is still the template draft
+    status: str  # "pending", "ready", "shed" or "failed"
+    refinement_id: Optional[str] = None  # poll GET /generate-quick/draft/{refinement_id}
+    retry_after: Optional[int] = None  # when status is "shed"
+    processing_time: Optional[float] = None
 
 # Middleware for logging and timing
 @app.middleware("http")
@@ -217,6 +374,183 @@ async def log_requests(request: Request, call_next):
         logger.error(f"Request failed after {process_time:.3f}s: {str(e)}")
         raise
 
+# Charge LLM tokens to the endpoint and API key, including background work the request starts
+@app.middleware("http")
+async def attribute_usage(request: Request, call_next):
+    with usage_scope(request.url.path, api_key_id(request.headers)):
+        return await call_next(request)
+
+# Charge LLM endpoints by tokens: the estimate up front, settled against the actual tokens after the response
+@app.middleware("http")
+async def limit_llm_tokens(request: Request, call_next):
+    cost = ENDPOINT_COSTS.get(request.url.path) if request.method == "POST" else None
+    if not TOKEN_RATE_LIMIT or cost is None:
+        return await call_next(request)
+
+    key = api_key_id(request.headers)
+    client = key if key != "anonymous" else f"ip-{get_remote_address(request)}"
+    estimate = cost.estimate(await request.body())
+    bucket = await asyncio.to_thread(token_buckets.charge, client, estimate)
+    if not bucket.allowed:
+        logger.warning(f"Token rate limit exceeded for {client}: request needs ~{estimate} tokens")
+        return JSONResponse(
+            status_code=429,
+            content={"detail": f"Token rate limit exceeded: this request needs about {estimate} LLM tokens"},
+            headers=bucket.headers(),
+        )
+
+    with tally_request_tokens() as tally:
+        charge = TokenCharge(token_buckets, client, estimate, tally)
+        reset = current_charge.set(charge)
+        try:
+            response = await call_next(request)
+        except BaseException:
+            # No body to wait for: settle now against the tokens used so far
+            await charge.release()
+            raise
+        finally:
+            current_charge.reset(reset)
+    response.headers.update(bucket.headers())
+    body = response.body_iterator
+
+    async def settle_after_body():
+        try:
+            async for chunk in body:
+                yield chunk
+        finally:
+            await charge.release()
+
+    response.body_iterator = settle_after_body()
+    return response
+
+def llm_overloaded(e: LLMOverloadedError) -> HTTPException:
+    """503 telling the client when to retry, for requests shed by the LLM limiter"""
+    logger.warning(f"Shedding request: {str(e)}")
+    return HTTPException(
+        status_code=503,
+        detail="AI service is at capacity, please retry later",
+        headers={"Retry-After": str(e.retry_after)}
+    )
+
+async def run_agent(request: Request, endpoint: str, agent, **kwargs) -> str:
+    """Generate with the agent, hedged to a secondary backend when the endpoint has a hedging policy.
+
+    The LLM call is cancelled if the client disconnects first, so abandoned
+    requests give their limiter slot back instead of running to completion.
+    """
+    if hedger.policy_for(endpoint, agent) is None:
+        generation = agent.agenerate(**kwargs)
+    else:
+        generation = hedger.generate(endpoint, agent, **kwargs)
+    return await cancel_on_disconnect(request, endpoint, generation)
+
+async def cancel_on_disconnect(request: Request, endpoint: str, generation) -> str:
+    """Await `generation`, cancelling it and answering 499 if the client disconnects first"""
+    task = asyncio.ensure_future(generation)
+    try:
+        while True:
+            done, _ = await asyncio.wait({task}, timeout=DISCONNECT_POLL_SECONDS)
+            if done:
+                return task.result()
+            if await request.is_disconnected():
+                logger.info(f"Client disconnected, cancelling {endpoint} generation")
+                raise HTTPException(status_code=499, detail="Client closed request")
+    finally:
+        task.cancel()
+
+def candidate_info_for(user: dict) -> dict:
+    return {
+        "Name": user['name'],
+        "Email": user['email'],
+        "Phone": user.get('phone', ''),
+        "City": user.get('city', ''),
+        "Country": user.get('country', ''),
+        "Date": datetime.now().strftime("%B %d, %Y")
+    }
+
+async def quick_cover_letter(generate, agent, data, user: dict, job: dict, regenerate: bool = False) -> Tuple[str, bool]:
+    """Cover letter for a stored user and job, through the result cache.
+
+    `generate` runs the agent with the prompt fields; returns the letter and
+    whether it came from the cache.
+    """
+    candidate_info = candidate_info_for(user)
+    # The letter is dated, so a cached one is only reused on the same day
+    cache_key = result_key("generate-quick", agent, user, job, candidate_info["Date"])
+    letter = None if regenerate else result_cache.get(cache_key)
+    if letter is not None:
+        return letter, True
+    letter = await generate(
+        cv_text=await cv_context(user),
+        job_title=job.get('title', 'Position'),
+        company_name=job.get('company_name', 'Company'),
+        job_desc=await run_query(data, job_context, job, data),
+        candidate_info=candidate_info,
+    )
+    if not letter.startswith("❌"):
+        result_cache.put(cache_key, letter, regenerated=regenerate)
+    return letter, False
+
+async def quick_career_objective(generate, agent, data, user: dict, job: dict, regenerate: bool = False) -> Tuple[str, bool]:
+    """Career objective for a stored user and job, through the result cache."""
+    cache_key = result_key("generate-objective-quick", agent, user, job)
+    objective = None if regenerate else result_cache.get(cache_key)
+    if objective is not None:
+        return objective, True
+    objective = await generate(
+        cv_text=await cv_context(user),
+        job_title=job.get('title', 'Position'),
+        company_name=job.get('company_name', 'Company'),
+        job_desc=await run_query(data, job_context, job, data),
+        current_objective=user.get('career_objective', None),
+    )
+    if not objective.startswith("❌"):
+        result_cache.put(cache_key, objective, regenerated=regenerate)
+    return objective, False
+
+async def quick_career_objectives(agent, data, user: dict, jobs: List[dict], regenerate: bool = False) -> List[Tuple[str, bool]]:
+    """`quick_career_objective` for one user and several jobs; the uncached ones share batched prompts."""
+    keys = [result_key("generate-objective-quick", agent, user, job) for job in jobs]
+    objectives = [None if regenerate else result_cache.get(key) for key in keys]
+    missing = [i for i, objective in enumerate(objectives) if objective is None]
+    if missing:
+        generated = await agent.agenerate_batch(
+            await cv_context(user),
+            [
+                {
+                    "job_title": jobs[i].get('title', 'Position'),
+                    "company_name": jobs[i].get('company_name', 'Company'),
+                    "job_desc": await run_query(data, job_context, jobs[i], data),
+                }
+                for i in missing
+            ],
+            current_objective=user.get('career_objective', None),
+        )
+        for i, objective in zip(missing, generated):
+            objectives[i] = objective
+            if not objective.startswith("❌"):
+                result_cache.put(keys[i], objective, regenerated=regenerate)
+    return [(objective, i not in missing) for i, objective in enumerate(objectives)]
+
+async def quick_application(generate, agent, data, user: dict, job: dict, regenerate: bool = False) -> Tuple[dict, bool]:
+    """Cover letter and career objective for a stored user and job, through the result cache."""
+    candidate_info = candidate_info_for(user)
+    cache_key = result_key("generate-application-quick", agent, user, job, candidate_info["Date"])
+    cached = None if regenerate else result_cache.get(cache_key)
+    if cached is not None:
+        return json.loads(cached), True
+    application = await generate(
+        cv_text=await cv_context(user),
+        job_title=job.get('title', 'Position'),
+        company_name=job.get('company_name', 'Company'),
+        job_desc=await run_query(data, job_context, job, data),
+        candidate_info=candidate_info,
+        current_objective=user.get('career_objective', None),
+    )
+    if not any(text.startswith("❌") for text in application.values()):
+        result_cache.put(cache_key, json.dumps(application), regenerated=regenerate)
+    return application, False
+
 # Authentication
 def verify_token(credentials: HTTPAuthorizationCredentials = Depends(security)):
     if credentials is None:
@@ -226,6 +560,7 @@ def verify_token(credentials: HTTPAuthorizationCredentials = Depends(security)):
 # Root endpoint
 @app.get("/")
 async def root():
+    data = data_store.dataset
     return {
         "message": "Cover Letter & Career Objective Generator API",
         "version": "1.0.0",
@@ -233,42 +568,54 @@ async def root():
         "endpoints": {
             "cover_letters": {
                 "manual": "/generate",
-                "quick": "/generate-quick"
+                "stream": "/generate/stream",
+                "revise": "/generate/revise",
+                "quick": "/generate-quick",
+                "draft": "/generate-quick/draft",
+                "bulk": "/generate-quick/bulk"
             },
             "career_objectives": {
                 "manual": "/generate-objective",
-                "quick": "/generate-objective-quick"
+                "stream": "/generate-objective/stream",
+                "quick": "/generate-objective-quick",
+                "bulk": "/generate-objective-quick/bulk"
+            },
+            "applications": {
+                "manual": "/generate-application",
+                "quick": "/generate-application-quick"
             },
             "data": {
                 "users": "/users",
-                "jobs": "/jobs"
+                "jobs": "/jobs",
+                "search_users": "/users/search",
+                "search_jobs": "/jobs/search"
             },
             "monitoring": {
                 "health": "/health",
+                "metrics": "/metrics",
                 "docs": "/docs"
             }
         },
         "loaded_data": {
-            "users": len(user_profiles),
-            "jobs": len(jobs)
+            "users": await run_query(data, data.count_users),
+            "jobs": await run_query(data, data.count_jobs)
         }
     }
 
 # COVER LETTER ENDPOINTS
 @app.post("/generate", response_model=CoverLetterResponse)
-@limiter.limit("5/minute")
 async def generate_cover_letter(request: Request, req: CoverLetterRequest, token=Depends(verify_token)):
     start_time = time.time()
     
     try:
         logger.info(f"Generating cover letter for {req.candidate_info.Name}")
         
-        agent = CoverLetterAgent(
-            llm_name=req.llm_name,
-            model_name=req.model_name,
-        )
+        agent = get_agent(CoverLetterAgent, req.llm_name, req.model_name)
         
-        letter = agent.generate(
+        letter = await run_agent(
+            request,
+            "generate",
+            agent,
             cv_text=req.cv_text,
             job_title=req.job_title,
             company_name=req.company_name,
@@ -284,6 +631,10 @@ async def generate_cover_letter(request: Request, req: CoverLetterRequest, token
             processing_time=processing_time
         )
         
+    except HTTPException:
+        raise
+    except LLMOverloadedError as e:
+        raise llm_overloaded(e)
     except ValueError as e:
         logger.warning(f"Validation error: {str(e)}")
         raise HTTPException(status_code=400, detail=f"Validation error: {str(e)}")
@@ -291,79 +642,205 @@ async def generate_cover_letter(request: Request, req: CoverLetterRequest, token
         logger.error(f"Error generating cover letter: {str(e)}")
         raise HTTPException(status_code=500, detail="Internal server error occurred")
 
+@app.post("/generate/stream")
+async def stream_cover_letter(request: Request, req: CoverLetterRequest, token=Depends(verify_token)):
+    """Stream the cover letter as server-sent events (`token` events, then `done` with TTFT and tokens/sec)"""
+    try:
+        agent = get_agent(CoverLetterAgent, req.llm_name, req.model_name)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"Validation error: {str(e)}")
+
+    logger.info(f"Streaming cover letter for {req.candidate_info.Name}")
+    stream = agent.astream(
+        cv_text=req.cv_text,
+        job_title=req.job_title,
+        company_name=req.company_name,
+        job_desc=req.job_desc,
+        candidate_info=req.candidate_info.model_dump(),
+    )
+    return StreamingResponse(
+        stream_sse(stream, request.is_disconnected, DISCONNECT_POLL_SECONDS),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@app.post("/generate/revise", response_model=CoverLetterRevisionResponse)
+async def revise_cover_letter(request: Request, req: CoverLetterRevisionRequest, token=Depends(verify_token)):
+    """Rewrite one paragraph of a cover letter, with the paragraphs around it as context"""
+    start_time = time.time()
+    paragraphs = split_paragraphs(req.cover_letter)
+    if req.paragraph_index >= len(paragraphs):
+        raise HTTPException(
+            status_code=400,
+            detail=f"paragraph_index out of range: the letter has {len(paragraphs)} paragraphs"
+        )
+
+    try:
+        agent = get_agent(CoverLetterAgent, req.llm_name, req.model_name)
+        paragraph = await cancel_on_disconnect(
+            request,
+            "generate-revise",
+            agent.arevise_paragraph(
+                req.cover_letter,
+                req.paragraph_index,
+                guidance=req.guidance,
+                job_title=req.job_title,
+                company_name=req.company_name,
+                job_desc=req.job_desc or "",
+                cv_text=req.cv_text or "",
+            ),
+        )
+        if paragraph.startswith("❌"):
+            logger.error(paragraph)
+            raise HTTPException(status_code=500, detail="Internal server error occurred")
+
+        processing_time = time.time() - start_time
+        logger.info(f"Revised paragraph {req.paragraph_index} in {processing_time:.3f}s")
+        return CoverLetterRevisionResponse(
+            cover_letter=replace_paragraph(req.cover_letter, req.paragraph_index, paragraph),
+            paragraph_index=req.paragraph_index,
+            paragraph=paragraph,
+            processing_time=processing_time
+        )
+
+    except HTTPException:
+        raise
+    except LLMOverloadedError as e:
+        raise llm_overloaded(e)
+    except ValueError as e:
+        logger.warning(f"Validation error: {str(e)}")
+        raise HTTPException(status_code=400, detail=f"Validation error: {str(e)}")
+    except Exception as e:
+        logger.error(f"Error revising cover letter: {str(e)}")
+        raise HTTPException(status_code=500, detail="Internal server error occurred")
+
 @app.post("/generate-quick", response_model=CoverLetterResponse)
-@limiter.limit("10/minute")
 async def generate_quick_cover_letter(request: Request, req: QuickCoverLetterRequest, token=Depends(verify_token)):
     start_time = time.time()
     
     try:
+        # One dataset snapshot for the whole request, even if a reload lands meanwhile
+        data = data_store.dataset
+
         # Find user profile
-        user = next((u for u in user_profiles if u['user_id'] == req.user_id), None)
+        user = await run_query(data, data.user, req.user_id)
         if not user:
             logger.warning(f"User not found: {req.user_id}")
             raise HTTPException(status_code=404, detail="User not found")
         
         # Find job
-        job = next((j for j in jobs if j.get('id') == req.job_id), None)
+        job = await run_query(data, data.job, req.job_id)
         if not job:
             logger.warning(f"Job not found: {req.job_id}")
             raise HTTPException(status_code=404, detail="Job not found")
         
-        # Prepare candidate info
-        candidate_info = {
-            "Name": user['name'],
-            "Email": user['email'],
-            "Phone": user.get('phone', ''),
-            "City": user.get('city', ''),
-            "Country": user.get('country', ''),
-            "Date": datetime.now().strftime("%B %d, %Y")
-        }
-        
         logger.info(f"Generating quick cover letter for user {req.user_id}, job {req.job_id}")
         
         # Generate cover letter
-        agent = CoverLetterAgent(
-            llm_name=req.llm_name,
-            model_name=req.model_name,
-        )
-        
-        letter = agent.generate(
-            cv_text=user['cv_text'],
-            job_title=job.get('title', 'Position'),
-            company_name=job.get('company_name', 'Company'),
-            job_desc=job.get('description', job.get('job_desc', '')),
-            candidate_info=candidate_info,
+        agent = get_agent(CoverLetterAgent, req.llm_name, req.model_name)
+        letter, cached = await quick_cover_letter(
+            lambda **kwargs: run_agent(request, "generate-quick", agent, **kwargs),
+            agent, data, user, job, req.regenerate
         )
         
         processing_time = time.time() - start_time
-        logger.info(f"Quick cover letter generated successfully in {processing_time:.3f}s")
+        logger.info(f"Quick cover letter {'served from cache' if cached else 'generated successfully'} in {processing_time:.3f}s")
         
         return CoverLetterResponse(
             cover_letter=letter,
-            processing_time=processing_time
+            processing_time=processing_time,
+            cached=cached
         )
         
     except HTTPException:
         raise
+    except LLMOverloadedError as e:
+        raise llm_overloaded(e)
     except Exception as e:
         logger.error(f"Error generating quick cover letter: {str(e)}")
         raise HTTPException(status_code=500, detail="Internal server error occurred")
 
+@app.post("/generate-quick/draft", response_model=DraftResponse)
+async def generate_quick_cover_letter_draft(request: Request, req: QuickCoverLetterRequest, token=Depends(verify_token)):
+    """Instant template draft of the quick cover letter; the LLM-polished letter follows via polling"""
+    start_time = time.time()
+    data = data_store.dataset
+    user = await run_query(data, data.user, req.user_id)
+    if not user:
+        raise HTTPException(status_code=404, detail="User not found")
+    job = await run_query(data, data.job, req.job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+    try:
+        agent = get_agent(CoverLetterAgent, req.llm_name, req.model_name)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"Validation error: {str(e)}")
+
+    candidate_info = candidate_info_for(user)
+    if not req.regenerate:
+        letter = result_cache.get(result_key("generate-quick", agent, user, job, candidate_info["Date"]))
+        if letter is not None:
+            return DraftResponse(cover_letter=letter, draft=False, status="ready", processing_time=time.time() - start_time)
+
+    draft = render_cover_letter_draft(user, job, candidate_info)
+
+    # The refinement outlives the response, so it settles the request's token charge itself
+    charge = current_charge.get()
+    if charge is not None:
+        charge.hold()
+
+    async def refine() -> str:
+        try:
+            # Deferrable work: the batch lane is shed first when the LLM is busy
+            with use_lane("batch"):
+                letter, _ = await quick_cover_letter(
+                    lambda **kwargs: agent.agenerate(**kwargs), agent, data, user, job, req.regenerate
+                )
+            return letter
+        finally:
+            if charge is not None:
+                await charge.release()
+
+    refinement_id = refinement_store.start(draft, refine())
+    logger.info(f"Served template draft for user {req.user_id}, job {req.job_id}; refinement {refinement_id} queued")
+    return DraftResponse(
+        cover_letter=draft,
+        draft=True,
+        status="pending",
+        refinement_id=refinement_id,
+        processing_time=time.time() - start_time,
+    )
+
+@app.get("/generate-quick/draft/{refinement_id}", response_model=DraftResponse)
+@limiter.limit("60/minute")
+async def get_quick_cover_letter_refinement(request: Request, refinement_id: str, token=Depends(verify_token)):
+    """The LLM-polished letter once ready, otherwise the draft and the refinement's status"""
+    refinement = refinement_store.get(refinement_id)
+    if refinement is None:
+        raise HTTPException(status_code=404, detail="Refinement not found or expired")
+    ready = refinement.status == "ready"
+    return DraftResponse(
+        cover_letter=refinement.text if ready else refinement.draft,
+        draft=not ready,
+        status=refinement.status,
+        refinement_id=refinement_id,
+        retry_after=refinement.retry_after,
+    )
+
 # CAREER OBJECTIVE ENDPOINTS
 @app.post("/generate-objective", response_model=CareerObjectiveResponse, tags=["Career Objectives"])
-@limiter.limit("10/minute")
 async def generate_career_objective(request: Request, req: CareerObjectiveRequest, token=Depends(verify_token)):
     start_time = time.time()
     
     try:
         logger.info(f"Generating career objective for {req.job_title} at {req.company_name}")
         
-        agent = CareerObjectiveAgent(
-            llm_name=req.llm_name,
-            model_name=req.model_name,
-        )
+        agent = get_agent(CareerObjectiveAgent, req.llm_name, req.model_name)
         
-        objective = agent.generate(
+        objective = await run_agent(
+            request,
+            "generate-objective",
+            agent,
             cv_text=req.cv_text,
             job_title=req.job_title,
             company_name=req.company_name,
@@ -379,6 +856,10 @@ async def generate_career_objective(request: Request, req: CareerObjectiveReques
             processing_time=processing_time
         )
         
+    except HTTPException:
+        raise
+    except LLMOverloadedError as e:
+        raise llm_overloaded(e)
     except ValueError as e:
         logger.warning(f"Validation error: {str(e)}")
         raise HTTPException(status_code=400, detail=f"Validation error: {str(e)}")
@@ -386,20 +867,44 @@ async def generate_career_objective(request: Request, req: CareerObjectiveReques
         logger.error(f"Error generating career objective: {str(e)}")
         raise HTTPException(status_code=500, detail="Internal server error occurred")
 
+@app.post("/generate-objective/stream", tags=["Career Objectives"])
+async def stream_career_objective(request: Request, req: CareerObjectiveRequest, token=Depends(verify_token)):
+    """Stream the career objective as server-sent events (`token` events, then `done` with TTFT and tokens/sec)"""
+    try:
+        agent = get_agent(CareerObjectiveAgent, req.llm_name, req.model_name)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"Validation error: {str(e)}")
+
+    logger.info(f"Streaming career objective for {req.job_title} at {req.company_name}")
+    stream = agent.astream(
+        cv_text=req.cv_text,
+        job_title=req.job_title,
+        company_name=req.company_name,
+        job_desc=req.job_desc,
+        current_objective=req.current_objective,
+    )
+    return StreamingResponse(
+        stream_sse(stream, request.is_disconnected, DISCONNECT_POLL_SECONDS),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
 @app.post("/generate-objective-quick", response_model=CareerObjectiveResponse, tags=["Career Objectives"])
-@limiter.limit("15/minute")
 async def generate_quick_career_objective(request: Request, req: QuickCareerObjectiveRequest, token=Depends(verify_token)):
     start_time = time.time()
     
     try:
+        # One dataset snapshot for the whole request, even if a reload lands meanwhile
+        data = data_store.dataset
+
         # Find user profile
-        user = next((u for u in user_profiles if u['user_id'] == req.user_id), None)
+        user = await run_query(data, data.user, req.user_id)
         if not user:
             logger.warning(f"User not found: {req.user_id}")
             raise HTTPException(status_code=404, detail="User not found")
         
         # Find job
-        job = next((j for j in jobs if j.get('id') == req.job_id), None)
+        job = await run_query(data, data.job, req.job_id)
         if not job:
             logger.warning(f"Job not found: {req.job_id}")
             raise HTTPException(status_code=404, detail="Job not found")
@@ -407,82 +912,336 @@ async def generate_quick_career_objective(request: Request, req: QuickCareerObje
         logger.info(f"Generating quick career objective for user {req.user_id}, job {req.job_id}")
         
         # Generate career objective
-        agent = CareerObjectiveAgent(
-            llm_name=req.llm_name,
-            model_name=req.model_name,
-        )
-        
-        objective = agent.generate(
-            cv_text=user['cv_text'],
-            job_title=job.get('title', 'Position'),
-            company_name=job.get('company_name', 'Company'),
-            job_desc=job.get('description', job.get('job_desc', '')),
-            current_objective=user.get('career_objective', None),
+        agent = get_agent(CareerObjectiveAgent, req.llm_name, req.model_name)
+        objective, cached = await quick_career_objective(
+            lambda **kwargs: run_agent(request, "generate-objective-quick", agent, **kwargs),
+            agent, data, user, job, req.regenerate
         )
         
         processing_time = time.time() - start_time
-        logger.info(f"Quick career objective generated successfully in {processing_time:.3f}s")
+        logger.info(f"Quick career objective {'served from cache' if cached else 'generated successfully'} in {processing_time:.3f}s")
         
         return CareerObjectiveResponse(
             career_objective=objective,
-            processing_time=processing_time
+            processing_time=processing_time,
+            cached=cached
         )
         
     except HTTPException:
         raise
+    except LLMOverloadedError as e:
+        raise llm_overloaded(e)
     except Exception as e:
         logger.error(f"Error generating quick career objective: {str(e)}")
         raise HTTPException(status_code=500, detail="Internal server error occurred")
 
+# COMBINED ENDPOINTS
+@app.post("/generate-application", response_model=ApplicationResponse, tags=["Applications"])
+async def generate_application(request: Request, req: ApplicationRequest, token=Depends(verify_token)):
+    """Cover letter and career objective from one LLM call over the shared CV and job context"""
+    start_time = time.time()
+    
+    try:
+        logger.info(f"Generating application for {req.candidate_info.Name}")
+        
+        agent = get_agent(ApplicationAgent, req.llm_name, req.model_name)
+        
+        application = await run_agent(
+            request,
+            "generate-application",
+            agent,
+            cv_text=req.cv_text,
+            job_title=req.job_title,
+            company_name=req.company_name,
+            job_desc=req.job_desc,
+            candidate_info=req.candidate_info.model_dump(),
+            current_objective=req.current_objective,
+        )
+        
+        processing_time = time.time() - start_time
+        logger.info(f"Application generated successfully in {processing_time:.3f}s")
+        
+        return ApplicationResponse(**application, processing_time=processing_time)
+        
+    except HTTPException:
+        raise
+    except LLMOverloadedError as e:
+        raise llm_overloaded(e)
+    except ValueError as e:
+        logger.warning(f"Validation error: {str(e)}")
+        raise HTTPException(status_code=400, detail=f"Validation error: {str(e)}")
+    except Exception as e:
+        logger.error(f"Error generating application: {str(e)}")
+        raise HTTPException(status_code=500, detail="Internal server error occurred")
+
+@app.post("/generate-application-quick", response_model=ApplicationResponse, tags=["Applications"])
+async def generate_quick_application(request: Request, req: QuickCoverLetterRequest, token=Depends(verify_token)):
+    """Cover letter and career objective for a stored user and job in one LLM call"""
+    start_time = time.time()
+    
+    try:
+        # One dataset snapshot for the whole request, even if a reload lands meanwhile
+        data = data_store.dataset
+
+        user = await run_query(data, data.user, req.user_id)
+        if not user:
+            logger.warning(f"User not found: {req.user_id}")
+            raise HTTPException(status_code=404, detail="User not found")
+        
+        job = await run_query(data, data.job, req.job_id)
+        if not job:
+            logger.warning(f"Job not found: {req.job_id}")
+            raise HTTPException(status_code=404, detail="Job not found")
+        
+        logger.info(f"Generating quick application for user {req.user_id}, job {req.job_id}")
+        
+        agent = get_agent(ApplicationAgent, req.llm_name, req.model_name)
+        application, cached = await quick_application(
+            lambda **kwargs: run_agent(request, "generate-application-quick", agent, **kwargs),
+            agent, data, user, job, req.regenerate
+        )
+        
+        processing_time = time.time() - start_time
+        logger.info(f"Quick application {'served from cache' if cached else 'generated successfully'} in {processing_time:.3f}s")
+        
+        return ApplicationResponse(**application, processing_time=processing_time, cached=cached)
+        
+    except HTTPException:
+        raise
+    except LLMOverloadedError as e:
+        raise llm_overloaded(e)
+    except Exception as e:
+        logger.error(f"Error generating quick application: {str(e)}")
+        raise HTTPException(status_code=500, detail="Internal server error occurred")
+
+# BULK ENDPOINTS
+async def bulk_response(request: Request, req: BulkQuickRequest, agent_cls, generate_one, field: str, generate_batch=None) -> StreamingResponse:
+    """Fan a bulk request out under the shared LLM limiter and stream NDJSON lines as generations finish.
+
+    The generations run in the limiter's `batch` lane, so interactive
+    requests keep priority. Each line carries `index`, `user_id` and
+    `job_id`; one that cannot be generated (unknown ID, shed, failed)
+    reports `"status": "error"` without affecting the others. With
+    `generate_batch`, one user's jobs are generated OBJECTIVE_BATCH_SIZE
+    at a time, one LLM call per group.
+    """
+    # One dataset snapshot for the whole bulk run
+    data = data_store.dataset
+    if req.user_id is not None and not await run_query(data, data.user, req.user_id):
+        raise HTTPException(status_code=404, detail="User not found")
+    if req.job_id is not None and not await run_query(data, data.job, req.job_id):
+        raise HTTPException(status_code=404, detail="Job not found")
+    try:
+        agent = get_agent(agent_cls, req.llm_name, req.model_name)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"Validation error: {str(e)}")
+
+    in_flight = asyncio.Semaphore(BULK_MAX_IN_FLIGHT)
+
+    async def run_group(group: List[Tuple[int, str, str]]) -> List[dict]:
+        items, found = [], []
+        for index, user_id, job_id in group:
+            item = {"index": index, "user_id": user_id, "job_id": job_id}
+            user, job = await run_query(data, data.user, user_id), await run_query(data, data.job, job_id)
+            if not user or not job:
+                item.update(status="error", error="User not found" if not user else "Job not found")
+            else:
+                found.append((item, user, job))
+            items.append(item)
+        if not found:
+            return items
+
+        start_time = time.time()
+        try:
+            with use_lane("batch"):
+                async with in_flight:
+                    if len(found) == 1:
+                        _, user, job = found[0]
+                        results = [await generate_one(agent.agenerate, agent, data, user, job, req.regenerate)]
+                    else:
+                        results = await generate_batch(agent, data, found[0][1], [job for _, _, job in found], req.regenerate)
+            for (item, _, _), (text, cached) in zip(found, results):
+                if text.startswith("❌"):
+                    item.update(status="error", error=text)
+                else:
+                    item.update(status="ok", cached=cached, **{field: text})
+        except LLMOverloadedError as e:
+            for item, _, _ in found:
+                item.update(status="error", error="AI service is at capacity, please retry later", retry_after=e.retry_after)
+        except Exception as e:
+            logger.error(f"Bulk generation failed for pairs {[(i['user_id'], i['job_id']) for i, _, _ in found]}: {str(e)}")
+            for item, _, _ in found:
+                item.update(status="error", error="Internal server error occurred")
+        processing_time = round(time.time() - start_time, 3)
+        for item, _, _ in found:
+            item["processing_time"] = processing_time
+        return items
+
+    pairs = [(i, user_id, job_id) for i, (user_id, job_id) in enumerate(req.pairs())]
+    size = OBJECTIVE_BATCH_SIZE if generate_batch and req.user_id is not None else 1
+    groups = [pairs[i:i + size] for i in range(0, len(pairs), max(1, size))]
+    logger.info(f"Bulk {field} generation for {len(pairs)} pairs in {len(groups)} LLM groups")
+    return StreamingResponse(
+        stream_ndjson((run_group(group) for group in groups), request.is_disconnected, DISCONNECT_POLL_SECONDS),
+        media_type="application/x-ndjson",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@app.post("/generate-quick/bulk", tags=["Bulk"])
+async def generate_quick_cover_letters_bulk(request: Request, req: BulkQuickRequest, token=Depends(verify_token)):
+    """Cover letters for one user and many jobs, or one job and many users, streamed as NDJSON"""
+    return await bulk_response(request, req, CoverLetterAgent, quick_cover_letter, "cover_letter")
+
+@app.post("/generate-objective-quick/bulk", tags=["Bulk"])
+async def generate_quick_career_objectives_bulk(request: Request, req: BulkQuickRequest, token=Depends(verify_token)):
+    """Career objectives for one user and many jobs, or one job and many users, streamed as NDJSON
+
+    For one user, the jobs are packed several to a prompt (see `CareerObjectiveAgent.generate_batch`).
+    """
+    return await bulk_response(request, req, CareerObjectiveAgent, quick_career_objective, "career_objective", quick_career_objectives)
+
 # Health check endpoint
 @app.get("/health", tags=["Monitoring"])
 async def health_check():
+    data = data_store.dataset
     return {
         "status": "healthy",
         "timestamp": datetime.now().isoformat(),
-        "loaded_users": len(user_profiles),
-        "loaded_jobs": len(jobs),
+        "loaded_users": await run_query(data, data.count_users),
+        "loaded_jobs": await run_query(data, data.count_jobs),
+        "dataset": await run_query(data, data_store.snapshot),
         "features": ["cover_letters", "career_objectives"],
+        "prompt_compaction": compaction_stats.snapshot(),
         "api_version": "1.0.0"
     }
 
+@app.get("/metrics", tags=["Monitoring"])
+async def metrics():
+    return {
+        "ollama": model_manager.snapshot(),
+        "llm_limiters": limiter_snapshots(),
+        "prompt_compaction": compaction_stats.snapshot(),
+        "agents": registry_snapshot(),
+        "hedging": hedger.snapshot(),
+        "result_cache": result_cache.snapshot(),
+        "objective_batching": batch_stats.snapshot(),
+        "applications": application_stats.snapshot(),
+        "candidate_briefs": brief_store.snapshot(),
+        "job_digests": digest_stats.snapshot(),
+        "prompt_cache": prefix_stats.snapshot(),
+        "output_limits": output_stats.snapshot(),
+        "token_usage": await asyncio.to_thread(usage_tracker.snapshot),
+        "token_rate_limits": token_buckets.snapshot(),
+        "refinements": refinement_store.snapshot(),
+        "timestamp": datetime.now().isoformat()
+    }
+
+# DATA ENDPOINTS
+USER_FIELDS = ("user_id", "name", "email", "city", "country", "current_title", "experience_years", "has_career_objective")
+JOB_FIELDS = ("job_id", "title", "company", "location", "type", "category", "contract_type", "salary_min", "salary_max")
+DEFAULT_USER_FIELDS = ("user_id", "name", "email", "city", "current_title", "has_career_objective")
+DEFAULT_JOB_FIELDS = ("job_id", "title", "company", "location", "type")
+
+def user_summary(u: dict) -> dict:
+    return {
+        "user_id": u["user_id"],
+        "name": u["name"],
+        "email": u.get("email", ""),
+        "city": u.get("city", ""),
+        "country": u.get("country", ""),
+        "current_title": u.get("current_title", ""),
+        "experience_years": u.get("experience_years"),
+        "has_career_objective": bool(u.get("career_objective"))
+    }
+
+def job_summary(j: dict) -> dict:
+    return {
+        "job_id": j.get("id"),
+        "title": j.get("title"),
+        "company": j.get("company_name"),
+        "location": j.get("location", ""),
+        "type": j.get("type", ""),
+        "category": j.get("category", ""),
+        "contract_type": j.get("contract_type", ""),
+        "salary_min": j.get("salary_min"),
+        "salary_max": j.get("salary_max")
+    }
+
+def parse_fields(fields: Optional[str], allowed: tuple, default: tuple) -> tuple:
+    """Validate a comma-separated `fields=` projection"""
+    if not fields:
+        return default
+    selected = tuple(f.strip() for f in fields.split(",") if f.strip())
+    unknown = [f for f in selected if f not in allowed]
+    if unknown:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Unknown field(s): {', '.join(unknown)}. Allowed: {', '.join(allowed)}"
+        )
+    return selected
+
+def dataset_etag(request: Request, version: str) -> str:
+    """ETag for a data page: changes with the dataset version and the query"""
+    return make_etag(version, request.url.path, sorted(request.query_params.multi_items()))
+
 @app.get("/users", tags=["Data"])
+@app.get("/users/search", tags=["Data"])
 @limiter.limit("30/minute")
-async def get_users(request: Request):
+async def get_users(
+    request: Request,
+    q: Optional[str] = Query(None, description="Full-text search over CV text"),
+    fields: Optional[str] = Query(None, description=f"Comma-separated subset of: {', '.join(USER_FIELDS)}"),
+    limit: int = Query(100, ge=1, le=500),
+    cursor: Optional[str] = Query(None, description="next_cursor from the previous page"),
+):
+    selected = parse_fields(fields, USER_FIELDS, DEFAULT_USER_FIELDS)
+    data = data_store.dataset
+    etag = dataset_etag(request, data.version)
+    if etag_matches(request, etag):
+        return not_modified(etag)
     try:
-        return {
-            "users": [
-                {
-                    "user_id": u["user_id"], 
-                    "name": u["name"],
-                    "email": u.get("email", ""),
-                    "city": u.get("city", ""),
-                    "current_title": u.get("current_title", ""),
-                    "has_career_objective": bool(u.get("career_objective"))
-                } for u in user_profiles
-            ],
-            "total_users": len(user_profiles)
-        }
+        users, next_cursor = await run_query(data, data.query_users, q=q, limit=limit, cursor=cursor)
+        return JSONResponse({
+            "users": [{k: v for k, v in user_summary(u).items() if k in selected} for u in users],
+            "total_users": await run_query(data, data.count_users),
+            "next_cursor": next_cursor
+        }, headers=cache_headers(etag))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         logger.error(f"Error fetching users: {str(e)}")
         raise HTTPException(status_code=500, detail="Internal server error occurred")
 
 @app.get("/jobs", tags=["Data"])
+@app.get("/jobs/search", tags=["Data"])
 @limiter.limit("30/minute")
-async def get_jobs(request: Request):
+async def get_jobs(
+    request: Request,
+    q: Optional[str] = Query(None, description="Full-text search over title and description"),
+    category: Optional[str] = None,
+    contract_type: Optional[str] = None,
+    location: Optional[str] = Query(None, description="Substring of the job location"),
+    salary_min: Optional[float] = Query(None, ge=0, description="Jobs paying at least this"),
+    salary_max: Optional[float] = Query(None, ge=0, description="Jobs starting at or below this"),
+    fields: Optional[str] = Query(None, description=f"Comma-separated subset of: {', '.join(JOB_FIELDS)}"),
+    limit: int = Query(100, ge=1, le=500),
+    cursor: Optional[str] = Query(None, description="next_cursor from the previous page"),
+):
+    selected = parse_fields(fields, JOB_FIELDS, DEFAULT_JOB_FIELDS)
+    data = data_store.dataset
+    etag = dataset_etag(request, data.version)
+    if etag_matches(request, etag):
+        return not_modified(etag)
+    filters = JobFilters(q, category, contract_type, location, salary_min, salary_max)
     try:
-        return {
-            "jobs": [
-                {
-                    "job_id": j.get("id"), 
-                    "title": j.get("title"), 
-                    "company": j.get("company_name"),
-                    "location": j.get("location", ""),
-                    "type": j.get("type", "")
-                } for j in jobs
-            ],
-            "total_jobs": len(jobs)
-        }
+        jobs, next_cursor = await run_query(data, data.query_jobs, filters, limit=limit, cursor=cursor)
+        return JSONResponse({
+            "jobs": [{k: v for k, v in job_summary(j).items() if k in selected} for j in jobs],
+            "total_jobs": await run_query(data, data.count_jobs),
+            "next_cursor": next_cursor
+        }, headers=cache_headers(etag))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         logger.error(f"Error fetching jobs: {str(e)}")
         raise HTTPException(status_code=500, detail="Internal server error occurred")
@@ -0,0 +1,199 @@
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional
+from uuid import UUID
+
+import ollama
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.outputs import LLMResult
+
+logger = logging.getLogger(__name__)
+
+OLLAMA_BASE_URL = os.getenv("OLLAMA_BASE_URL", "http://localhost:11434")
+# How long Ollama keeps a model resident after the last request ("30m", "24h", "-1m" for forever).
+OLLAMA_KEEP_ALIVE = os.getenv("OLLAMA_KEEP_ALIVE", "30m")
+OLLAMA_PRELOAD_MODELS = [m.strip() for m in os.getenv("OLLAMA_PRELOAD_MODELS", "llama3.1:latest").split(",") if m.strip()]
+# Context size models are loaded with; requests use it too (see `num_ctx_for`).
+OLLAMA_PRELOAD_NUM_CTX = int(os.getenv("OLLAMA_PRELOAD_NUM_CTX", "4096"))
+OLLAMA_WARM_CHECK_SECONDS = float(os.getenv("OLLAMA_WARM_CHECK_SECONDS", "60"))
+
+# Models whose raised num_ctx pin is remembered; the least recently used falls back to the preload size.
+OLLAMA_MAX_PINNED_MODELS = 64
+
+# A load that takes longer than this is counted as a cold start.
+COLD_START_THRESHOLD_SECONDS = 1.0
+
+
+class OllamaModelManager:
+    """Preloads Ollama models and keeps them resident.
+
+    A daemon thread loads every configured model at startup, then checks
+    `/api/ps` periodically and reloads any model that is no longer resident
+    (idle eviction or an Ollama restart). Each load slower than
+    COLD_START_THRESHOLD_SECONDS is counted as a cold start, whether it was
+    the manager's or a request's (see `LoadCallback`).
+
+    Ollama reloads a model whenever a request asks for another num_ctx, so
+    each model is pinned to one context size: the preload size, raised to a
+    larger bucket the first time a prompt needs one and never lowered.
+    Requests and re-warms both use the pinned size.
+    """
+
+    def __init__(
+        self,
+        models: Optional[List[str]] = None,
+        base_url: str = OLLAMA_BASE_URL,
+        keep_alive: str = OLLAMA_KEEP_ALIVE,
+        check_interval: float = OLLAMA_WARM_CHECK_SECONDS,
+        num_ctx: int = OLLAMA_PRELOAD_NUM_CTX,
+    ):
+        self.models = list(models if models is not None else OLLAMA_PRELOAD_MODELS)
+        self.keep_alive = keep_alive
+        self.check_interval = check_interval
+        self.num_ctx = num_ctx
+        self.client = ollama.Client(host=base_url, timeout=300)
+
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+        self._num_ctx: "OrderedDict[str, int]" = OrderedDict()  # model -> pinned context size above num_ctx
+
+        self.server_available = False
+        self.cold_starts = 0
+        self.cold_starts_by_reason: Dict[str, int] = {}
+        self.rewarms = 0
+        self.load_seconds_total = 0.0
+        self.last_cold_start: Optional[Dict] = None
+        self.last_check_at: Optional[float] = None
+
+    def num_ctx_for(self, model: str, num_ctx: int = 0) -> int:
+        """The context size to load `model` with, given that a prompt needs `num_ctx`; raises the pin if needed."""
+        with self._lock:
+            pinned = self._num_ctx.get(model, self.num_ctx)
+            if num_ctx > pinned:
+                logger.info(f"Pinning Ollama model {model} to num_ctx={num_ctx} (was {pinned})")
+                pinned = num_ctx
+            if pinned > self.num_ctx:
+                self._num_ctx[model] = pinned
+                self._num_ctx.move_to_end(model)
+                while len(self._num_ctx) > OLLAMA_MAX_PINNED_MODELS:
+                    self._num_ctx.popitem(last=False)
+            return pinned
+
+    def record_load(self, model: str, load_seconds: float, reason: str):
+        """Count a model load reported by Ollama's `load_duration`."""
+        with self._lock:
+            self.load_seconds_total += load_seconds
+            if load_seconds >= COLD_START_THRESHOLD_SECONDS:
+                self.cold_starts += 1
+                self.cold_starts_by_reason[reason] = self.cold_starts_by_reason.get(reason, 0) + 1
+                self.last_cold_start = {
+                    "model": model,
+                    "reason": reason,
+                    "load_seconds": round(load_seconds, 3),
+                    "at": time.time(),
+                }
+
+    def preload(self, model: str, reason: str = "startup") -> bool:
+        """Load a model into memory with the configured keep_alive and its pinned num_ctx."""
+        start = time.perf_counter()
+        try:
+            response = self.client.generate(
+                model=model,
+                prompt="",
+                keep_alive=self.keep_alive,
+                options={"num_ctx": self.num_ctx_for(model)},
+            )
+        except Exception as e:
+            logger.warning(f"Failed to preload Ollama model {model}: {e}")
+            return False
+
+        load_seconds = (getattr(response, "load_duration", None) or 0) / 1e9
+        elapsed = time.perf_counter() - start
+        self.record_load(model, load_seconds, reason)
+        logger.info(f"Ollama model {model} warm ({reason}) after {elapsed:.2f}s, load {load_seconds:.2f}s")
+        return True
+
+    def resident_models(self) -> List[str]:
+        response = self.client.ps()
+        return [m.model for m in response.models]
+
+    def check(self):
+        """Reload any configured model that Ollama no longer has resident."""
+        self.last_check_at = time.time()
+        try:
+            resident = self.resident_models()
+        except Exception as e:
+            if self.server_available:
+                logger.warning(f"Ollama server unreachable: {e}")
+            self.server_available = False
+            return
+
+        reason = "rewarm" if self.server_available else "server_restart"
+        self.server_available = True
+        for model in self.models:
+            if model not in resident and self.preload(model, reason=reason):
+                with self._lock:
+                    self.rewarms += 1
+
+    def _run(self):
+        for model in self.models:
+            self.server_available = self.preload(model) or self.server_available
+        while not self._stop.wait(self.check_interval):
+            self.check()
+
+    def start(self):
+        if self._thread is not None or not self.models:
+            return
+        self._thread = threading.Thread(target=self._run, name="ollama-warmer", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def snapshot(self) -> Dict:
+        with self._lock:
+            return {
+                "models": self.models,
+                "keep_alive": self.keep_alive,
+                "server_available": self.server_available,
+                "cold_starts": self.cold_starts,
+                "cold_starts_by_reason": dict(self.cold_starts_by_reason),
+                "num_ctx": self.num_ctx,
+                "raised_num_ctx": dict(self._num_ctx),
+                "rewarms": self.rewarms,
+                "load_seconds_total": round(self.load_seconds_total, 3),
+                "last_cold_start": self.last_cold_start,
+                "last_check_at": self.last_check_at,
+            }
+
+
+class LoadCallback(BaseCallbackHandler):
+    """LangChain callback that reports the `load_duration` of Ollama responses to the model manager.
+
+    A request that finds its model unloaded (evicted, or asked for with
+    another num_ctx) pays the load itself; this counts it as a cold start.
+    """
+
+    run_inline = True
+
+    def __init__(self, model: str, manager: Optional["OllamaModelManager"] = None):
+        self.model = model
+        self.manager = manager
+
+    def on_llm_end(self, response: LLMResult, *, run_id: UUID, **kwargs):
+        generation = response.generations[0][0] if response.generations and response.generations[0] else None
+        if generation is None:
+            return
+        info = generation.generation_info or {}
+        message = getattr(generation, "message", None)
+        load_duration = info.get("load_duration") or (getattr(message, "response_metadata", None) or {}).get("load_duration")
+        if load_duration:
+            (self.manager or model_manager).record_load(self.model, load_duration / 1e9, "request")
+
+
+model_manager = OllamaModelManager()
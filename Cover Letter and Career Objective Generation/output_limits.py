@@ -0,0 +1,84 @@
+import logging
+import math
+import threading
+from typing import Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+# Tokens per word of English prose with names, numbers and punctuation
+# (Llama 3 and OpenAI tokenizers), for turning a format's length into tokens.
+TOKENS_PER_WORD = 1.4
+# Room above the format's length before a generation counts as a runaway
+CEILING_HEADROOM = 1.5
+
+# Text that only follows a finished document: notes about it, a new example
+# in the few-shot format, a separator. OpenAI takes at most four sequences.
+TRAILER_STOP_SEQUENCES = ["\n\nNote:", "\n---", "\nExample", "\nJob Title:"]
+
+# Reasons the backends give for a generation that hit its token ceiling
+_LENGTH_REASONS = {"length", "max_tokens"}
+
+
+def token_ceiling(words: int) -> int:
+    """Output token ceiling for a document of about `words` words."""
+    return math.ceil(words * TOKENS_PER_WORD * CEILING_HEADROOM)
+
+
+def finish_reason(result) -> str:
+    """Why the generation ended ("stop", "length", ...); OpenAI calls it finish_reason, Ollama done_reason."""
+    metadata = getattr(result, "response_metadata", None) or {}
+    return metadata.get("finish_reason") or metadata.get("done_reason") or ""
+
+
+class OutputStats:
+    """Thread-safe per-endpoint counts of generations cut off at their output token ceiling."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._endpoints: Dict[str, Dict] = {}
+
+    def _stats(self, name: str, max_tokens: int) -> Dict:
+        return self._endpoints.setdefault(name, {
+            "max_tokens": max_tokens,
+            "calls": 0,
+            "truncated": 0,
+            "trimmed": 0,
+        })
+
+    def record(self, name: str, result, max_tokens: int, reason: Optional[str] = None) -> bool:
+        """Count one finished generation; returns whether it hit the ceiling.
+
+        Chunks without a finish reason (all but the last of a stream) are
+        skipped; `reason` stands in for one when the caller ended the
+        stream itself.
+        """
+        reason = reason or finish_reason(result)
+        if not reason:
+            return False
+        truncated = reason in _LENGTH_REASONS
+        if truncated:
+            logger.warning(f"{name} generation hit its {max_tokens}-token ceiling")
+        with self._lock:
+            stats = self._stats(name, max_tokens)
+            stats["max_tokens"] = max_tokens  # batches vary with their size; the last one's
+            stats["calls"] += 1
+            stats["truncated"] += int(truncated)
+        return truncated
+
+    def record_trim(self, name: str, max_tokens: int):
+        """Count a generation that ran on past its end and had the extra text cut off."""
+        with self._lock:
+            self._stats(name, max_tokens)["trimmed"] += 1
+
+    def snapshot(self) -> Dict[str, Dict]:
+        with self._lock:
+            return {
+                name: {
+                    **stats,
+                    "truncation_rate": round(stats["truncated"] / stats["calls"], 3) if stats["calls"] else None,
+                }
+                for name, stats in self._endpoints.items()
+            }
+
+
+output_stats = OutputStats()
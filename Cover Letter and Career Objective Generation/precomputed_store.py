@@ -0,0 +1,180 @@
+import atexit
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, Iterable, Optional, Tuple
+
+from result_cache import record_hash
+
+logger = logging.getLogger(__name__)
+
+# Entries kept in memory per store; the rest are read back from its SQLite file.
+PRECOMPUTED_CACHE_ENTRIES = int(os.getenv("PRECOMPUTED_CACHE_ENTRIES", "2000"))
+# How often entries built by requests are written to the file.
+PRECOMPUTED_FLUSH_SECONDS = float(os.getenv("PRECOMPUTED_FLUSH_SECONDS", "5"))
+PRECOMPUTE_BATCH_SIZE = 500
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    id TEXT PRIMARY KEY,
+    hash TEXT NOT NULL,
+    text TEXT NOT NULL
+);
+"""
+
+
+class PrecomputedStore:
+    """Texts derived from data records, persisted to SQLite keyed by record id and content hash.
+
+    An entry is built the first time its record is seen and rebuilt only
+    when the record (or `version`) changes, so the derived text is computed
+    once per record rather than once per request. The most recently used
+    entries are kept in memory; entries built by requests are written in
+    batches by a background thread (and at exit), so a request never
+    waits on a write.
+    """
+
+    def __init__(self, path: str, build: Callable[[Dict], str], id_field: str, version: str = "1",
+                 max_entries: int = PRECOMPUTED_CACHE_ENTRIES, flush_seconds: float = PRECOMPUTED_FLUSH_SECONDS):
+        self.path = path
+        self.build = build
+        self.id_field = id_field
+        self.version = version
+        self.max_entries = max_entries
+        self.flush_seconds = flush_seconds
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._entries: "OrderedDict[str, Tuple[str, str]]" = OrderedDict()  # id -> (hash, text)
+        self._pending: Dict[str, Tuple[str, str]] = {}
+        self._local = threading.local()
+        self._flusher: Optional[threading.Thread] = None
+        self.hits = 0
+        self.builds = 0
+        self.flush_errors = 0
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10)
+            conn.executescript(SCHEMA)
+            self._local.conn = conn
+        return conn
+
+    def content_hash(self, record: Dict) -> str:
+        return f"{self.version}:{record_hash(record)}"
+
+    def _remember(self, record_id: str, entry: Tuple[str, str]):
+        """Keep an entry in memory, evicting the least recently used. Must hold the lock."""
+        self._entries[record_id] = entry
+        self._entries.move_to_end(record_id)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def _lookup(self, record_id: str, content_hash: str, remember: bool = True) -> Optional[str]:
+        with self._lock:
+            entry = self._entries.get(record_id) or self._pending.get(record_id)
+        if entry is None:
+            try:
+                row = self._conn().execute("SELECT hash, text FROM entries WHERE id = ?", (record_id,)).fetchone()
+            except sqlite3.Error as e:
+                logger.warning(f"Could not read {self.path}: {str(e)}")
+                row = None
+            entry = tuple(row) if row else None
+        if entry is None or entry[0] != content_hash:
+            return None
+        if remember:
+            with self._lock:
+                self._remember(record_id, entry)
+        return entry[1]
+
+    def cached(self, record: Dict) -> Optional[str]:
+        """The entry for `record` if it is in memory and current; never touches the file."""
+        record_id, content_hash = str(record.get(self.id_field)), self.content_hash(record)
+        with self._lock:
+            entry = self._entries.get(record_id) or self._pending.get(record_id)
+            if entry is None or entry[0] != content_hash:
+                return None
+            self._remember(record_id, entry)
+            self.hits += 1
+        return entry[1]
+
+    def get(self, record: Dict) -> str:
+        record_id, content_hash = str(record.get(self.id_field)), self.content_hash(record)
+        text = self._lookup(record_id, content_hash)
+        if text is not None:
+            self.hits += 1
+            return text
+        text = self.build(record)
+        with self._lock:
+            self.builds += 1
+            self._remember(record_id, (content_hash, text))
+            self._pending[record_id] = (content_hash, text)
+            if self._flusher is None:
+                self._start_flusher()
+        return text
+
+    def _start_flusher(self):
+        self._flusher = threading.Thread(target=self._flush_loop, name="precomputed-flusher", daemon=True)
+        self._flusher.start()
+        atexit.register(self.flush)
+
+    def _flush_loop(self):
+        while True:
+            time.sleep(self.flush_seconds)
+            self.flush()
+
+    def _write(self, entries: Dict[str, Tuple[str, str]]):
+        conn = self._conn()
+        with conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO entries VALUES (?, ?, ?)",
+                [(record_id, content_hash, text) for record_id, (content_hash, text) in entries.items()],
+            )
+
+    def flush(self):
+        """Write the entries built since the last flush; on failure they are kept for the next one."""
+        with self._flush_lock:
+            with self._lock:
+                pending, self._pending = self._pending, {}
+            if not pending:
+                return
+            try:
+                self._write(pending)
+            except sqlite3.Error as e:
+                logger.warning(f"Could not save {self.path}: {str(e)}")
+                self.flush_errors += 1
+                with self._lock:
+                    self._pending = {**pending, **self._pending}
+
+    def precompute(self, records: Iterable[Dict]) -> int:
+        """Build every missing or stale entry, writing them in batches; for threads, not the event loop."""
+        built = 0
+        batch: Dict[str, Tuple[str, str]] = {}
+        for record in records:
+            record_id, content_hash = str(record.get(self.id_field)), self.content_hash(record)
+            if self._lookup(record_id, content_hash, remember=False) is not None:
+                continue
+            batch[record_id] = (content_hash, self.build(record))
+            built += 1
+            if len(batch) >= PRECOMPUTE_BATCH_SIZE:
+                self._write(batch)
+                batch = {}
+        if batch:
+            self._write(batch)
+        with self._lock:
+            self.builds += built
+        return built
+
+    def snapshot(self) -> Dict:
+        with self._lock:
+            return {
+                "cached": len(self._entries),
+                "max_cached": self.max_entries,
+                "pending_writes": len(self._pending),
+                "hits": self.hits,
+                "builds": self.builds,
+                "flush_errors": self.flush_errors,
+            }
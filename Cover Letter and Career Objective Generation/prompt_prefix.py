@@ -0,0 +1,86 @@
+import hashlib
+import logging
+import threading
+from typing import Dict
+
+from langchain_core.prompts import ChatPromptTemplate, PromptTemplate
+
+from prompt_compaction import count_tokens
+
+logger = logging.getLogger(__name__)
+
+
+def build_prompt(prefix: str, fields: str) -> ChatPromptTemplate:
+    """A chat prompt whose system message is the static `prefix`.
+
+    The prefix must not contain template variables. That makes it
+    byte-identical on every call, so OpenAI's prompt cache and Ollama's KV
+    cache can reuse it instead of prefilling it again.
+    """
+    variables = PromptTemplate.from_template(prefix).input_variables
+    if variables:
+        raise ValueError(f"Static prompt prefix must not contain template variables: {variables}")
+    return ChatPromptTemplate.from_messages([("system", prefix), ("human", fields)])
+
+
+def prefix_key(prefix: str) -> str:
+    """Stable id of a prefix; sent as OpenAI's `prompt_cache_key` so calls sharing it hit the same cache."""
+    return hashlib.sha1(prefix.encode()).hexdigest()[:16]
+
+
+class PrefixStats:
+    """Thread-safe prompt-cache totals per prompt prefix."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._prefixes: Dict[str, Dict] = {}
+
+    def record(self, name: str, prompt: ChatPromptTemplate, inputs: Dict[str, str], result):
+        """Count one call's prompt and cached tokens; calls without usage data are skipped.
+
+        OpenAI reports cached tokens as `cache_read`. Ollama reports how many
+        prompt tokens it evaluated (`prompt_eval_count`), so the reused part
+        is estimated against the local token count of the whole prompt.
+        """
+        usage = getattr(result, "usage_metadata", None) or {}
+        metadata = getattr(result, "response_metadata", None) or {}
+        if "input_token_details" in usage:
+            prompt_tokens = usage["input_tokens"]
+            cached = usage["input_token_details"].get("cache_read") or 0
+        elif metadata.get("prompt_eval_count") is not None:
+            prompt_tokens = count_tokens(prompt.format(**inputs))
+            cached = min(max(prompt_tokens - metadata["prompt_eval_count"], 0), prompt_tokens)
+        else:
+            return
+        prefill_ns = metadata.get("prompt_eval_duration")
+        prefix = prompt.messages[0].prompt.template
+        with self._lock:
+            stats = self._prefixes.setdefault(name, {
+                "prefix_key": prefix_key(prefix),
+                "prefix_tokens": count_tokens(prefix),
+                "calls": 0,
+                "hits": 0,
+                "prompt_tokens": 0,
+                "cached_tokens": 0,
+                "prefill_ms": 0.0,
+            })
+            stats["calls"] += 1
+            stats["hits"] += int(cached >= stats["prefix_tokens"] // 2)
+            stats["prompt_tokens"] += prompt_tokens
+            stats["cached_tokens"] += cached
+            stats["prefill_ms"] += (prefill_ns or 0) / 1e6
+
+    def snapshot(self) -> Dict[str, Dict]:
+        with self._lock:
+            return {
+                name: {
+                    **stats,
+                    "prefill_ms": round(stats["prefill_ms"], 1),
+                    "hit_rate": round(stats["hits"] / stats["calls"], 3) if stats["calls"] else None,
+                    "cached_token_share": round(stats["cached_tokens"] / stats["prompt_tokens"], 3) if stats["prompt_tokens"] else None,
+                }
+                for name, stats in self._prefixes.items()
+            }
+
+
+prefix_stats = PrefixStats()
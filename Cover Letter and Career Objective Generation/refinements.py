@@ -0,0 +1,108 @@
+import asyncio
+import logging
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Awaitable, Dict, Optional
+
+from llm_limiter import LLMOverloadedError
+
+logger = logging.getLogger(__name__)
+
+# How long a finished refinement can still be polled, and how many are kept.
+REFINEMENT_TTL_SECONDS = float(os.getenv("REFINEMENT_TTL_SECONDS", "900"))
+REFINEMENT_MAX_ENTRIES = int(os.getenv("REFINEMENT_MAX_ENTRIES", "1000"))
+
+STATUSES = ("pending", "ready", "shed", "failed")
+
+
+@dataclass
+class Refinement:
+    """The LLM-polished version of a template draft, as far as it has got."""
+
+    draft: str
+    status: str = "pending"  # one of STATUSES
+    text: Optional[str] = None  # the polished letter once ready
+    retry_after: Optional[int] = None  # set when the LLM work was shed
+    created: float = field(default_factory=time.time)
+    task: Optional[asyncio.Task] = field(default=None, repr=False)
+
+
+class RefinementStore:
+    """Background LLM refinements of template drafts, polled by id.
+
+    Each refinement runs as its own task, detached from the request that
+    started it, so the client can leave and poll later. A refinement shed
+    by the LLM limiter ends as "shed" and the draft stays the answer.
+    Entries live in this worker's memory; the oldest are evicted past
+    REFINEMENT_MAX_ENTRIES, and a pending one is cancelled when evicted.
+    """
+
+    def __init__(self, max_entries: int = REFINEMENT_MAX_ENTRIES, ttl: float = REFINEMENT_TTL_SECONDS):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[str, Refinement]" = OrderedDict()
+        self.counts: Dict[str, int] = {status: 0 for status in STATUSES}
+
+    def start(self, draft: str, generation: Awaitable[str]) -> str:
+        """Run `generation` in the background and return the id to poll."""
+        refinement_id = uuid.uuid4().hex
+        entry = Refinement(draft=draft)
+        with self._lock:
+            self._evict()
+            self._entries[refinement_id] = entry
+            self.counts["pending"] += 1
+        entry.task = asyncio.ensure_future(self._run(entry, generation))
+        return refinement_id
+
+    async def _run(self, entry: Refinement, generation: Awaitable[str]):
+        try:
+            text = await generation
+            if text.startswith("❌"):
+                self._finish(entry, "failed")
+            else:
+                entry.text = text
+                self._finish(entry, "ready")
+        except LLMOverloadedError as e:
+            entry.retry_after = e.retry_after
+            self._finish(entry, "shed")
+        except asyncio.CancelledError:
+            self._finish(entry, "failed")
+            raise
+        except Exception as e:
+            logger.error(f"Refinement failed: {str(e)}")
+            self._finish(entry, "failed")
+
+    def _finish(self, entry: Refinement, status: str):
+        with self._lock:
+            entry.status = status
+            self.counts["pending"] -= 1
+            self.counts[status] += 1
+
+    def _evict(self):
+        now = time.time()
+        while self._entries:
+            oldest_id, oldest = next(iter(self._entries.items()))
+            if len(self._entries) < self.max_entries and (not self.ttl or now - oldest.created <= self.ttl):
+                break
+            del self._entries[oldest_id]
+            if oldest.task is not None and not oldest.task.done():
+                oldest.task.cancel()
+
+    def get(self, refinement_id: str) -> Optional[Refinement]:
+        with self._lock:
+            entry = self._entries.get(refinement_id)
+        if entry is None or (self.ttl and time.time() - entry.created > self.ttl):
+            return None
+        return entry
+
+    def snapshot(self) -> Dict:
+        with self._lock:
+            return {"entries": len(self._entries), "max_entries": self.max_entries, **self.counts}
+
+
+refinement_store = RefinementStore()
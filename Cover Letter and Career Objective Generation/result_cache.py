@@ -0,0 +1,87 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+RESULT_CACHE_SIZE = int(os.getenv("RESULT_CACHE_SIZE", "1024"))
+# Seconds a generated text stays valid (0 keeps it until evicted or its inputs change).
+RESULT_CACHE_TTL_SECONDS = float(os.getenv("RESULT_CACHE_TTL_SECONDS", "0"))
+
+ResultKey = Tuple[str, ...]
+
+
+def record_hash(*records: Dict) -> str:
+    """Content hash of the records a generation was built from."""
+    return hashlib.sha1(json.dumps(records, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def result_key(endpoint: str, agent, user: Dict, job: Dict, *extra: str) -> ResultKey:
+    """Cache key for a quick generation.
+
+    Includes a hash of the user and job records, so editing either one in
+    the data files misses the cache without any explicit invalidation.
+    """
+    return (
+        endpoint,
+        str(user.get("user_id")),
+        str(job.get("id")),
+        agent.llm_name,
+        agent.model_name,
+        str(agent.temperature),
+        record_hash(user, job),
+        *extra,
+    )
+
+
+class ResultCache:
+    """Thread-safe LRU cache of generated texts."""
+
+    def __init__(self, max_entries: int = RESULT_CACHE_SIZE, ttl: float = RESULT_CACHE_TTL_SECONDS):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[ResultKey, Tuple[str, float]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.regenerations = 0
+
+    def get(self, key: ResultKey) -> Optional[str]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and self.ttl and time.time() - entry[1] > self.ttl:
+                del self._entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key: ResultKey, value: str, regenerated: bool = False):
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            self.regenerations += int(regenerated)
+            self._entries[key] = (value, time.time())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def snapshot(self) -> Dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 3) if lookups else None,
+                "regenerations": self.regenerations,
+            }
+
+
+result_cache = ResultCache()
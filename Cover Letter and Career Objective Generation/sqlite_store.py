@@ -0,0 +1,406 @@
+import argparse
+import codecs
+import hashlib
+import json
+import logging
+import os
+import queue
+import sqlite3
+import weakref
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+from data_store import (
+    DATA_RELOAD_SECONDS,
+    JOBS_FILE,
+    SQLITE_PATH,
+    USERS_FILE,
+    DataStore,
+    JobFilters,
+    decode_cursor,
+    encode_cursor,
+    parse_salary,
+    query_terms,
+)
+from result_cache import record_hash
+
+logger = logging.getLogger(__name__)
+
+# Rows per INSERT batch while importing; with the streaming reader this
+# bounds import memory regardless of file size.
+IMPORT_BATCH_SIZE = 1000
+READ_CHUNK_BYTES = 1 << 16
+# Connections per dataset snapshot, i.e. how many of its queries run at once.
+SQLITE_READ_CONNECTIONS = int(os.getenv("SQLITE_READ_CONNECTIONS", "4"))
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE IF NOT EXISTS users (
+    user_id TEXT NOT NULL UNIQUE,
+    cv_text TEXT,
+    data TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT NOT NULL UNIQUE,
+    title TEXT,
+    description TEXT,
+    category TEXT COLLATE NOCASE,
+    contract_type TEXT COLLATE NOCASE,
+    location TEXT,
+    salary_min REAL,
+    salary_max REAL,
+    data TEXT NOT NULL,
+    hash TEXT,
+    digest TEXT
+);
+CREATE INDEX IF NOT EXISTS jobs_category ON jobs (category);
+CREATE INDEX IF NOT EXISTS jobs_contract_type ON jobs (contract_type);
+CREATE INDEX IF NOT EXISTS jobs_salary_min ON jobs (salary_min);
+CREATE INDEX IF NOT EXISTS jobs_salary_max ON jobs (salary_max);
+CREATE VIRTUAL TABLE IF NOT EXISTS users_fts USING fts5(cv_text, content='users', content_rowid='rowid');
+CREATE VIRTUAL TABLE IF NOT EXISTS jobs_fts USING fts5(title, description, content='jobs', content_rowid='rowid');
+"""
+
+
+def iter_json_array(path: str, digest=None) -> Iterator[Dict]:
+    """Yield the objects of a top-level JSON array without loading the whole file.
+
+    The raw bytes read are fed to `digest` (a hashlib object) when given.
+    """
+    decoder = json.JSONDecoder()
+    with open(path, "rb") as f:
+        text = codecs.getincrementaldecoder("utf-8")()
+
+        def read() -> str:
+            raw = f.read(READ_CHUNK_BYTES)
+            if digest is not None:
+                digest.update(raw)
+            return text.decode(raw, final=not raw)
+
+        buffer = read()
+        while buffer and not buffer.strip():
+            buffer = read()
+        buffer = buffer.lstrip()
+        if not buffer.startswith("["):
+            raise ValueError(f"{path} must contain a JSON array")
+        pos = 1
+        while True:
+            while pos < len(buffer) and (buffer[pos].isspace() or buffer[pos] == ","):
+                pos += 1
+            if pos < len(buffer) and buffer[pos] == "]":
+                while read():
+                    pass  # hash the rest of the file
+                return
+            try:
+                if pos == len(buffer):
+                    raise json.JSONDecodeError("need more data", buffer, pos)
+                record, pos = decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                more = read()
+                if not more:
+                    raise ValueError(f"{path}: invalid or truncated JSON array")
+                buffer, pos = buffer[pos:] + more, 0
+                continue
+            if not isinstance(record, dict):
+                raise ValueError(f"{path} must contain a JSON array of objects")
+            yield record
+
+
+def _close_all(connections: List[sqlite3.Connection]):
+    for conn in connections:
+        conn.close()
+
+
+def _fts_query(q: Optional[str]) -> Optional[str]:
+    """Every term must match, as a prefix so "develop" finds "developer"."""
+    terms = query_terms(q)
+    return " ".join(f'"{term}"*' for term in terms) if terms else None
+
+
+class SQLiteDataset:
+    """Read-only snapshot of the SQLite store with the same query API as Dataset.
+
+    Its connections are opened together when the store publishes it, each
+    inside a read transaction. The database runs in WAL mode, so they keep
+    seeing the rows as of that moment: a later re-import does not change
+    what an older dataset returns, matching its `version`. Queries wait on
+    disk, so `blocking` tells async callers to use `run_query`. The
+    connections are closed once the store has replaced the dataset and no
+    request holds it any more.
+    """
+
+    blocking = True
+
+    def __init__(self, path: str, version: str, connections: int = SQLITE_READ_CONNECTIONS):
+        self.path = path
+        self.version = version
+        self._pool: "queue.Queue[sqlite3.Connection]" = queue.Queue()
+        opened = []
+        for _ in range(max(1, connections)):
+            conn = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+            conn.execute("BEGIN")
+            conn.execute("SELECT count(*) FROM meta").fetchone()  # starts the read transaction
+            opened.append(conn)
+            self._pool.put(conn)
+        self._finalizer = weakref.finalize(self, _close_all, opened)
+
+    @contextmanager
+    def _conn(self) -> Iterator[sqlite3.Connection]:
+        conn = self._pool.get()
+        try:
+            yield conn
+        finally:
+            self._pool.put(conn)
+
+    def _fetch(self, sql: str, params, one: bool = False):
+        with self._conn() as conn:
+            cursor = conn.execute(sql, params)
+            return cursor.fetchone() if one else cursor.fetchall()
+
+    def _one(self, sql: str, params: Tuple) -> Optional[Dict]:
+        row = self._fetch(sql, params, one=True)
+        return json.loads(row[0]) if row else None
+
+    def user(self, user_id: str) -> Optional[Dict]:
+        return self._one("SELECT data FROM users WHERE user_id = ?", (user_id,))
+
+    def job(self, job_id: str) -> Optional[Dict]:
+        return self._one("SELECT data FROM jobs WHERE id = ?", (job_id,))
+
+    def job_digest(self, job: Dict) -> Optional[str]:
+        """The digest stored next to this job, or None if it has none or the job changed since."""
+        row = self._fetch(
+            "SELECT digest FROM jobs WHERE id = ? AND hash = ?", (str(job.get("id")), record_hash(job)), one=True
+        )
+        return row[0] if row else None
+
+    def count_users(self) -> int:
+        return self._fetch("SELECT count(*) FROM users", (), one=True)[0]
+
+    def count_jobs(self) -> int:
+        return self._fetch("SELECT count(*) FROM jobs", (), one=True)[0]
+
+    def _page(self, table: str, fts_table: str, match: Optional[str], where: List[str], params: List,
+              limit: Optional[int], cursor: Optional[str]) -> Tuple[List[Dict], Optional[str]]:
+        """Keyset pagination by rowid, or offset pagination in rank order for text searches."""
+        kind, position = decode_cursor(cursor)
+        where, params = list(where), list(params)
+        if match:
+            sql = f"SELECT t.rowid, t.data FROM {fts_table} JOIN {table} t ON t.rowid = {fts_table}.rowid"
+            where.insert(0, f"{fts_table} MATCH ?")
+            params.insert(0, match)
+            order, offset = f"{fts_table}.rank", max(position, 0) if kind == "o" else 0
+        else:
+            sql = f"SELECT t.rowid, t.data FROM {table} t"
+            if kind == "k" and position >= 0:
+                where.append("t.rowid > ?")
+                params.append(position)
+            order, offset = "t.rowid", 0
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += f" ORDER BY {order} LIMIT ? OFFSET ?"
+        params += [-1 if limit is None else limit + 1, offset]
+
+        rows = self._fetch(sql, params)
+        next_cursor = None
+        if limit is not None and len(rows) > limit:
+            rows = rows[:limit]
+            next_cursor = encode_cursor("o", offset + limit) if match else encode_cursor("k", rows[-1][0])
+        return [json.loads(data) for _, data in rows], next_cursor
+
+    def query_users(self, q: Optional[str] = None, limit: Optional[int] = None, cursor: Optional[str] = None) -> Tuple[List[Dict], Optional[str]]:
+        return self._page("users", "users_fts", _fts_query(q), [], [], limit, cursor)
+
+    def query_jobs(self, filters: JobFilters = JobFilters(), limit: Optional[int] = None, cursor: Optional[str] = None) -> Tuple[List[Dict], Optional[str]]:
+        where, params = [], []
+        if filters.category:
+            where.append("t.category = ?")
+            params.append(filters.category)
+        if filters.contract_type:
+            where.append("t.contract_type = ?")
+            params.append(filters.contract_type)
+        if filters.location:
+            where.append("t.location LIKE ?")
+            params.append(f"%{filters.location}%")
+        if filters.salary_min is not None:
+            where.append("COALESCE(t.salary_max, t.salary_min) >= ?")
+            params.append(filters.salary_min)
+        if filters.salary_max is not None:
+            where.append("COALESCE(t.salary_min, t.salary_max) <= ?")
+            params.append(filters.salary_max)
+        return self._page("jobs", "jobs_fts", _fts_query(filters.q), where, params, limit, cursor)
+
+
+def _user_row(user: Dict) -> Tuple:
+    return str(user.get("user_id")), user.get("cv_text", ""), json.dumps(user)
+
+
+def _job_row(job: Dict) -> Tuple:
+    return (
+        str(job.get("id")), job.get("title", ""), job.get("description", job.get("job_desc", "")),
+        job.get("category"), job.get("contract_type"), job.get("location", ""),
+        parse_salary(job.get("salary_min")), parse_salary(job.get("salary_max")), json.dumps(job), record_hash(job),
+    )
+
+
+IMPORTS = {
+    "users": ("INSERT OR IGNORE INTO users (user_id, cv_text, data) VALUES (?, ?, ?)", _user_row),
+    "jobs": (
+        "INSERT OR IGNORE INTO jobs (id, title, description, category, contract_type, location, salary_min, salary_max, data,"
+        " hash) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+        _job_row,
+    ),
+}
+
+
+class SQLiteStore(DataStore):
+    """DataStore that serves users and jobs from SQLite with FTS5 indexes.
+
+    The JSON files are streamed into the database in batches, so neither
+    the import nor the workers ever hold a whole file in memory. When a
+    file changes, its table is re-imported in one transaction. A database prepared
+    offline with `python sqlite_store.py` is used as-is when the JSON
+    files are absent. Each published SQLiteDataset is a snapshot: requests
+    holding an older one keep reading its rows after a re-import.
+
+    Job digests are stored in the jobs table next to each job. A re-import
+    carries over the digests of unchanged jobs, so only new and changed
+    jobs are digested.
+    """
+
+    backend = "sqlite"
+
+    def __init__(self, path: str = SQLITE_PATH, users_path: str = USERS_FILE, jobs_path: str = JOBS_FILE,
+                 poll_interval: float = DATA_RELOAD_SECONDS):
+        self.path = path
+        with sqlite3.connect(path) as conn:
+            conn.execute("PRAGMA journal_mode = WAL")
+            conn.executescript(SCHEMA)
+            columns = {row[1] for row in conn.execute("PRAGMA table_info(jobs)")}
+            for column in ("hash", "digest"):
+                if column not in columns:  # a database from before digests were stored with the jobs
+                    conn.execute(f"ALTER TABLE jobs ADD COLUMN {column} TEXT")
+        super().__init__(users_path, jobs_path, poll_interval)
+
+    def _meta(self, conn: sqlite3.Connection, key: str) -> Optional[str]:
+        row = conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def _import(self, conn: sqlite3.Connection, table: str, path: str) -> int:
+        insert, to_row = IMPORTS[table]
+        digest = hashlib.sha1()
+        count = 0
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            if table == "jobs":
+                conn.execute("CREATE TEMP TABLE previous_digests AS SELECT id, hash, digest FROM jobs WHERE digest IS NOT NULL")
+            conn.execute(f"DELETE FROM {table}")
+            batch = []
+            for record in iter_json_array(path, digest):
+                batch.append(to_row(record))
+                if len(batch) >= IMPORT_BATCH_SIZE:
+                    conn.executemany(insert, batch)
+                    count += len(batch)
+                    batch = []
+            conn.executemany(insert, batch)
+            count += len(batch)
+            if table == "jobs":
+                conn.execute(
+                    "UPDATE jobs SET digest = (SELECT p.digest FROM previous_digests p WHERE p.id = jobs.id AND p.hash = jobs.hash)"
+                )
+                conn.execute("DROP TABLE previous_digests")
+            conn.execute(f"INSERT INTO {table}_fts({table}_fts) VALUES ('rebuild')")
+            conn.execute("INSERT OR REPLACE INTO meta VALUES (?, ?)", (f"hash:{table}", digest.hexdigest()))
+            conn.execute("INSERT OR REPLACE INTO meta VALUES (?, ?)", (f"source:{table}", repr(self._signature(path))))
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return count
+
+    def _fill_digests(self, conn: sqlite3.Connection):
+        """Digest the jobs that have no digest yet, a batch per transaction. Must hold the lock."""
+        if self._build_digest is None:
+            return
+        last = 0
+        while True:
+            rows = conn.execute(
+                "SELECT rowid, data FROM jobs WHERE digest IS NULL AND rowid > ? ORDER BY rowid LIMIT ?",
+                (last, IMPORT_BATCH_SIZE),
+            ).fetchall()
+            if not rows:
+                return
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                conn.executemany(
+                    "UPDATE jobs SET digest = ? WHERE rowid = ?",
+                    [(self._build_digest(json.loads(data)), rowid) for rowid, data in rows],
+                )
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            self.digests_built += len(rows)
+            last = rows[-1][0]
+
+    def build_job_digests(self, build: Callable[[Dict], str], version: str = "1"):
+        """Store `build(job)` next to every job that has no digest; digests of another `version` are rebuilt."""
+        with self._lock:
+            self._build_digest = build
+            conn = sqlite3.connect(self.path, isolation_level=None)
+            try:
+                if self._meta(conn, "digest_version") != version:
+                    conn.execute("UPDATE jobs SET digest = NULL")
+                    conn.execute("INSERT OR REPLACE INTO meta VALUES ('digest_version', ?)", (version,))
+                self._fill_digests(conn)
+            finally:
+                conn.close()
+            # The current snapshot predates the digests
+            self.dataset = SQLiteDataset(self.path, self.dataset.version)
+
+    def reload(self) -> SQLiteDataset:
+        """Re-import any JSON file that changed since it was last imported."""
+        with self._lock:
+            current = self.dataset
+            conn = sqlite3.connect(self.path, isolation_level=None)
+            try:
+                for table, path in (("users", self.users_path), ("jobs", self.jobs_path)):
+                    signature = self._signature(path)
+                    if signature is None or repr(signature) == self._meta(conn, f"source:{table}"):
+                        self._signatures[path] = signature
+                        continue
+                    try:
+                        count = self._import(conn, table, path)
+                    except (ValueError, OSError) as e:
+                        logger.error(f"Error importing {path}, keeping previous data: {str(e)}")
+                        continue
+                    self._signatures[path] = signature
+                    logger.info(f"Imported {count} {table} from {path} into {self.path}")
+                self._fill_digests(conn)
+                version = hashlib.sha1(
+                    f"{self._meta(conn, 'hash:users') or ''}:{self._meta(conn, 'hash:jobs') or ''}".encode()
+                ).hexdigest()[:16]
+            finally:
+                conn.close()
+            if version != self.dataset.version:
+                self.dataset = SQLiteDataset(self.path, version)
+                self.reloads += 1
+            dataset = self.dataset
+        if dataset is not current:
+            self._notify(dataset)
+        return dataset
+
+
+if __name__ == "__main__":
+    from job_digests import DIGEST_VERSION, JOB_DIGESTS, build_digest
+
+    parser = argparse.ArgumentParser(description="Import user_profiles.json and jobs.json into the SQLite store")
+    parser.add_argument("--db", default=SQLITE_PATH)
+    parser.add_argument("--users", default=USERS_FILE)
+    parser.add_argument("--jobs", default=JOBS_FILE)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    store = SQLiteStore(args.db, args.users, args.jobs, poll_interval=0)
+    if JOB_DIGESTS:
+        store.build_job_digests(build_digest, DIGEST_VERSION)
+    print(store.snapshot())
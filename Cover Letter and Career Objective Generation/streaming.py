@@ -0,0 +1,176 @@
+import asyncio
+import json
+import re
+import time
+from typing import AsyncIterator, Awaitable, Callable, Dict, Iterable, List, Optional, Union
+
+from llm_limiter import LLMOverloadedError
+from prompt_compaction import count_tokens
+
+# Chit-chat some models put before the actual text, e.g. "Sure! Here is a
+# tailored cover letter for the role:" or an echoed "Cover Letter:" label.
+# Only matched at the very start of the output and only up to a colon or
+# the end of the line.
+_PREAMBLE_RE = re.compile(
+    r"^(?:(?:sure|certainly|of course|absolutely|okay)\b[!,.]*\s*)?"
+    r"(?:here(?:'s| is| are)|below is|i(?:'ve| have) (?:written|drafted|crafted|prepared))\b[^\n:]{0,150}(?::[ \t]*|\n)"
+    r"|^(?:sure|certainly|of course|absolutely|okay)\b[!,.]*[ \t]*\n"
+    r"|^(?:cover letter|career objective)[ \t]*:[ \t]*",
+    re.IGNORECASE,
+)
+
+
+class PreambleStripper:
+    """Removes a leading preamble from streamed text without buffering the whole output.
+
+    Text is held back only until the first line is complete (or
+    `hold_chars` have arrived), which is enough to recognise a preamble;
+    everything after that passes straight through.
+    """
+
+    def __init__(self, hold_chars: int = 200):
+        self.hold_chars = hold_chars
+        self._buffer = ""
+        self._passthrough = False
+
+    def feed(self, chunk: str) -> str:
+        if self._passthrough:
+            return chunk
+        self._buffer += chunk
+        while True:
+            text = self._buffer.lstrip()
+            match = _PREAMBLE_RE.match(text)
+            if match and match.end():
+                self._buffer = text[match.end():]
+                continue
+            if "\n" in text or len(text) >= self.hold_chars:
+                self._passthrough = True
+                self._buffer = ""
+                return text
+            self._buffer = text
+            return ""
+
+    def flush(self) -> str:
+        """Whatever is still held back once the stream has ended."""
+        text, self._buffer, self._passthrough = self._buffer, "", True
+        return text.rstrip()
+
+
+def sse_event(event: str, data: Dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+async def stream_sse(
+    stream: AsyncIterator[str],
+    is_disconnected: Callable[[], Awaitable[bool]],
+    poll_interval: float = 0.5,
+) -> AsyncIterator[str]:
+    """Relay an LLM text stream as server-sent events.
+
+    Emits `token` events with preamble-free text, then one `done` event with
+    time-to-first-token and throughput, or an `error` event. The LLM call
+    runs in its own task so a client that disconnects, even while the call
+    is still queued or waiting for its first token, cancels it.
+    """
+    start = time.perf_counter()
+    queue: asyncio.Queue = asyncio.Queue()
+    _END = object()
+
+    async def produce():
+        try:
+            async for chunk in stream:
+                await queue.put(chunk)
+            await queue.put(_END)
+        except Exception as e:
+            await queue.put(e)
+
+    producer = asyncio.ensure_future(produce())
+    stripper = PreambleStripper()
+    first_token_at: Optional[float] = None
+    chunks = 0
+    text = []
+    try:
+        while True:
+            try:
+                item = await asyncio.wait_for(queue.get(), poll_interval)
+            except asyncio.TimeoutError:
+                if await is_disconnected():
+                    return
+                continue
+
+            if item is _END:
+                break
+            if isinstance(item, LLMOverloadedError):
+                yield sse_event("error", {"detail": "AI service is at capacity, please retry later", "retry_after": item.retry_after})
+                return
+            if isinstance(item, Exception):
+                yield sse_event("error", {"detail": f"Generation failed: {str(item)}"})
+                return
+
+            if first_token_at is None:
+                first_token_at = time.perf_counter()
+            chunks += 1
+            visible = stripper.feed(item)
+            if visible:
+                text.append(visible)
+                yield sse_event("token", {"text": visible})
+
+        tail = stripper.flush()
+        if tail:
+            text.append(tail)
+            yield sse_event("token", {"text": tail})
+
+        end = time.perf_counter()
+        tokens = count_tokens("".join(text))
+        generation_time = end - first_token_at if first_token_at else 0.0
+        yield sse_event("done", {
+            "ttft": round(first_token_at - start, 3) if first_token_at else None,
+            "tokens": tokens,
+            "chunks": chunks,
+            "tokens_per_second": round(tokens / generation_time, 2) if generation_time > 0 else None,
+            "processing_time": round(end - start, 3),
+        })
+    finally:
+        producer.cancel()
+
+
+async def stream_ndjson(
+    results: Iterable[Awaitable[Union[Dict, List[Dict]]]],
+    is_disconnected: Callable[[], Awaitable[bool]],
+    poll_interval: float = 0.5,
+) -> AsyncIterator[str]:
+    """Run the awaitables concurrently and emit each result as one JSON line when it finishes.
+
+    An awaitable may also return a list of items, e.g. for a batched LLM
+    call. Results arrive in completion order, so every item should identify
+    itself. A closing `{"done": true, ...}` line carries the totals; items
+    with `"status": "ok"` count as succeeded. Outstanding work is cancelled
+    if the client disconnects.
+    """
+    start = time.perf_counter()
+    tasks = [asyncio.ensure_future(result) for result in results]
+    pending = set(tasks)
+    total = succeeded = 0
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, timeout=poll_interval, return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                if await is_disconnected():
+                    return
+                continue
+            for task in done:
+                result = task.result()
+                for item in result if isinstance(result, list) else [result]:
+                    total += 1
+                    succeeded += int(item.get("status") == "ok")
+                    yield json.dumps(item) + "\n"
+        yield json.dumps({
+            "done": True,
+            "total": total,
+            "succeeded": succeeded,
+            "failed": total - succeeded,
+            "processing_time": round(time.perf_counter() - start, 3),
+        }) + "\n"
+    finally:
+        for task in tasks:
+            task.cancel()
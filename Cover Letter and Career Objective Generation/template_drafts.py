@@ -0,0 +1,97 @@
+import re
+from typing import Dict, List, Optional
+
+import cover_letter_agent
+from job_digests import job_duties
+
+# The letter part of the cover letter agent's example, with its [placeholders].
+SKELETON = cover_letter_agent.FEW_SHOTS.split("Cover Letter:\n", 1)[1].strip()
+# Profile skills named in the opening sentence
+OPENING_SKILLS = 3
+
+_PLACEHOLDER_RE = re.compile(r"\[([^\]]+)\]")
+_SENTENCE_RE = re.compile(r"(?<=[.!?])\s+")
+
+
+def _as_list(value) -> List[str]:
+    if not value:
+        return []
+    if isinstance(value, str):
+        return [v.strip() for v in value.split(",") if v.strip()]
+    return [str(v).strip() for v in value if str(v).strip()]
+
+
+def _join(items: List[str]) -> str:
+    return items[0] if len(items) == 1 else f"{', '.join(items[:-1])} and {items[-1]}"
+
+
+def _ranked_skills(user: Dict, job: Dict) -> List[str]:
+    """Profile skills the job mentions first, then the rest in profile order."""
+    text = f"{job.get('title', '')} {job.get('description', job.get('job_desc', ''))}".lower()
+    skills = _as_list(user.get("skills"))
+    return sorted(skills, key=lambda skill: skill.lower() not in text)
+
+
+def draft_values(user: Dict, job: Dict, candidate_info: Dict[str, str]) -> Dict[str, str]:
+    """Text for each skeleton placeholder that the profile and job can fill."""
+    skills = _ranked_skills(user, job)
+    title, years = user.get("current_title"), user.get("experience_years")
+    background = _join(skills[:OPENING_SKILLS]) if skills else ""
+    if title and years:
+        background = f"{background}, built over {years} years as a {title}" if background else f"{years} years as a {title}"
+    duties = job_duties(job)
+    certifications = _as_list(user.get("certifications"))
+    return {
+        "Candidate Name": candidate_info.get("Name", ""),
+        "City": candidate_info.get("City", ""),
+        "Country": candidate_info.get("Country", ""),
+        "Candidate Phone": candidate_info.get("Phone", ""),
+        "Candidate Email": candidate_info.get("Email", ""),
+        "Date": candidate_info.get("Date", ""),
+        "Job Title": job.get("title", "Position"),
+        "Company Name": job.get("company_name", "Company"),
+        "relevant skills/experience": background,
+        "mention relevant skills or industries": _join(skills[OPENING_SKILLS:2 * OPENING_SKILLS]) if skills[OPENING_SKILLS:] else "",
+        "describe how your skills match the job requirements": duties[0][0].lower() + duties[0][1:] if duties else "",
+        "industry or skill": skills[0] if skills else "",
+        "related value or goal": (
+            f"continuous learning, shown by my {_join(certifications)}," if certifications else "continuous learning"
+        ),
+    }
+
+
+def _fill(sentence: str, values: Dict[str, str]) -> Optional[str]:
+    """The sentence with its placeholders filled, or None if any of them has no value."""
+    missing = False
+
+    def value(match) -> str:
+        nonlocal missing
+        text = values.get(match.group(1))
+        missing = missing or not text
+        return text or ""
+
+    filled = _PLACEHOLDER_RE.sub(value, sentence)
+    return None if missing else filled
+
+
+def render_cover_letter_draft(user: Dict, job: Dict, candidate_info: Dict[str, str]) -> str:
+    """A cover letter draft from the FEW_SHOTS skeleton, without calling an LLM.
+
+    Placeholders are filled from the profile (`skills`, `current_title`,
+    `experience_years`, `certifications`), the contact details and the
+    job's title, company and first duty. Sentences with a placeholder that
+    nothing can fill (previous employer, quantified achievement) are left
+    out, so the draft never shows brackets.
+    """
+    values = draft_values(user, job, candidate_info)
+    paragraphs = []
+    for paragraph in SKELETON.split("\n\n"):
+        lines = []
+        for line in paragraph.split("\n"):
+            sentences = [_fill(s, values) for s in _SENTENCE_RE.split(line)]
+            kept = [s for s in sentences if s]
+            if kept:
+                lines.append(" ".join(kept))
+        if lines:
+            paragraphs.append("\n".join(lines))
+    return "\n\n".join(paragraphs)
@@ -180,5 +180,1339 @@ class TestCoverLetterAPI:
         # CORS headers should be present in preflight response
         assert response.status_code in [200, 405]  # Some servers return 405 for OPTIONS
 
+class TestPromptCompaction:
+
+    def test_compaction_strips_furniture_and_duplicates(self):
+        """Test that page furniture, bullets and repeated lines are removed"""
+        from prompt_compaction import compact_text
+        text = (
+            "Alice Smith | alice.smith@email.com | +44 7700 900123\n"
+            "•   Built   data pipelines in Python\n\n\n"
+            "Page 1 of 2\n"
+            "Alice Smith | alice.smith@email.com | +44 7700 900123\n"
+            "●  Reduced reporting time by 60%\n"
+            "Page 2 of 2"
+        )
+        result = compact_text(text)
+        assert "Page 1" not in result.text
+        assert result.text.count("alice.smith@email.com") == 1
+        assert "- Built data pipelines in Python" in result.text
+        assert result.tokens_saved > 0
+
+    def test_compaction_keeps_repeated_cv_content(self):
+        """Test that repeated job titles, bullets and numbers in the body survive, and page headers go"""
+        from prompt_compaction import normalize_text
+        text = (
+            "Alice Smith | alice.smith@email.com\nExperience\n"
+            "Software Engineer\nAcme\n- Maintained the CI pipeline for the platform team\n"
+            "Software Engineer\nGlobex\n- Maintained the CI pipeline for the platform team\n"
+            "Years of experience\n7\nSoftware Engineer\nInitech\nShipped the billing service\n1"
+            "\fAlice Smith | alice.smith@email.com\nEducation\nBSc Computer Science\n2\f"
+        )
+        result = normalize_text(text)
+        assert result.count("Software Engineer") == 3
+        assert result.count("Maintained the CI pipeline") == 2
+        assert "\n7\n" in result
+        assert result.count("alice.smith@email.com") == 1
+        assert not result.endswith("2") and "Initech\nShipped the billing service\n" in result
+
+    def test_compaction_enforces_budget(self):
+        """Test that least relevant sentences are dropped to fit the budget"""
+        from prompt_compaction import compact_text, count_tokens
+        text = (
+            "Enjoys hiking and photography on weekends. "
+            "Built machine learning models in Python and TensorFlow. "
+            "Volunteers at a local animal shelter every month."
+        )
+        result = compact_text(text, max_tokens=15, query="Python machine learning engineer")
+        assert result.truncated
+        assert count_tokens(result.text) <= 15
+        assert "machine learning" in result.text
+
+    def test_health_reports_compaction(self):
+        """Test that health check reports prompt compaction savings"""
+        response = client.get("/health")
+        assert "tokens_saved" in response.json()["prompt_compaction"]
+
+class TestContextSizing:
+
+    def test_smallest_bucket_that_fits(self):
+        """Test that num_ctx is the smallest bucket fitting prompt plus output"""
+        from llm_clients import pick_num_ctx
+        assert pick_num_ctx(500, 200) == 2048
+        assert pick_num_ctx(3000, 600) == 4096
+        assert pick_num_ctx(8000, 800) == 16384
+        assert pick_num_ctx(10**6, 0) == 32768
+
+    def test_client_reused_per_pinned_size(self):
+        """Test that one Ollama client is shared per model and pinned context size, which only grows"""
+        from llm_clients import get_ollama_llm
+        first = get_ollama_llm("bucket-test-model", 0.1, 2048)
+        assert get_ollama_llm("bucket-test-model", 0.1, 4096) is first
+        assert first.num_ctx == 4096  # the preload size
+        larger = get_ollama_llm("bucket-test-model", 0.1, 8192)
+        assert larger is not first and larger.num_ctx == 8192
+        assert get_ollama_llm("bucket-test-model", 0.1, 2048) is larger
+
+class TestModelWarmKeeping:
+
+    class FakeOllama:
+        def __init__(self):
+            self.resident = []
+            self.loads = []
+            self.num_ctx = []
+
+        def generate(self, model, prompt, keep_alive, options):
+            self.loads.append((model, keep_alive))
+            self.num_ctx.append(options["num_ctx"])
+            self.resident.append(model)
+            return type("Response", (), {"load_duration": 3_000_000_000})()
+
+        def ps(self):
+            models = [type("Model", (), {"model": m})() for m in self.resident]
+            return type("Response", (), {"models": models})()
+
+    def test_rewarm_after_restart(self):
+        """Test that models missing after an Ollama restart are reloaded"""
+        from ollama_manager import OllamaModelManager
+        manager = OllamaModelManager(models=["llama3.1:latest"], keep_alive="1h")
+        manager.client = self.FakeOllama()
+        assert manager.preload("llama3.1:latest")
+        manager.server_available = True
+
+        manager.client.resident.clear()  # Ollama restarted
+        manager.check()
+
+        assert manager.client.loads == [("llama3.1:latest", "1h")] * 2
+        snapshot = manager.snapshot()
+        assert snapshot["cold_starts"] == 2
+        assert snapshot["rewarms"] == 1
+        assert snapshot["last_cold_start"]["reason"] == "rewarm"
+
+    def test_request_loads_counted_and_rewarm_uses_pin(self):
+        """Test that a slow load reported on a request counts as a cold start and re-warms use the pinned num_ctx"""
+        from langchain_core.messages import AIMessage
+        from langchain_core.outputs import ChatGeneration, LLMResult
+        from ollama_manager import LoadCallback, OllamaModelManager
+        manager = OllamaModelManager(models=["llama3.1:latest"], keep_alive="1h")
+        manager.client = self.FakeOllama()
+        callback = LoadCallback("llama3.1:latest", manager)
+        for load_duration in (2_500_000_000, 20_000_000):  # a reload, then a warm call
+            generation = ChatGeneration(message=AIMessage(content="Hi"), generation_info={"load_duration": load_duration})
+            callback.on_llm_end(LLMResult(generations=[[generation]]), run_id=None)
+        assert manager.num_ctx_for("llama3.1:latest", 16384) == 16384
+        assert manager.preload("llama3.1:latest", reason="rewarm")
+        snapshot = manager.snapshot()
+        assert snapshot["cold_starts"] == 2 and snapshot["cold_starts_by_reason"] == {"request": 1, "rewarm": 1}
+        assert manager.client.num_ctx == [16384]
+
+    def test_metrics_endpoint(self):
+        """Test that metrics expose Ollama warm-keeping state"""
+        response = client.get("/metrics")
+        assert response.status_code == 200
+        assert "cold_starts" in response.json()["ollama"]
+
+class TestAdaptiveConcurrency:
+
+    def test_limit_grows_while_latency_is_stable(self):
+        """Test additive increase while latency stays at baseline"""
+        from llm_limiter import AdaptiveConcurrencyLimiter
+        limiter = AdaptiveConcurrencyLimiter("test", initial_limit=2, max_limit=8)
+        for _ in range(20):
+            limiter.acquire()
+            limiter.release(latency=1.0, ok=True)
+        assert limiter.limit > 2
+
+    def test_limit_shrinks_on_latency_inflation_and_errors(self):
+        """Test multiplicative decrease on slow calls and failures"""
+        from llm_limiter import AdaptiveConcurrencyLimiter
+        limiter = AdaptiveConcurrencyLimiter("test", initial_limit=8)
+        limiter.acquire()
+        limiter.release(latency=1.0, ok=True)
+        for _ in range(3):
+            limiter.acquire()
+            limiter.release(latency=10.0, ok=True)
+        assert limiter.limit < 8
+        before = limiter.limit
+        limiter.acquire()
+        limiter.release(latency=1.0, ok=False)
+        assert limiter.limit <= before
+        assert limiter.snapshot()["errors"] == 1
+
+    def test_long_calls_of_another_kind_do_not_shrink_limit(self):
+        """Test that latency baselines are per kind, and concurrent slow calls cut the limit only once"""
+        from llm_limiter import AdaptiveConcurrencyLimiter
+        limiter = AdaptiveConcurrencyLimiter("test", initial_limit=8)
+        for kind, latency in [("career_objective", 1.0), ("cover_letter", 10.0)] * 10:
+            limiter.acquire()
+            limiter.release(latency=latency, ok=True, kind=kind)
+        assert limiter.limit >= 8 and limiter.snapshot()["decreases"] == 0
+        limiter.acquire()
+        limiter.release(latency=100.0, ok=True, kind="cover_letter")
+        for _ in range(5):  # in flight alongside the first slow call
+            limiter.acquire()
+            limiter.release(latency=100.0, ok=False, kind="cover_letter")
+        assert limiter.snapshot()["decreases"] == 1
+
+    def test_overflow_is_shed_with_retry_after(self):
+        """Test that requests beyond the limit and queue get 503 with Retry-After"""
+        from llm_limiter import get_limiter
+        limiter = get_limiter("ollama", "shed-test-model")
+        limiter.max_queue = 0
+        limiter.in_flight = limiter.limit
+        try:
+            response = client.post("/generate-objective-quick", json={
+                "user_id": "u1001",
+                "job_id": "7001000001",
+                "llm_name": "ollama",
+                "model_name": "shed-test-model"
+            })
+        finally:
+            limiter.in_flight = 0
+        assert response.status_code == 503
+        assert int(response.headers["Retry-After"]) >= 1
+
+class TestPriorityLanes:
+
+    def test_interactive_overtakes_queued_batch_work(self):
+        """Test weighted fair queuing across lanes"""
+        import threading
+        from llm_limiter import AdaptiveConcurrencyLimiter
+        limiter = AdaptiveConcurrencyLimiter("lanes", initial_limit=1, max_limit=1)
+        order = []
+
+        def call(lane, i):
+            with limiter.slot(lane):
+                order.append((lane, i))
+
+        limiter.acquire()
+        threads = []
+        for lane, count in (("batch", 6), ("interactive", 3)):
+            for i in range(count):
+                t = threading.Thread(target=call, args=(lane, i))
+                t.start()
+                threads.append(t)
+                time.sleep(0.01)
+        limiter.release(ok=None)
+        for t in threads:
+            t.join()
+
+        # All interactive calls finish within the first few grants
+        last_interactive = max(i for i, (lane, _) in enumerate(order) if lane == "interactive")
+        assert last_interactive <= 4
+        lanes = limiter.snapshot()["lanes"]
+        assert lanes["batch"]["granted"] == 6
+        assert lanes["batch"]["queue_wait_max"] >= lanes["interactive"]["queue_wait_max"]
+
+    def test_lane_from_context(self):
+        """Test that use_lane tags nested LLM calls"""
+        from llm_limiter import AdaptiveConcurrencyLimiter, use_lane
+        limiter = AdaptiveConcurrencyLimiter("lanes")
+        with use_lane("batch"):
+            with limiter.slot():
+                pass
+        assert limiter.snapshot()["lanes"]["batch"]["granted"] == 1
+        with pytest.raises(ValueError):
+            with use_lane("vip"):
+                pass
+
+class TestHedgedRequests:
+
+    class FakeAgent:
+        """Streams a fixed text after a per-backend delay"""
+        delays = {}
+        cancelled = []
+
+        def __init__(self, llm_name, model_name, temperature=0.1, base_url=None):
+            self.llm_name, self.model_name, self.temperature, self.base_url = llm_name, model_name, temperature, base_url
+            self.backend = llm_name
+
+        async def astream_chunks(self, text):
+            import asyncio
+            try:
+                await asyncio.sleep(self.delays[self.llm_name])
+                yield f"{text} from {self.llm_name}"
+            except asyncio.CancelledError:
+                self.cancelled.append(self.llm_name)
+                raise
+
+        def finalize(self, result):
+            return result.strip()
+
+        @staticmethod
+        def error_text(error):
+            return f"❌ Error: {error}"
+
+    def run(self, hedger, count=1):
+        import asyncio
+        agent = self.FakeAgent("slow", "m")
+
+        async def go():
+            return [await hedger.generate("generate", agent, text="letter") for _ in range(count)]
+        return asyncio.run(go())
+
+    def test_slow_primary_is_hedged_and_cancelled(self):
+        """Test that the secondary wins when the primary has no first token by the hedge delay"""
+        from hedging import HedgePolicy, Hedger
+        self.FakeAgent.delays = {"slow": 1.0, "fast": 0.01}
+        self.FakeAgent.cancelled = []
+        hedger = Hedger({"generate": HedgePolicy("fast", "m", max_ratio=1.0, initial_delay=0.05)})
+        assert self.run(hedger) == ["letter from fast"]
+        assert self.FakeAgent.cancelled == ["slow"]
+        stats = hedger.snapshot()["endpoints"]["generate"]
+        assert stats["hedged"] == 1 and stats["hedge_wins"] == 1
+
+    def test_fast_primary_is_not_hedged(self):
+        """Test that no duplicate is sent when the primary answers within the delay"""
+        from hedging import HedgePolicy, Hedger
+        self.FakeAgent.delays = {"slow": 0.01, "fast": 0.01}
+        hedger = Hedger({"generate": HedgePolicy("fast", "m", max_ratio=1.0, initial_delay=0.5)})
+        assert self.run(hedger) == ["letter from slow"]
+        assert hedger.snapshot()["endpoints"]["generate"]["hedged"] == 0
+
+    def test_hedge_budget_is_capped(self):
+        """Test that hedges stay within max_ratio of requests"""
+        from hedging import HedgePolicy, Hedger
+        self.FakeAgent.delays = {"slow": 0.05, "fast": 0.01}
+        hedger = Hedger({"generate": HedgePolicy("fast", "m", max_ratio=0.25, initial_delay=0.01)})
+        self.run(hedger, count=8)
+        stats = hedger.snapshot()["endpoints"]["generate"]
+        assert stats["hedged"] == 2
+        assert stats["budget_denied"] == 6
+
+    def test_hedged_answer_is_finalized(self):
+        """Test that a hedged letter is trimmed like an unhedged one, and a failed one is an error string"""
+        import asyncio
+        from langchain_core.runnables import RunnableLambda
+        from agent_registry import get_agent
+        from cover_letter_agent import CoverLetterAgent
+        from hedging import HedgePolicy, Hedger
+        letter = "Dear Hiring Manager,\n\nI am excited.\n\nSincerely,\nAlice Smith\n\nSincerely,\nAlice Smith"
+        agent = get_agent(CoverLetterAgent, "ollama", "hedge-primary-model")
+        agent._chain_for = lambda inputs: RunnableLambda(lambda x: letter)
+        hedger = Hedger({"generate": HedgePolicy("ollama", "hedge-secondary-model", max_ratio=1.0, initial_delay=5)})
+        fields = dict(cv_text="Python", job_title="Engineer", company_name="Acme", job_desc="Build", candidate_info={})
+        assert asyncio.run(hedger.generate("generate", agent, **fields)) == asyncio.run(agent.agenerate(**fields))
+        assert asyncio.run(hedger.generate("generate", agent, **fields)).count("Sincerely") == 1
+
+        def fail(_):
+            raise RuntimeError("backend down")
+        agent._chain_for = lambda inputs: RunnableLambda(fail)
+        assert asyncio.run(hedger.generate("generate", agent, **fields)) == "❌ Error generating cover letter: backend down"
+
+class TestAgentRegistry:
+
+    def test_agent_built_once_per_configuration(self):
+        """Test that requests share one agent per (llm, model, temperature)"""
+        from agent_registry import get_agent
+        from cover_letter_agent import CoverLetterAgent
+        agent = get_agent(CoverLetterAgent, "ollama", "registry-model")
+        assert get_agent(CoverLetterAgent, "ollama", "registry-model") is agent
+        assert get_agent(CoverLetterAgent, "ollama", "registry-model", temperature=0.7) is not agent
+
+    def test_failed_construction_not_cached(self, monkeypatch):
+        """Test that a missing API key is reported on every call, not cached"""
+        from agent_registry import get_agent
+        from career_objective_agent import CareerObjectiveAgent
+        monkeypatch.delenv("OPENAI_API_KEY", raising=False)
+        monkeypatch.delenv("openaikey", raising=False)
+        for _ in range(2):
+            with pytest.raises(ValueError):
+                get_agent(CareerObjectiveAgent, "openai", "registry-model")
+
+    def test_caches_keyed_by_model_are_bounded(self, monkeypatch):
+        """Test that request-chosen model names cannot grow the agent and limiter registries without limit"""
+        import agent_registry
+        import llm_limiter
+        from cover_letter_agent import CoverLetterAgent
+        monkeypatch.setattr(agent_registry, "AGENT_REGISTRY_SIZE", 3)
+        monkeypatch.setattr(llm_limiter, "LLM_LIMITER_REGISTRY_SIZE", 3)
+        busy = llm_limiter.get_limiter("ollama", "bounded-busy")
+        busy.in_flight += 1
+        try:
+            for i in range(10):
+                agent_registry.get_agent(CoverLetterAgent, "ollama", f"bounded-{i}")
+                llm_limiter.get_limiter("ollama", f"bounded-{i}")
+            assert len(agent_registry._agents) == 3
+            assert agent_registry.registry_snapshot()["evictions"] >= 7
+            assert len(llm_limiter._limiters) == 3
+            assert llm_limiter.get_limiter("ollama", "bounded-busy") is busy
+        finally:
+            busy.in_flight -= 1
+
+    def test_model_outside_allow_list_rejected(self, monkeypatch):
+        """Test that LLM_ALLOWED_MODELS rejects other models with 400 before any agent is built"""
+        import agent_registry
+        monkeypatch.setattr(agent_registry, "LLM_ALLOWED_MODELS", {"llama3.1:latest"})
+        builds = agent_registry._stats["builds"]
+        response = client.post("/generate", json={
+            "job_title": "Software Developer",
+            "company_name": "Tech Corp",
+            "job_desc": "We are looking for a skilled software developer with Python experience.",
+            "cv_text": "Experienced Python developer with 3 years of experience in web development.",
+            "candidate_info": {
+                "Name": "John Doe",
+                "Email": "john.doe@email.com",
+                "Phone": "+1234567890",
+                "City": "London",
+                "State": "UK"
+            },
+            "llm_name": "ollama",
+            "model_name": "not-allowed-model",
+        })
+        assert response.status_code == 400
+        assert "not allowed" in response.json()["detail"]
+        assert agent_registry._stats["builds"] == builds
+
+class TestAsyncGeneration:
+
+    def test_agenerate_uses_async_chain(self):
+        """Test that agenerate awaits the chain and returns its text"""
+        import asyncio
+        from langchain_core.language_models.fake import FakeListLLM
+        from career_objective_agent import CareerObjectiveAgent
+        agent = CareerObjectiveAgent(llm_name="ollama", model_name="async-test-model")
+        chain = agent.prompt | FakeListLLM(responses=["  Motivated engineer seeking growth.  "])
+        agent._chain_for = lambda inputs: chain
+        objective = asyncio.run(agent.agenerate("cv", "Engineer", "Acme", "Build things"))
+        assert objective == "Motivated engineer seeking growth."
+
+    def test_client_disconnect_cancels_generation(self):
+        """Test that a disconnected client cancels the in-flight LLM call"""
+        import asyncio
+        from fastapi import HTTPException
+        import main
+
+        cancelled = []
+
+        class SlowAgent:
+            llm_name, model_name, base_url = "ollama", "disconnect-model", None
+
+            async def agenerate(self, **kwargs):
+                try:
+                    await asyncio.sleep(10)
+                except asyncio.CancelledError:
+                    cancelled.append(True)
+                    raise
+
+        class GoneRequest:
+            async def is_disconnected(self):
+                return True
+
+        async def go():
+            with pytest.raises(HTTPException) as exc:
+                await main.run_agent(GoneRequest(), "generate", SlowAgent())
+            await asyncio.sleep(0)  # let the cancellation land
+            return exc.value.status_code, list(cancelled)
+
+        main.DISCONNECT_POLL_SECONDS = 0.01
+        try:
+            assert asyncio.run(go()) == (499, [True])
+        finally:
+            main.DISCONNECT_POLL_SECONDS = 0.5
+
+class TestStreaming:
+
+    def test_preamble_stripped_across_chunks(self):
+        """Test that a chatty preamble split over chunks never reaches the client"""
+        from streaming import PreambleStripper
+        stripper = PreambleStripper()
+        chunks = ["Sure", "! Here is a tailored ", "cover letter for you:", "\n\nDear Hiring", " Manager,\n", "I am writing"]
+        out = "".join(stripper.feed(c) for c in chunks) + stripper.flush()
+        assert out == "Dear Hiring Manager,\nI am writing"
+
+        plain = PreambleStripper()
+        out = "".join(plain.feed(c) for c in ["Results-driven engineer ", "seeking a role."]) + plain.flush()
+        assert out == "Results-driven engineer seeking a role."
+
+    def test_stream_endpoint_emits_tokens_and_stats(self):
+        """Test SSE cover letter stream with a fake streaming LLM"""
+        from langchain_core.language_models.fake import FakeStreamingListLLM
+        from agent_registry import get_agent
+        from cover_letter_agent import CoverLetterAgent
+        agent = get_agent(CoverLetterAgent, "ollama", "stream-test-model")
+        chain = agent.prompt | FakeStreamingListLLM(responses=["Here is your cover letter:\nDear Hiring Manager,\nHello."])
+        agent._chain_for = lambda inputs: chain
+
+        response = client.post("/generate/stream", json={
+            "job_title": "Software Developer",
+            "company_name": "Tech Corp",
+            "job_desc": "We are looking for a skilled software developer with Python experience.",
+            "cv_text": "Experienced Python developer with 3 years of experience in web development.",
+            "candidate_info": {"Name": "John Doe", "Email": "john.doe@email.com"},
+            "llm_name": "ollama",
+            "model_name": "stream-test-model"
+        })
+        assert response.status_code == 200
+        assert response.headers["content-type"].startswith("text/event-stream")
+        events = [block.split("\n", 1) for block in response.text.strip().split("\n\n")]
+        names = [e[0].replace("event: ", "") for e in events]
+        payloads = [json.loads(e[1].replace("data: ", "")) for e in events]
+        assert names[-1] == "done" and set(names[:-1]) == {"token"}
+        assert "".join(p["text"] for p in payloads[:-1]) == "Dear Hiring Manager,\nHello."
+        assert payloads[-1]["ttft"] is not None
+        assert payloads[-1]["tokens_per_second"] is not None
+
+class TestDataStore:
+
+    def test_lookup_by_id(self):
+        """Test indexed user and job lookups"""
+        from data_store import data_store
+        data = data_store.dataset
+        assert data.user("u1001")["user_id"] == "u1001"
+        assert data.job("7001000001")["id"] == "7001000001"
+        assert data.user("missing") is None
+
+    def test_reload_swaps_dataset_atomically(self, tmp_path):
+        """Test that changed files are picked up and bad JSON keeps the old data"""
+        from data_store import DataStore
+        users, jobs = tmp_path / "users.json", tmp_path / "jobs.json"
+        users.write_text(json.dumps([{"user_id": "a", "name": "A"}]))
+        jobs.write_text(json.dumps([{"id": "1", "title": "Old"}]))
+        store = DataStore(str(users), str(jobs), poll_interval=0)
+        before = store.dataset
+
+        jobs.write_text(json.dumps([{"id": "1", "title": "New"}, {"id": "2", "title": "Extra"}]))
+        assert store.changed()
+        store.reload()
+        assert store.dataset.job("1")["title"] == "New"
+        assert before.job("1")["title"] == "Old"  # earlier snapshot untouched
+        assert store.dataset.version != before.version
+
+        jobs.write_text("[{\"id\": ")
+        store.reload()
+        assert store.dataset.job("2")["title"] == "Extra"
+
+class TestSQLiteStore:
+
+    def test_streaming_import_matches_json_backend(self, tmp_path, monkeypatch):
+        """Test FTS5 store import in small chunks and query parity with the JSON store"""
+        import sqlite_store
+        from data_store import DataStore, JobFilters
+        monkeypatch.setattr(sqlite_store, "READ_CHUNK_BYTES", 512)
+        store = sqlite_store.SQLiteStore(str(tmp_path / "data.db"), "user_profiles.json", "jobs.json", poll_interval=0)
+        memory = DataStore("user_profiles.json", "jobs.json", poll_interval=0)
+        assert store.dataset.version == memory.dataset.version
+        assert store.dataset.count_jobs() == memory.dataset.count_jobs()
+        assert store.dataset.user("u1001") == memory.dataset.user("u1001")
+
+        for filters in (JobFilters(category="IT Jobs", salary_min=60000), JobFilters(location="london", contract_type="permanent")):
+            expected = sorted(j["id"] for j in memory.dataset.query_jobs(filters)[0])
+            assert sorted(j["id"] for j in store.dataset.query_jobs(filters)[0]) == expected
+
+        ids, cursor = [], None
+        while True:
+            page, cursor = store.dataset.query_jobs(limit=7, cursor=cursor)
+            ids += [j["id"] for j in page]
+            if not cursor:
+                break
+        assert ids == [j["id"] for j in memory.dataset.jobs]
+
+    def test_full_text_search(self, tmp_path):
+        """Test ranked full-text job search with prefix matching"""
+        from sqlite_store import SQLiteStore
+        from data_store import JobFilters
+        store = SQLiteStore(str(tmp_path / "data.db"), "user_profiles.json", "jobs.json", poll_interval=0)
+        jobs, _ = store.dataset.query_jobs(JobFilters(q="develop"))
+        assert jobs and all("develop" in (j["title"] + j["description"]).lower() for j in jobs)
+
+    def test_dataset_is_a_snapshot(self, tmp_path):
+        """Test that an older dataset keeps its rows after a re-import and is closed once dropped"""
+        import gc
+        import json
+        import os
+        from sqlite_store import SQLiteStore
+        users_path, jobs_path = tmp_path / "users.json", tmp_path / "jobs.json"
+        users_path.write_text(json.dumps([{"user_id": "u1", "cv_text": "Python"}]))
+        jobs_path.write_text(json.dumps([{"id": "1", "title": "Old", "description": "Python developer"}]))
+        store = SQLiteStore(str(tmp_path / "data.db"), str(users_path), str(jobs_path), poll_interval=0)
+        old = store.dataset
+        jobs_path.write_text(json.dumps([{"id": "1", "title": "New", "description": "Go developer"}, {"id": "2", "title": "Extra"}]))
+        os.utime(jobs_path, ns=(1, 1))
+        store.reload()
+        assert store.dataset is not old and store.dataset.job("1")["title"] == "New"
+        assert old.job("1")["title"] == "Old" and old.count_jobs() == 1
+        assert [j["id"] for j in old.query_jobs()[0]] == ["1"]
+        finalizer = old._finalizer
+        del old
+        gc.collect()
+        assert not finalizer.alive
+
+    def test_queries_run_off_the_event_loop(self, tmp_path):
+        """Test that run_query sends SQLite queries to a worker thread and calls in-memory ones inline"""
+        import asyncio
+        import threading
+        from data_store import DataStore, run_query
+        from sqlite_store import SQLiteStore
+        threads = []
+        for store in (SQLiteStore(str(tmp_path / "data.db"), "user_profiles.json", "jobs.json", poll_interval=0),
+                      DataStore("user_profiles.json", "jobs.json", poll_interval=0)):
+            data = store.dataset
+
+            def count():
+                threads.append(threading.current_thread())
+                return data.count_jobs()
+
+            assert asyncio.run(run_query(data, count)) == data.count_jobs()
+        assert threads[0] is not threading.main_thread() and threads[1] is threading.main_thread()
+
+    def test_search_endpoint(self):
+        """Test /jobs/search filters and cursor"""
+        response = client.get("/jobs/search", params={"category": "IT Jobs", "limit": 2})
+        assert response.status_code == 200
+        data = response.json()
+        assert len(data["jobs"]) == 2 and data["next_cursor"]
+        response = client.get("/jobs/search", params={"cursor": "not-a-cursor"})
+        assert response.status_code == 400
+
+class TestDataPagination:
+
+    def test_cursor_pagination_and_projection(self):
+        """Test /jobs pages through every job with only the requested fields"""
+        ids, cursor = [], None
+        while True:
+            params = {"limit": 20, "fields": "job_id,title"}
+            if cursor:
+                params["cursor"] = cursor
+            data = client.get("/jobs", params=params).json()
+            assert all(set(job) == {"job_id", "title"} for job in data["jobs"])
+            ids += [job["job_id"] for job in data["jobs"]]
+            cursor = data["next_cursor"]
+            if not cursor:
+                break
+        assert len(ids) == len(set(ids)) == data["total_jobs"]
+
+        response = client.get("/users", params={"fields": "user_id,password"})
+        assert response.status_code == 400
+
+    def test_etag_not_modified(self):
+        """Test that an unchanged page returns 304 and a different query does not"""
+        first = client.get("/users", params={"limit": 2})
+        etag = first.headers["ETag"]
+        again = client.get("/users", params={"limit": 2}, headers={"If-None-Match": etag})
+        assert again.status_code == 304
+        assert again.headers["ETag"] == etag
+        other = client.get("/users", params={"limit": 3}, headers={"If-None-Match": etag})
+        assert other.status_code == 200
+
+class TestResultCache:
+
+    def test_quick_objective_cached_until_regenerate(self):
+        """Test that repeated quick requests are served from cache and regenerate bypasses it"""
+        from langchain_core.runnables import RunnableLambda
+        from agent_registry import get_agent
+        from career_objective_agent import CareerObjectiveAgent
+        calls = []
+        agent = get_agent(CareerObjectiveAgent, "ollama", "cache-test-model")
+        agent._chain_for = lambda inputs: RunnableLambda(lambda _: calls.append(1) or f"Objective v{len(calls)}")
+
+        payload = {"user_id": "u1001", "job_id": "7001000001", "llm_name": "ollama", "model_name": "cache-test-model"}
+        first = client.post("/generate-objective-quick", json=payload).json()
+        second = client.post("/generate-objective-quick", json=payload).json()
+        assert (first["cached"], second["cached"]) == (False, True)
+        assert second["career_objective"] == first["career_objective"] == "Objective v1"
+
+        fresh = client.post("/generate-objective-quick", json={**payload, "regenerate": True}).json()
+        assert fresh["cached"] is False and fresh["career_objective"] == "Objective v2"
+        assert client.post("/generate-objective-quick", json=payload).json()["career_objective"] == "Objective v2"
+        assert len(calls) == 2
+
+    def test_key_changes_with_record_content(self):
+        """Test that editing a profile or job invalidates its cached results"""
+        from result_cache import result_key
+
+        class Agent:
+            llm_name, model_name, temperature = "ollama", "m", 0.1
+
+        user, job = {"user_id": "u1", "cv_text": "Python"}, {"id": "j1", "title": "Dev"}
+        key = result_key("generate-quick", Agent, user, job)
+        assert result_key("generate-quick", Agent, dict(user), dict(job)) == key
+        assert result_key("generate-quick", Agent, {**user, "cv_text": "Python, Go"}, job) != key
+        assert result_key("generate-quick", Agent, user, {**job, "title": "Senior Dev"}) != key
+
+class TestBulkGeneration:
+
+    def test_bulk_objectives_stream_ndjson_in_batch_lane(self):
+        """Test one user against several jobs streams one NDJSON line per job, then totals"""
+        from langchain_core.runnables import RunnableLambda
+        from agent_registry import get_agent
+        from career_objective_agent import CareerObjectiveAgent
+        from llm_limiter import current_lane
+        lanes = []
+        agent = get_agent(CareerObjectiveAgent, "ollama", "bulk-test-model")
+        agent._chain_for = lambda inputs: RunnableLambda(lambda x: lanes.append(current_lane.get()) or f"Objective for {x['job_title']}")
+        agent._batch_chain_for = lambda inputs, count: RunnableLambda(
+            lambda x: lanes.append(current_lane.get()) or json.dumps([f"Objective for job {i + 1}" for i in range(count)])
+        )
+
+        response = client.post("/generate-objective-quick/bulk", json={
+            "user_id": "u1001",
+            "job_ids": ["7001000001", "7001000002", "no-such-job"],
+            "llm_name": "ollama",
+            "model_name": "bulk-test-model"
+        })
+        assert response.status_code == 200
+        assert response.headers["content-type"].startswith("application/x-ndjson")
+        lines = [json.loads(line) for line in response.text.strip().split("\n")]
+        items = sorted(lines[:-1], key=lambda item: item["index"])
+        assert [item["job_id"] for item in items] == ["7001000001", "7001000002", "no-such-job"]
+        assert [item["status"] for item in items] == ["ok", "ok", "error"]
+        assert items[0]["career_objective"].startswith("Objective for")
+        assert lines[-1]["done"] is True
+        assert (lines[-1]["succeeded"], lines[-1]["failed"]) == (2, 1)
+        assert lanes == ["batch"]  # both jobs in one batched prompt
+
+    def test_bulk_request_validation(self):
+        """Test that bulk requests need exactly one shape and an existing anchor record"""
+        both = client.post("/generate-quick/bulk", json={"user_id": "u1001", "job_ids": ["7001000001"], "user_ids": ["u1002"]})
+        assert both.status_code == 422
+        neither = client.post("/generate-quick/bulk", json={"user_id": "u1001"})
+        assert neither.status_code == 422
+        missing = client.post("/generate-quick/bulk", json={"job_id": "no-such-job", "user_ids": ["u1001"]})
+        assert missing.status_code == 404
+
+class TestObjectiveBatching:
+
+    def test_parse_objectives_checks_length_and_order(self):
+        """Test that batched answers are only accepted with the right count in job order"""
+        from career_objective_agent import parse_objectives
+        answer = 'Here you go:\n[{"job": 1, "objective": "First  one."}, {"job": 2, "objective": "Second."}]'
+        assert parse_objectives(answer, 2) == ["First one.", "Second."]
+        assert parse_objectives('["A.", "B."]', 2) == ["A.", "B."]
+        assert parse_objectives(answer, 3) is None
+        assert parse_objectives('[{"job": 2, "objective": "B."}, {"job": 1, "objective": "A."}]', 2) is None
+        assert parse_objectives("Results-driven engineer seeking a role.", 1) is None
+
+    def test_batch_uses_one_call_and_falls_back(self):
+        """Test K jobs in one prompt, and individual calls when the answer is malformed"""
+        import asyncio
+        from langchain_core.runnables import RunnableLambda
+        from career_objective_agent import CareerObjectiveAgent
+        agent = CareerObjectiveAgent(llm_name="ollama", model_name="batch-test-model")
+        prompts, singles = [], []
+
+        def batched(inputs):
+            prompts.append(agent.batch_prompt.format(**inputs))
+            return json.dumps([{"job": i, "objective": f"Objective {i}."} for i in range(1, 4)])
+
+        agent._batch_chain_for = lambda inputs, count: RunnableLambda(batched)
+        agent._chain_for = lambda inputs: RunnableLambda(lambda x: singles.append(x["job_title"]) or f"Single for {x['job_title']}")
+        jobs = [{"job_title": f"Role {i}", "company_name": "Acme", "job_desc": "Python developer"} for i in range(1, 4)]
+
+        assert asyncio.run(agent.agenerate_batch("Python developer, 5 years.", jobs)) == ["Objective 1.", "Objective 2.", "Objective 3."]
+        assert len(prompts) == 1 and prompts[0].count("Python developer, 5 years.") == 1
+        assert singles == []
+
+        agent._batch_chain_for = lambda inputs, count: RunnableLambda(lambda _: "Sorry, I cannot do that.")
+        assert agent.generate_batch("Python developer, 5 years.", jobs) == ["Single for Role 1", "Single for Role 2", "Single for Role 3"]
+
+class TestCombinedApplication:
+
+    def test_parse_application(self):
+        """Test that the combined answer must be a JSON object with both documents"""
+        from application_agent import parse_application
+        answer = 'Sure!\n{"cover_letter": "Dear Hiring Manager,\n\nI am writing.", "career_objective": "Driven  engineer."}'
+        assert parse_application(answer) == {"cover_letter": "Dear Hiring Manager,\n\nI am writing.", "career_objective": "Driven engineer."}
+        raw_newlines = '{"cover_letter": "Dear Hiring Manager,\nLine two", "career_objective": "Driven."}'  # literal newline in the string
+        assert parse_application(raw_newlines)["cover_letter"] == "Dear Hiring Manager,\nLine two"
+        assert parse_application('{"cover_letter": "Dear Hiring Manager"}') is None
+        assert parse_application("Dear Hiring Manager, I am writing.") is None
+
+    def test_quick_application_one_call_and_fallback(self):
+        """Test both documents from one LLM call, and separate calls when the answer is malformed"""
+        from langchain_core.runnables import RunnableLambda
+        from agent_registry import get_agent
+        from application_agent import ApplicationAgent
+        from career_objective_agent import CareerObjectiveAgent
+        from cover_letter_agent import CoverLetterAgent
+        calls = []
+        agent = get_agent(ApplicationAgent, "ollama", "application-test-model")
+        agent._chain_for = lambda inputs: RunnableLambda(
+            lambda x: calls.append("combined") or json.dumps({"cover_letter": f"Dear Hiring Manager, {x['job_title']}", "career_objective": "Driven engineer."})
+        )
+        payload = {"user_id": "u1001", "job_id": "7001000001", "llm_name": "ollama", "model_name": "application-test-model"}
+        data = client.post("/generate-application-quick", json=payload).json()
+        assert data["cover_letter"].startswith("Dear Hiring Manager") and data["career_objective"] == "Driven engineer."
+        assert client.post("/generate-application-quick", json=payload).json()["cached"] is True
+        assert calls == ["combined"]
+
+        agent._chain_for = lambda inputs: RunnableLambda(lambda x: calls.append("combined") or "Not JSON at all")
+        get_agent(CoverLetterAgent, "ollama", "application-test-model")._chain_for = lambda inputs: RunnableLambda(lambda x: calls.append("letter") or "Letter")
+        get_agent(CareerObjectiveAgent, "ollama", "application-test-model")._chain_for = lambda inputs: RunnableLambda(lambda x: calls.append("objective") or "Objective")
+        data = client.post("/generate-application-quick", json={**payload, "regenerate": True}).json()
+        assert (data["cover_letter"], data["career_objective"]) == ("Letter", "Objective")
+        assert sorted(calls[1:]) == ["combined", "letter", "objective"]
+
+class TestPassageSelection:
+
+    CV = (
+        "Jane Doe\n"
+        "Backend engineer with 6 years of experience.\n"
+        "EXPERIENCE\n"
+        "- Built Python microservices on AWS serving 2M requests a day.\n"
+        "- Organised the office charity bake sale.\n"
+        "- Migrated PostgreSQL databases with zero downtime.\n"
+        "INTERESTS\n"
+        "Hiking, chess and watercolour painting in the Lake District every summer with friends.\n"
+    )
+
+    def test_bm25_keeps_relevant_passages_in_order(self):
+        """Test that the most job-relevant passages are kept, in CV order, under the budget"""
+        from prompt_compaction import count_tokens, select_passages
+        job = "Senior Python engineer to build AWS microservices and run PostgreSQL databases"
+        result = select_passages(self.CV, job, max_tokens=45, top_k=3)
+        assert result.truncated and count_tokens(result.text) <= 45
+        lines = result.text.split("\n")
+        assert lines[0] == "Jane Doe"
+        assert lines.index("EXPERIENCE") < lines.index("- Built Python microservices on AWS serving 2M requests a day.")
+        assert "- Migrated PostgreSQL databases with zero downtime." in lines
+        assert "bake sale" not in result.text and "INTERESTS" not in result.text
+
+    def test_short_cv_unchanged(self):
+        """Test that a CV already within the passage budget is only normalized"""
+        from prompt_compaction import normalize_text, select_passages
+        result = select_passages(self.CV, "Python engineer", max_tokens=500)
+        assert result.text == normalize_text(self.CV) and not result.truncated
+
+class TestCandidateBriefs:
+
+    def test_brief_sections(self):
+        """Test that the brief keeps roles, quantified achievements, skills and certifications"""
+        from candidate_briefs import build_brief
+        brief = build_brief({
+            "user_id": "b1",
+            "skills": ["Python", "SQL"],
+            "cv_text": (
+                "Jane Doe\nData Engineer\njane@example.com | +44 7700 900123\n"
+                "EXPERIENCE\nData Engineer, Acme Ltd Jan 2021 - Present\n"
+                "- Cut pipeline costs by 40% on AWS.\n- Enjoys working in teams.\n"
+                "CERTIFICATIONS\nAWS Certified Data Engineer\n"
+            ),
+        })
+        assert brief.startswith("Headline: Jane Doe - Data Engineer")
+        assert "- Data Engineer, Acme Ltd Jan 2021 - Present" in brief
+        assert "- Cut pipeline costs by 40% on AWS." in brief
+        assert "Skills: Python, SQL" in brief and "Certifications: AWS Certified Data Engineer" in brief
+        assert "jane@example.com" not in brief and "Enjoys" not in brief
+
+    def test_store_rebuilds_only_on_change(self, tmp_path):
+        """Test that a stored brief is reused until the profile changes"""
+        from candidate_briefs import BriefStore
+        path = str(tmp_path / "briefs.db")
+        user = {"user_id": "b2", "cv_text": "Backend engineer with 6 years of experience. Cut latency by 30%."}
+        store = BriefStore(path)
+        first = store.brief_for(user)
+        store.flush()
+        assert BriefStore(path).brief_for(user) == first  # read back from disk
+        assert store.brief_for(user) == first and store.builds == 1
+        changed = store.brief_for({**user, "cv_text": user["cv_text"] + " Led a team of 12 engineers."})
+        assert "12 engineers" in changed and store.builds == 2
+
+    def test_store_memory_is_bounded_and_writes_batched(self, tmp_path):
+        """Test that only the most recent entries stay in memory and request builds are written on flush"""
+        import sqlite3
+        from precomputed_store import PrecomputedStore
+        path = str(tmp_path / "texts.db")
+        store = PrecomputedStore(path, lambda record: record["text"].upper(), "id", max_entries=2)
+        for i in range(5):
+            assert store.get({"id": i, "text": f"text {i}"}) == f"TEXT {i}"
+        assert store.snapshot()["cached"] == 2 and store.snapshot()["pending_writes"] == 5
+        store.flush()
+        assert sqlite3.connect(path).execute("SELECT count(*) FROM entries").fetchone()[0] == 5
+        assert store.get({"id": 0, "text": "text 0"}) == "TEXT 0" and store.builds == 5  # read back, not rebuilt
+
+    def test_quick_endpoint_sends_brief(self):
+        """Test that the quick endpoints give the agent the brief instead of the raw CV"""
+        from langchain_core.runnables import RunnableLambda
+        from agent_registry import get_agent
+        from career_objective_agent import CareerObjectiveAgent
+        seen = []
+        agent = get_agent(CareerObjectiveAgent, "ollama", "brief-test-model")
+        agent._chain_for = lambda inputs: RunnableLambda(lambda x: seen.append(x["cv_text"]) or "Objective")
+        response = client.post("/generate-objective-quick", json={
+            "user_id": "u1002", "job_id": "7001000001", "llm_name": "ollama", "model_name": "brief-test-model"
+        })
+        assert response.status_code == 200
+        assert seen[0].startswith("Headline: ") and "Skills: " in seen[0]
+
+    def test_brief_lookup_off_event_loop(self, tmp_path, monkeypatch):
+        """Test that a brief not in memory is read or built in a worker thread, and a cached one is not"""
+        import asyncio
+        import threading
+        import candidate_briefs
+        threads = []
+        store = candidate_briefs.BriefStore(str(tmp_path / "briefs.db"))
+        brief_for = store.brief_for
+        store.brief_for = lambda user: threads.append(threading.current_thread()) or brief_for(user)
+        monkeypatch.setattr(candidate_briefs, "brief_store", store)
+        monkeypatch.setattr(candidate_briefs, "CANDIDATE_BRIEFS", True)
+        user = {"user_id": "u1", "name": "Jane Doe", "cv_text": "Data Engineer at Acme Ltd. Skills: Python, SQL."}
+        first = asyncio.run(candidate_briefs.cv_context(user))
+        assert threads and threads[0] is not threading.main_thread()
+        assert asyncio.run(candidate_briefs.cv_context(user)) == first and len(threads) == 1
+
+class TestJobDigests:
+
+    def test_digest_sections(self):
+        """Test that the digest lists skills, requirements, duties and values without the purpose tails"""
+        from job_digests import build_digest
+        description = (
+            "We are seeking a Data Engineer to join our growing team. "
+            "You will build batch pipelines using Python and Apache Spark to feed our reporting platform, "
+            "design data models in PostgreSQL for the analytics team, monitor data quality through automated checks, "
+            "tune slow queries to keep the nightly loads inside their window, write runbooks for the on-call rotation, "
+            "review pull requests from other engineers to share knowledge, automate backfills that used to be run by hand, "
+            "and collaborate with analysts to understand their reporting needs across the business. "
+            "Experience with AWS and Airflow is required. "
+            "We value curiosity and offer flexible working and a learning budget for every engineer."
+        )
+        digest = build_digest({"id": "d1", "title": "Data Engineer", "company_name": "Acme", "description": description})
+        assert digest.startswith("Must-have skills: Python, Apache Spark, PostgreSQL, AWS, Airflow")
+        assert "- Experience with AWS and Airflow is required." in digest
+        assert "- build batch pipelines using Python and Apache Spark\n" in digest
+        assert "- collaborate with analysts" not in digest  # past the duty limit
+        assert "- monitor data quality\n" in digest
+        assert "Company values:\n- We value curiosity" in digest
+        assert "We are seeking" not in digest
+
+    def test_short_description_kept_and_reload_rebuilds(self, tmp_path):
+        """Test that short descriptions are used as-is and a reload digests only the changed jobs"""
+        from data_store import DataStore
+        from job_digests import build_digest
+        from sqlite_store import SQLiteStore
+        short = {"id": "d2", "title": "Chef", "description": "Prepare meals and manage kitchen staff."}
+        other = {"id": "d3", "title": "Baker", "description": "Bake bread."}
+        assert build_digest(short) == short["description"]
+
+        users_path, jobs_path = tmp_path / "users.json", tmp_path / "jobs.json"
+        users_path.write_text("[]")
+        jobs_path.write_text(json.dumps([short, other]))
+        stores = [DataStore(str(users_path), str(jobs_path), poll_interval=0),
+                  SQLiteStore(str(tmp_path / "data.db"), str(users_path), str(jobs_path), poll_interval=0)]
+        for store in stores:
+            store.build_job_digests(build_digest)
+            assert store.digests_built == 2
+        changed = {**short, "description": "Cook and plate dishes."}
+        jobs_path.write_text(json.dumps([changed, other]))
+        for store in stores:
+            store.reload()
+            assert store.digests_built == 3
+            assert store.dataset.job_digest(store.dataset.job("d2")) == "Cook and plate dishes."
+            assert store.dataset.job_digest(short) is None  # stale record
+
+    def test_quick_endpoint_sends_digest(self):
+        """Test that the quick endpoints give the agent the job digest instead of the raw description"""
+        from langchain_core.runnables import RunnableLambda
+        from agent_registry import get_agent
+        from career_objective_agent import CareerObjectiveAgent
+        seen = []
+        agent = get_agent(CareerObjectiveAgent, "ollama", "digest-test-model")
+        agent._chain_for = lambda inputs: RunnableLambda(lambda x: seen.append(x["job_desc"]) or "Objective")
+        response = client.post("/generate-objective-quick", json={
+            "user_id": "u1002", "job_id": "7001000017", "llm_name": "ollama", "model_name": "digest-test-model"
+        })
+        assert response.status_code == 200
+        assert seen[0].startswith("Must-have skills: Python, R, SQL") and "Responsibilities:" in seen[0]
+
+class TestPromptPrefix:
+
+    def test_static_prefix_is_system_message(self, monkeypatch):
+        """Test that the instructions and examples are an identical system message carrying the OpenAI cache key"""
+        from langchain_core.messages import HumanMessage, SystemMessage
+        from cover_letter_agent import PROMPT_PREFIX, CoverLetterAgent
+        from prompt_prefix import build_prompt, prefix_key
+        monkeypatch.setenv("OPENAI_API_KEY", "sk-test")
+        agent = CoverLetterAgent("openai", "gpt-4o-mini")
+        fields = {"job_title": "A", "company_name": "B", "job_desc": "C", "cv_text": "D", "candidate_info": "E"}
+        first = agent.prompt.format_messages(**fields)
+        second = agent.prompt.format_messages(**{**fields, "cv_text": "Something else entirely"})
+        assert isinstance(first[0], SystemMessage) and isinstance(first[1], HumanMessage)
+        assert first[0].content == second[0].content == PROMPT_PREFIX
+        assert "Something else" not in second[0].content
+        payload = agent.llm._get_request_payload(first)
+        assert payload["prompt_cache_key"] == prefix_key(PROMPT_PREFIX)
+        with pytest.raises(ValueError):
+            build_prompt("Write for {company_name}", "CV: {cv_text}")
+
+    def test_cached_tokens_recorded(self):
+        """Test that OpenAI cache_read and Ollama prompt_eval_count are turned into prefix cache hits"""
+        from langchain_core.messages import AIMessage
+        from prompt_prefix import PrefixStats, build_prompt
+        prompt = build_prompt("Guidelines. " * 200, "CV: {cv_text}")
+        stats = PrefixStats()
+        stats.record("openai", prompt, {"cv_text": "x"}, AIMessage("a", usage_metadata={
+            "input_tokens": 700, "output_tokens": 5, "total_tokens": 705, "input_token_details": {"cache_read": 640},
+        }))
+        stats.record("ollama", prompt, {"cv_text": "x"}, AIMessage("a", response_metadata={"prompt_eval_count": 4}))
+        stats.record("ollama", prompt, {"cv_text": "x"}, AIMessage("a", response_metadata={"prompt_eval_count": 690}))
+        stats.record("ollama", prompt, {"cv_text": "x"}, "no usage data")
+        snapshot = stats.snapshot()
+        assert snapshot["openai"]["hit_rate"] == 1.0 and snapshot["openai"]["cached_tokens"] == 640
+        assert snapshot["ollama"]["calls"] == 2 and snapshot["ollama"]["hit_rate"] == 0.5
+
+class TestTemplateDrafts:
+
+    def test_draft_fills_skeleton(self):
+        """Test that the draft fills the example letter from the profile and job, without brackets, in under 20 ms"""
+        from data_store import data_store
+        from main import candidate_info_for
+        from template_drafts import render_cover_letter_draft
+        data = data_store.dataset
+        user, job = data.user("u1001"), data.job("7001000017")
+        start = time.perf_counter()
+        draft = render_cover_letter_draft(user, job, candidate_info_for(user))
+        assert (time.perf_counter() - start) * 1000 < 20
+        assert draft.startswith("Alice Smith\nLondon, United Kingdom")
+        assert "Data Scientist position at Data Intelligence Corp" in draft
+        assert "built over 4 years as a Data Analyst" in draft
+        assert "ability to analyze large datasets using Python, R, and SQL" in draft
+        assert "AWS Certified Cloud Practitioner" in draft and "[" not in draft
+
+    def test_draft_then_polished_or_shed(self):
+        """Test that the draft is returned at once and polling yields the LLM letter, or the draft when shed"""
+        from langchain_core.runnables import RunnableLambda
+        from agent_registry import get_agent
+        from cover_letter_agent import CoverLetterAgent
+        from llm_limiter import LLMOverloadedError
+        agent = get_agent(CoverLetterAgent, "ollama", "draft-test-model")
+        agent._chain_for = lambda inputs: RunnableLambda(lambda x: "Polished letter.")
+        shed_agent = get_agent(CoverLetterAgent, "ollama", "draft-shed-model")
+
+        async def overloaded(**kwargs):
+            raise LLMOverloadedError("ollama", 7, "batch")
+        shed_agent.agenerate = overloaded
+
+        body = {"user_id": "u1001", "job_id": "7001000017", "llm_name": "ollama"}
+        with TestClient(app) as c:
+            results = {}
+            for model in ("draft-test-model", "draft-shed-model"):
+                first = c.post("/generate-quick/draft", json={**body, "model_name": model}).json()
+                assert first["draft"] and first["status"] == "pending" and first["cover_letter"].startswith("Alice Smith")
+                for _ in range(50):
+                    polled = c.get(f"/generate-quick/draft/{first['refinement_id']}").json()
+                    if polled["status"] != "pending":
+                        break
+                    time.sleep(0.02)
+                results[model] = (first, polled)
+            again = c.post("/generate-quick/draft", json={**body, "model_name": "draft-test-model"}).json()
+        first, polled = results["draft-test-model"]
+        assert polled["status"] == "ready" and not polled["draft"] and polled["cover_letter"] == "Polished letter."
+        assert again["status"] == "ready" and not again["draft"] and again["cover_letter"] == "Polished letter."  # cached
+        first, polled = results["draft-shed-model"]
+        assert polled["status"] == "shed" and polled["retry_after"] == 7 and polled["cover_letter"] == first["cover_letter"]
+        assert client.get("/generate-quick/draft/unknown").status_code == 404
+
+class TestParagraphRevision:
+
+    LETTER = "Dear Hiring Manager,\n\nFirst paragraph about data.\n\nSecond paragraph about teams.\n\nSincerely,\nAlice"
+
+    def test_revise_replaces_only_the_paragraph(self):
+        """Test that only the chosen paragraph is regenerated, with its neighbours in the prompt"""
+        from langchain_core.runnables import RunnableLambda
+        from agent_registry import get_agent
+        from cover_letter_agent import CoverLetterAgent
+        agent = get_agent(CoverLetterAgent, "ollama", "revise-test-model")
+        seen = {}
+
+        def rewrite(inputs):
+            seen.update(inputs)
+            return "Here is the rewritten paragraph:\n\nA sharper paragraph\nabout data."
+        agent._revision_chain_for = lambda inputs: RunnableLambda(rewrite)
+
+        response = client.post("/generate/revise", json={
+            "cover_letter": self.LETTER,
+            "paragraph_index": 1,
+            "guidance": "Mention SQL",
+            "job_title": "Data Scientist",
+            "company_name": "Data Intelligence Corp",
+            "model_name": "revise-test-model",
+        })
+        assert response.status_code == 200
+        data = response.json()
+        assert data["paragraph"] == "A sharper paragraph about data."
+        assert data["cover_letter"] == self.LETTER.replace("First paragraph about data.", "A sharper paragraph about data.")
+        assert seen["previous"] == "Dear Hiring Manager," and seen["next"] == "Second paragraph about teams."
+        assert seen["guidance"] == "Mention SQL"
+
+    def test_revise_index_out_of_range(self):
+        """Test that a paragraph index past the end of the letter is rejected"""
+        response = client.post("/generate/revise", json={
+            "cover_letter": self.LETTER,
+            "paragraph_index": 4,
+            "job_title": "Data Scientist",
+            "company_name": "Data Intelligence Corp",
+        })
+        assert response.status_code == 400
+        assert "4 paragraphs" in response.json()["detail"]
+
+class TestOutputLimits:
+
+    def test_ceilings_and_stop_sequences(self):
+        """Test that Ollama chains carry the per-endpoint output ceiling and the trailer stop sequences"""
+        from agent_registry import get_agent
+        from career_objective_agent import CareerObjectiveAgent
+        from cover_letter_agent import CoverLetterAgent
+        from output_limits import TRAILER_STOP_SEQUENCES, token_ceiling
+        inputs = {"job_title": "Data Scientist", "company_name": "Acme", "job_desc": "SQL", "cv_text": "Python"}
+        letter_agent = get_agent(CoverLetterAgent, "ollama", "limits-test-model")
+        objective_agent = get_agent(CareerObjectiveAgent, "ollama", "limits-test-model")
+        letter_llm = letter_agent._chain_for({**inputs, "candidate_info": "Name: Alice"}).last
+        objective_llm = objective_agent._chain_for({**inputs, "current_objective": "None"}).last
+        assert letter_llm.bound.num_predict == token_ceiling(400) == 840
+        assert objective_llm.bound.num_predict == token_ceiling(80) == 168
+        assert letter_llm.kwargs["stop"] == objective_llm.kwargs["stop"] == TRAILER_STOP_SEQUENCES
+
+    def test_truncation_and_trailing_signatures(self):
+        """Test that truncated objectives end at a full sentence, repeated signatures are cut, and both are counted"""
+        from langchain_core.messages import AIMessage
+        from langchain_core.runnables import RunnableLambda
+        from agent_registry import get_agent
+        from career_objective_agent import CareerObjectiveAgent
+        from cover_letter_agent import CoverLetterAgent
+        letter_agent = get_agent(CoverLetterAgent, "ollama", "limits-trim-model")
+        objective_agent = get_agent(CareerObjectiveAgent, "ollama", "limits-trim-model")
+        letter_agent._chain_for = lambda inputs: RunnableLambda(lambda x: AIMessage(
+            content="Dear Hiring Manager,\n\nI apply.\n\nSincerely,\nAlice Smith\n\nSincerely,\nAlice Smith",
+            response_metadata={"done_reason": "stop"},
+        ))
+        objective_agent._chain_for = lambda inputs: RunnableLambda(lambda x: AIMessage(
+            content="Analyst seeking a role at Acme. I also bring a long and", response_metadata={"done_reason": "length"},
+        ))
+        before = client.get("/metrics").json()["output_limits"]
+        letter = letter_agent.generate("Python", "Data Scientist", "Acme", "SQL", {"Name": "Alice Smith"})
+        objective = objective_agent.generate("Python", "Data Scientist", "Acme", "SQL")
+        after = client.get("/metrics").json()["output_limits"]
+        assert letter == "Dear Hiring Manager,\n\nI apply.\n\nSincerely,\nAlice Smith"
+        assert objective == "Analyst seeking a role at Acme."
+        assert after["cover_letter"]["trimmed"] == before.get("cover_letter", {}).get("trimmed", 0) + 1
+        assert after["career_objective"]["truncated"] == before.get("career_objective", {}).get("truncated", 0) + 1
+        assert after["career_objective"]["truncation_rate"] > 0
+
+    def test_application_stops_and_trims_letter(self):
+        """Test that the combined call binds the trailer stop sequences and cuts its letter after the signature"""
+        from langchain_core.messages import AIMessage
+        from langchain_core.runnables import RunnableLambda
+        from agent_registry import get_agent
+        from application_agent import ApplicationAgent
+        from output_limits import TRAILER_STOP_SEQUENCES
+        agent = get_agent(ApplicationAgent, "ollama", "limits-application-model")
+        inputs = {"job_title": "Data Scientist", "company_name": "Acme", "job_desc": "SQL", "cv_text": "Python",
+                  "candidate_info": "Name: Alice", "current_objective": "None"}
+        assert agent._chain_for(inputs).last.kwargs["stop"] == TRAILER_STOP_SEQUENCES
+        answer = {"cover_letter": "Dear Hiring Manager,\n\nI apply.\n\nSincerely,\nAlice Smith\n\nP.S. Hire me.",
+                  "career_objective": "Analyst seeking a role at Acme."}
+        agent._chain_for = lambda inputs: RunnableLambda(lambda x: AIMessage(
+            content=json.dumps(answer), response_metadata={"done_reason": "stop"},
+        ))
+        before = client.get("/metrics").json()["output_limits"].get("application", {}).get("trimmed", 0)
+        application = agent.generate("Python", "Data Scientist", "Acme", "SQL", {"Name": "Alice Smith"})
+        assert application["cover_letter"] == "Dear Hiring Manager,\n\nI apply.\n\nSincerely,\nAlice Smith"
+        assert client.get("/metrics").json()["output_limits"]["application"]["trimmed"] == before + 1
+
+    def test_streamed_letter_ends_at_signature(self):
+        """Test that a streamed letter stops at its signature or a split stop sequence, and its LLM stream is closed"""
+        from langchain_core.language_models.fake import FakeStreamingListLLM
+        from langchain_core.runnables import RunnableGenerator
+        from agent_registry import get_agent
+        from cover_letter_agent import CoverLetterAgent, LetterStreamCutter
+        cutter = LetterStreamCutter()
+        out = "".join(cutter.feed(c) for c in ["Thanks.", "\n\nNo", "te: I tailored it."]) + cutter.flush()
+        assert out == "Thanks." and cutter.done and cutter.trimmed
+
+        agent = get_agent(CoverLetterAgent, "ollama", "stream-cut-model")
+        chain = agent.prompt | FakeStreamingListLLM(
+            responses=["Dear Hiring Manager,\nHello.\n\nSincerely,\nJohn Doe\nSincerely,\nJohn Doe\n\nThis letter highlights..."]
+        )
+        streamed = []
+
+        async def count(chunks):
+            async for chunk in chunks:
+                streamed.append(chunk)
+                yield chunk
+
+        agent._chain_for = lambda inputs: chain | RunnableGenerator(count)
+        response = client.post("/generate/stream", json={
+            "job_title": "Software Developer",
+            "company_name": "Tech Corp",
+            "job_desc": "We are looking for a skilled software developer with Python experience.",
+            "cv_text": "Experienced Python developer with 3 years of experience in web development.",
+            "candidate_info": {"Name": "John Doe", "Email": "john.doe@email.com"},
+            "llm_name": "ollama",
+            "model_name": "stream-cut-model"
+        })
+        events = [block.split("\n", 1) for block in response.text.strip().split("\n\n")]
+        text = "".join(json.loads(e[1].replace("data: ", ""))["text"] for e in events if e[0] == "event: token")
+        assert text == "Dear Hiring Manager,\nHello.\n\nSincerely,\nJohn Doe"
+        assert len(streamed) < len("Dear Hiring Manager,\nHello.\n\nSincerely,\nJohn Doe") + 5
+
+class TestTokenUsage:
+
+    def test_callback_records_provider_usage_and_cost(self, tmp_path):
+        """Test that provider token counts are stored per endpoint, model and hashed API key, with their cost"""
+        from langchain_core.language_models import GenericFakeChatModel
+        from langchain_core.messages import AIMessage
+        from usage_tracker import UsageCallback, UsageTracker, api_key_id, usage_scope
+        tracker = UsageTracker(str(tmp_path / "usage.db"))
+        message = AIMessage(content="Objective", usage_metadata={"input_tokens": 1200, "output_tokens": 300, "total_tokens": 1500})
+        llm = GenericFakeChatModel(messages=iter([message, message]),
+                                   callbacks=[UsageCallback("openai", "gpt-4o-mini", tracker=tracker)])
+        key = api_key_id({"authorization": "Bearer secret-token"})
+        with usage_scope("/generate-objective", key):
+            llm.invoke("prompt")
+            llm.invoke("prompt")
+        snapshot = tracker.snapshot()
+        assert snapshot["by_endpoint"]["/generate-objective"]["input_tokens"] == 2400
+        assert snapshot["by_model"]["openai/gpt-4o-mini"]["output_tokens"] == 600
+        assert snapshot["by_model"]["openai/gpt-4o-mini"]["cost_usd"] == round((2400 * 0.15 + 600 * 0.60) / 1e6, 6)
+        assert snapshot["by_api_key"][key]["calls"] == 2 and "secret" not in key
+
+    def test_cut_stream_records_estimated_tokens(self, tmp_path):
+        """Test that a letter stream closed at its signature still records its prompt and streamed tokens"""
+        import asyncio
+        from langchain_core.language_models import GenericFakeChatModel
+        from langchain_core.messages import AIMessage
+        from agent_registry import get_agent
+        from cover_letter_agent import CoverLetterAgent
+        from usage_tracker import UsageCallback, UsageTracker, tally_request_tokens
+        tracker = UsageTracker(str(tmp_path / "usage.db"))
+        agent = get_agent(CoverLetterAgent, "ollama", "usage-cut-model")
+        llm = GenericFakeChatModel(
+            messages=iter([AIMessage(content="Dear Hiring Manager,\n\nHello.\n\nSincerely,\nJohn Doe\n\nThis letter shows my fit.")]),
+            callbacks=[UsageCallback("openai", "gpt-4o-mini", tracker=tracker)],
+        )
+        agent._chain_for = lambda inputs: agent.prompt | llm
+
+        async def stream():
+            return "".join([text async for text in agent.astream("Python", "Developer", "Acme", "Python", {"Name": "John Doe"})])
+
+        with tally_request_tokens() as tally:
+            letter = asyncio.run(stream())
+        assert letter == "Dear Hiring Manager,\n\nHello.\n\nSincerely,\nJohn Doe"
+        assert tally[0] > 0
+        usage = tracker.snapshot()["by_model"]["openai/gpt-4o-mini"]
+        assert usage["input_tokens"] > 0 and usage["output_tokens"] > 0 and usage["estimated_calls"] == 1
+
+    def test_request_usage_attributed_to_endpoint(self):
+        """Test that tokens of an LLM call made by a request show up under its endpoint in /metrics"""
+        from langchain_core.language_models import GenericFakeChatModel
+        from langchain_core.messages import AIMessage
+        from agent_registry import get_agent
+        from cover_letter_agent import CoverLetterAgent
+        from prompt_compaction import count_tokens
+        from usage_tracker import UsageCallback
+        agent = get_agent(CoverLetterAgent, "ollama", "usage-test-model")
+        llm = GenericFakeChatModel(messages=iter([AIMessage(content="A better paragraph.")]),
+                                   callbacks=[UsageCallback("ollama", "usage-test-model", count_tokens)])
+        agent._revision_chain_for = lambda inputs: agent.revision_prompt | llm
+
+        def revise_usage():
+            usage = client.get("/metrics").json()["token_usage"]["by_endpoint"].get("/generate/revise", {})
+            return usage.get("calls", 0), usage.get("estimated_calls", 0)
+        before = revise_usage()
+        response = client.post("/generate/revise", headers={"Authorization": "Bearer usage-test"}, json={
+            "cover_letter": "Dear Hiring Manager,\n\nFirst paragraph.\n\nSincerely,\nAlice",
+            "paragraph_index": 1,
+            "job_title": "Data Scientist",
+            "company_name": "Acme",
+            "model_name": "usage-test-model",
+        })
+        assert response.status_code == 200
+        # The fake model reports no usage, so the tokens are counted locally
+        assert revise_usage() == (before[0] + 1, before[1] + 1)
+
+class TestTokenRateLimit:
+
+    def test_bucket_charges_and_settles(self, tmp_path):
+        """Test that a charge is refused when it does not fit, and settling returns the unused estimate"""
+        from token_rate_limit import TokenBuckets
+        buckets = TokenBuckets(str(tmp_path / "buckets.db"), capacity=1000, refill_per_minute=600)
+        first = buckets.charge("key-a", 800)
+        assert first.allowed and 199 <= first.remaining <= 201
+        refused = buckets.charge("key-a", 500)
+        assert not refused.allowed and 29 <= refused.retry_after <= 31
+        assert refused.headers()["Retry-After"] in ("30", "31") and refused.headers()["RateLimit-Limit"] == "1000"
+        buckets.settle("key-a", 800, 100)  # used 100 of the 800 charged
+        assert buckets.charge("key-a", 500).allowed
+        assert buckets.charge("key-b", 5000).allowed  # capped at the bucket size
+
+    def test_heavy_usage_is_throttled(self, tmp_path, monkeypatch):
+        """Test that responses carry RateLimit headers and a client is throttled by the tokens it used"""
+        import main
+        from langchain_core.runnables import RunnableLambda
+        from agent_registry import get_agent
+        from career_objective_agent import CareerObjectiveAgent
+        from token_rate_limit import TokenBuckets
+        from usage_tracker import usage_tracker
+        monkeypatch.setattr(main, "token_buckets", TokenBuckets(str(tmp_path / "buckets.db"), capacity=4000))
+        agent = get_agent(CareerObjectiveAgent, "ollama", "rate-test-model")
+
+        def heavy(_):
+            usage_tracker.record("ollama", "rate-test-model", 3000, 500)
+            return "Objective"
+        agent._chain_for = lambda inputs: RunnableLambda(heavy)
+
+        payload = {"user_id": "u1001", "job_id": "7001000002", "llm_name": "ollama",
+                   "model_name": "rate-test-model", "regenerate": True}
+        headers = {"Authorization": "Bearer rate-test"}
+        first = client.post("/generate-objective-quick", json=payload, headers=headers)
+        assert first.status_code == 200
+        assert first.headers["RateLimit-Limit"] == "4000" and int(first.headers["RateLimit-Remaining"]) < 4000
+        second = client.post("/generate-objective-quick", json=payload, headers=headers)
+        assert second.status_code == 429 and int(second.headers["Retry-After"]) > 0
+        # Another API key has its own bucket
+        other = client.post("/generate-objective-quick", json=payload, headers={"Authorization": "Bearer rate-other"})
+        assert other.status_code == 200
+
+    def test_draft_refinement_is_settled(self, tmp_path, monkeypatch):
+        """Test that the tokens a draft refinement uses after its response are charged once it finishes"""
+        import main
+        from langchain_core.runnables import RunnableLambda
+        from agent_registry import get_agent
+        from cover_letter_agent import CoverLetterAgent
+        from token_rate_limit import TokenBuckets
+        from usage_tracker import api_key_id, usage_tracker
+        buckets = TokenBuckets(str(tmp_path / "buckets.db"), capacity=40000)
+        monkeypatch.setattr(main, "token_buckets", buckets)
+        agent = get_agent(CoverLetterAgent, "ollama", "rate-draft-model")
+
+        def refinement(_):
+            usage_tracker.record("ollama", "rate-draft-model", 3000, 800)
+            return "Polished letter."
+        agent._chain_for = lambda inputs: RunnableLambda(refinement)
+
+        payload = {"user_id": "u1001", "job_id": "7001000017", "llm_name": "ollama",
+                   "model_name": "rate-draft-model", "regenerate": True}
+        headers = {"Authorization": "Bearer rate-draft"}
+        with TestClient(app) as c:
+            first = c.post("/generate-quick/draft", json=payload, headers=headers).json()
+            for _ in range(50):
+                if c.get(f"/generate-quick/draft/{first['refinement_id']}").json()["status"] != "pending":
+                    break
+                time.sleep(0.02)
+        remaining = buckets.charge(api_key_id({"authorization": "Bearer rate-draft"}), 0).remaining
+        assert 40000 - 3800 <= remaining <= 40000 - 3800 + 500
+
+    def test_unrecorded_calls_keep_estimate_and_failures_settle(self, tmp_path, monkeypatch):
+        """Test that LLM calls with no recorded tokens are charged the estimate, and a failed request is settled"""
+        import asyncio
+        import main
+        from token_rate_limit import TokenBuckets, TokenCharge
+        from usage_tracker import api_key_id
+        buckets = TokenBuckets(str(tmp_path / "buckets.db"), capacity=1000, refill_per_minute=1)
+        for client_key, tally in (("ran", [0, 1]), ("cached", [0, 0])):
+            buckets.charge(client_key, 800)
+            asyncio.run(TokenCharge(buckets, client_key, 800, tally).release())
+        assert 200 <= buckets.charge("ran", 0).remaining <= 201
+        assert buckets.charge("cached", 0).remaining == 1000
+
+        monkeypatch.setattr(main, "token_buckets", buckets)
+        monkeypatch.setattr(main, "get_agent", lambda *args: (_ for _ in ()).throw(RuntimeError("boom")))
+        with pytest.raises(RuntimeError):
+            client.post("/generate-objective/stream", headers={"Authorization": "Bearer rate-fail"}, json={
+                "cv_text": "Python developer", "job_title": "Developer", "company_name": "Acme Corp",
+                "job_desc": "Python services", "llm_name": "ollama", "model_name": "rate-fail-model",
+            })
+        assert buckets.charge(api_key_id({"authorization": "Bearer rate-fail"}), 0).remaining == 1000  # refunded
+
 if __name__ == "__main__":
     pytest.main([__file__, "-v"])
\ No newline at end of file
@@ -0,0 +1,241 @@
+import asyncio
+import json
+import logging
+import math
+import os
+import sqlite3
+import threading
+import time
+from contextvars import ContextVar
+from dataclasses import dataclass
+from typing import Dict, List, Optional
+
+import application_agent
+import career_objective_agent
+import cover_letter_agent
+from prompt_compaction import TOKEN_BUDGETS, count_tokens
+
+logger = logging.getLogger(__name__)
+
+# Each client (API key, or IP without one) has a bucket of LLM tokens that
+# refills continuously. The defaults allow about what the old flat limits did
+# for typical requests: 20k tokens a minute, bursts of up to 40k.
+TOKEN_RATE_LIMIT = os.getenv("TOKEN_RATE_LIMIT", "1") == "1"
+TOKEN_BUCKET_CAPACITY = int(os.getenv("TOKEN_BUCKET_CAPACITY", "40000"))
+TOKEN_BUCKET_REFILL_PER_MINUTE = float(os.getenv("TOKEN_BUCKET_REFILL_PER_MINUTE", "20000"))
+TOKEN_BUCKET_DB = os.getenv("TOKEN_BUCKET_DB", "rate_limits.db")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS buckets (
+    client TEXT PRIMARY KEY,
+    tokens REAL NOT NULL,
+    updated REAL NOT NULL
+);
+"""
+
+
+@dataclass(frozen=True)
+class EndpointCost:
+    """How many LLM tokens a request to an endpoint is charged up front."""
+
+    prefix_tokens: int  # the static system message
+    max_input_tokens: int  # request fields after compaction
+    output_tokens: int  # the endpoint's output token ceiling
+    stored: bool = False  # fields come from the data store, so charge the full input budget
+    bulk: bool = False  # one generation per ID in `job_ids`/`user_ids`
+
+    def estimate(self, body: bytes) -> int:
+        try:
+            payload = json.loads(body or b"{}")
+        except ValueError:
+            payload = {}
+        if not isinstance(payload, dict):
+            payload = {}
+        if self.stored:
+            input_tokens = self.max_input_tokens
+        else:
+            text = " ".join(str(v) for v in payload.values() if isinstance(v, (str, dict)))
+            input_tokens = min(count_tokens(text), self.max_input_tokens)
+        items = len(payload.get("job_ids") or payload.get("user_ids") or [None]) if self.bulk else 1
+        return (self.prefix_tokens + input_tokens + self.output_tokens) * items
+
+
+def _cost(prefix: str, budget: str, output_tokens: int, fields_allowance: int = 200, **kwargs) -> EndpointCost:
+    budgets = TOKEN_BUDGETS[budget]
+    return EndpointCost(
+        count_tokens(prefix), budgets["cv_text"] + budgets["job_desc"] + fields_allowance, output_tokens, **kwargs
+    )
+
+
+_LETTER = (cover_letter_agent.PROMPT_PREFIX, "cover_letter", cover_letter_agent.MAX_OUTPUT_TOKENS)
+_OBJECTIVE = (career_objective_agent.PROMPT_PREFIX, "career_objective", career_objective_agent.MAX_OUTPUT_TOKENS)
+_APPLICATION = (application_agent.PROMPT_PREFIX, "application", application_agent.MAX_OUTPUT_TOKENS)
+
+# LLM endpoints (POST) and what they are charged up front
+ENDPOINT_COSTS: Dict[str, EndpointCost] = {
+    "/generate": _cost(*_LETTER),
+    "/generate/stream": _cost(*_LETTER),
+    # The letter itself is context for the rewritten paragraph
+    "/generate/revise": _cost(
+        cover_letter_agent.REVISION_PROMPT, "cover_letter_revision", cover_letter_agent.REVISION_MAX_OUTPUT_TOKENS,
+        fields_allowance=1000,
+    ),
+    "/generate-quick": _cost(*_LETTER, stored=True),
+    "/generate-quick/draft": _cost(*_LETTER, stored=True),
+    "/generate-quick/bulk": _cost(*_LETTER, stored=True, bulk=True),
+    "/generate-objective": _cost(*_OBJECTIVE),
+    "/generate-objective/stream": _cost(*_OBJECTIVE),
+    "/generate-objective-quick": _cost(*_OBJECTIVE, stored=True),
+    "/generate-objective-quick/bulk": _cost(*_OBJECTIVE, stored=True, bulk=True),
+    "/generate-application": _cost(*_APPLICATION),
+    "/generate-application-quick": _cost(*_APPLICATION, stored=True),
+}
+
+
+@dataclass
+class BucketState:
+    """A client's bucket after a charge, and the `RateLimit-*` headers describing it."""
+
+    allowed: bool
+    limit: int
+    remaining: float
+    reset: float  # seconds until the bucket is full again
+    retry_after: Optional[float] = None  # seconds until the denied charge would fit
+    window: float = 60.0  # seconds for an empty bucket to refill
+
+    def headers(self) -> Dict[str, str]:
+        headers = {
+            "RateLimit-Policy": f"{self.limit};w={math.ceil(self.window)}",
+            "RateLimit-Limit": str(self.limit),
+            "RateLimit-Remaining": str(max(0, int(self.remaining))),
+            "RateLimit-Reset": str(math.ceil(self.reset)),
+        }
+        if self.retry_after is not None:
+            headers["Retry-After"] = str(max(1, math.ceil(self.retry_after)))
+        return headers
+
+
+class TokenBuckets:
+    """Token buckets per client in a SQLite file, so every worker draws from the same bucket.
+
+    A request is charged its estimated tokens before it runs and settled
+    against the tokens it actually used once its response is sent. A charge
+    larger than the whole bucket is capped at the bucket size, so a big bulk
+    request can still run when the bucket is full; settling may then leave
+    the bucket negative, and the client waits until it refills.
+    """
+
+    def __init__(self, path: str = TOKEN_BUCKET_DB, capacity: int = TOKEN_BUCKET_CAPACITY,
+                 refill_per_minute: float = TOKEN_BUCKET_REFILL_PER_MINUTE):
+        self.path = path
+        self.capacity = capacity
+        self.refill_per_second = refill_per_minute / 60
+        self._lock = threading.Lock()
+        self.counts = {"charged": 0, "throttled": 0, "estimated_tokens": 0, "actual_tokens": 0}
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.executescript(SCHEMA)
+        return conn
+
+    def _update(self, client: str, change) -> float:
+        """Apply `change(tokens) -> tokens` to the refilled bucket in one write transaction; returns the new level."""
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            now = time.time()
+            row = conn.execute("SELECT tokens, updated FROM buckets WHERE client = ?", (client,)).fetchone()
+            tokens = self.capacity if row is None else min(self.capacity, row[0] + (now - row[1]) * self.refill_per_second)
+            tokens = change(tokens)
+            conn.execute(
+                "INSERT INTO buckets VALUES (?, ?, ?) ON CONFLICT (client) DO UPDATE SET tokens = excluded.tokens, "
+                "updated = excluded.updated",
+                (client, tokens, now),
+            )
+            conn.execute("COMMIT")
+            return tokens
+        except BaseException:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            raise
+        finally:
+            conn.close()
+
+    def _state(self, allowed: bool, tokens: float, needed: float = 0) -> BucketState:
+        return BucketState(
+            allowed=allowed,
+            limit=self.capacity,
+            remaining=tokens,
+            reset=(self.capacity - tokens) / self.refill_per_second,
+            retry_after=None if allowed else (needed - tokens) / self.refill_per_second,
+            window=self.capacity / self.refill_per_second,
+        )
+
+    def charge(self, client: str, estimate: int) -> BucketState:
+        """Take the estimate (capped at the bucket size) if it fits; otherwise take nothing."""
+        needed = min(estimate, self.capacity)
+        allowed = False
+
+        def take(tokens: float) -> float:
+            nonlocal allowed
+            allowed = tokens >= needed
+            return tokens - needed if allowed else tokens
+
+        tokens = self._update(client, take)
+        with self._lock:
+            self.counts["charged" if allowed else "throttled"] += 1
+            self.counts["estimated_tokens"] += needed if allowed else 0
+        return self._state(allowed, tokens, needed)
+
+    def settle(self, client: str, charged: int, actual: int):
+        """Return the unused part of a charge, or take the tokens used beyond it."""
+        charged = min(charged, self.capacity)
+        self._update(client, lambda tokens: min(self.capacity, tokens + charged - actual))
+        with self._lock:
+            self.counts["actual_tokens"] += actual
+
+    def snapshot(self) -> Dict:
+        with self._lock:
+            return {
+                "enabled": TOKEN_RATE_LIMIT,
+                "capacity": self.capacity,
+                "refill_per_minute": self.refill_per_second * 60,
+                **self.counts,
+            }
+
+
+token_buckets = TokenBuckets()
+
+
+class TokenCharge:
+    """A request's up-front charge, settled once its response and any background work it started are done.
+
+    The response holds the charge until its body is sent; work that outlives
+    it (a draft refinement) takes its own `hold()` and `release()`s it when
+    it finishes, so the tokens it uses are settled too.
+    """
+
+    def __init__(self, buckets: TokenBuckets, client: str, estimate: int, tally: List[int]):
+        self.buckets = buckets
+        self.client = client
+        self.estimate = estimate
+        self.tally = tally  # the request's [tokens, LLM calls], from usage_tracker.tally_request_tokens
+        self._holds = 1
+
+    def hold(self):
+        self._holds += 1
+
+    async def release(self):
+        self._holds -= 1
+        if self._holds == 0:
+            actual, calls = self.tally
+            if not actual and calls:
+                # LLM calls ran but none was recorded; keep the estimate rather than refund it
+                logger.warning(f"No tokens recorded for {calls} LLM call(s) of {self.client}, charging the estimate")
+                actual = self.estimate
+            await asyncio.to_thread(self.buckets.settle, self.client, self.estimate, actual)
+
+
+# The current request's charge, when the endpoint is token rate limited
+current_charge: ContextVar[Optional[TokenCharge]] = ContextVar("token_charge", default=None)
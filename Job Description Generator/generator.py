@@ -10,6 +10,9 @@ from dotenv import load_dotenv
 from langchain_core.prompts import ChatPromptTemplate
 from langchain_core.output_parsers import JsonOutputParser
 
+from llm_limiter import LLMOverloadedError, get_limiter
+from usage_tracker import UsageCallback
+
 load_dotenv()
 
 class JobParams(BaseModel):
@@ -191,7 +194,8 @@ Generate valid JSON in this exact format:
                 frequency_penalty=0.1,
                 request_timeout=120,
                 max_retries=3,
-                api_key=api_key
+                api_key=api_key,
+                callbacks=[UsageCallback(self.model_type, self.model_name)]
             )
             self.parser = JsonOutputParser(pydantic_object=JobDescription)
             
@@ -206,30 +210,31 @@ Generate valid JSON in this exact format:
             experience_value = params.experience if params.experience is not None else "AI_DETERMINE"
             industry_value = params.industry or "AI_DETERMINE"
 
-            response = await chain.ainvoke({
-                "job_title": params.job_title,
-                "experience": experience_value,
-                "education": params.education,
-                "industry": industry_value,
-                "location_type": params.location_type,
-                "required_skills": params.required_skills or "Generate based on job title and industry",
-                "company_name": params.company_name,
-                "company_information": params.company_information,
-                "employment_type": params.employment_type,
-                "experience_level": params.experience_level,
-                "job_responsibilities": params.job_responsibilities or "Not specified",
-                "required_qualifications": params.required_qualifications or "Not specified",
-                "preferred_skills": params.preferred_skills or "Generate 2-5 relevant preferred skills based on job title and industry",
-                "salary_range": params.salary_range,
-                "benefits_perks": params.benefits_perks or "Not specified",
-                "additional_notes": params.additional_notes or "Not specified",
-                "timestamp": datetime.now().isoformat(),
-                "model_type": self.model_type,
-                "model_name": self.model_name,
-                "valid_experience_levels": VALID_EXPERIENCE_LEVELS,
-                "valid_location_types": VALID_LOCATION_TYPES,
-                "valid_employment_types": VALID_EMPLOYMENT_TYPES
-            })
+            async with get_limiter(self.model_type, self.model_name).aslot():
+                response = await chain.ainvoke({
+                    "job_title": params.job_title,
+                    "experience": experience_value,
+                    "education": params.education,
+                    "industry": industry_value,
+                    "location_type": params.location_type,
+                    "required_skills": params.required_skills or "Generate based on job title and industry",
+                    "company_name": params.company_name,
+                    "company_information": params.company_information,
+                    "employment_type": params.employment_type,
+                    "experience_level": params.experience_level,
+                    "job_responsibilities": params.job_responsibilities or "Not specified",
+                    "required_qualifications": params.required_qualifications or "Not specified",
+                    "preferred_skills": params.preferred_skills or "Generate 2-5 relevant preferred skills based on job title and industry",
+                    "salary_range": params.salary_range,
+                    "benefits_perks": params.benefits_perks or "Not specified",
+                    "additional_notes": params.additional_notes or "Not specified",
+                    "timestamp": datetime.now().isoformat(),
+                    "model_type": self.model_type,
+                    "model_name": self.model_name,
+                    "valid_experience_levels": VALID_EXPERIENCE_LEVELS,
+                    "valid_location_types": VALID_LOCATION_TYPES,
+                    "valid_employment_types": VALID_EMPLOYMENT_TYPES
+                })
             
             ai_end_time = time.perf_counter()
             ai_generation_time = ai_end_time - ai_start_time
@@ -264,6 +269,8 @@ Generate valid JSON in this exact format:
                     if attempt == max_attempts - 1:
                         raise Exception(f"JSON parsing failed after {max_attempts} attempts: {e}")
                     
+        except LLMOverloadedError:
+            raise
         except Exception as e:
             raise Exception(f"OpenAI generation failed: {e}")
 
@@ -0,0 +1,47 @@
+import hashlib
+import json
+from typing import Any, Dict, Optional
+
+from fastapi import Request
+from fastapi.responses import JSONResponse, Response
+
+
+def make_etag(*parts: Any) -> str:
+    """Weak ETag over the JSON form of `parts` (dataset version, query, payload...)."""
+    digest = hashlib.sha1(json.dumps(parts, sort_keys=True, default=str).encode()).hexdigest()[:20]
+    return f'W/"{digest}"'
+
+
+def etag_matches(request: Request, etag: str) -> bool:
+    """True if the request's If-None-Match already names `etag` (weak comparison)."""
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    if header.strip() == "*":
+        return True
+    opaque = etag[2:] if etag.startswith("W/") else etag
+    return any(
+        (tag[2:] if tag.startswith("W/") else tag) == opaque
+        for tag in (t.strip() for t in header.split(","))
+    )
+
+
+def cache_headers(etag: str, cache_control: str = "no-cache") -> Dict[str, str]:
+    return {"ETag": etag, "Cache-Control": cache_control}
+
+
+def not_modified(etag: str, cache_control: str = "no-cache") -> Response:
+    return Response(status_code=304, headers=cache_headers(etag, cache_control))
+
+
+def conditional_json(request: Request, content: Any, etag: Optional[str] = None, cache_control: str = "no-cache") -> Response:
+    """JSONResponse with an ETag, or 304 when the client already has this version.
+
+    Without an explicit `etag` the content itself is hashed, so only pass
+    content without per-request fields such as timestamps, or pass an etag
+    computed from the stable part.
+    """
+    etag = etag or make_etag(content)
+    if etag_matches(request, etag):
+        return not_modified(etag, cache_control)
+    return JSONResponse(content, headers=cache_headers(etag, cache_control))
@@ -1,3 +1,4 @@
+import asyncio
 import json
 import os
 from datetime import datetime
@@ -16,6 +17,12 @@ from generator import (
     VALID_LOCATION_TYPES,
     VALID_EMPLOYMENT_TYPES
 )
+from llm_limiter import LLMOverloadedError, limiter_snapshots
+from http_caching import cache_headers, etag_matches, make_etag, not_modified
+from usage_tracker import api_key_id, usage_scope, usage_tracker
+
+# The valid options only change on deploy.
+OPTIONS_CACHE_CONTROL = "public, max-age=3600"
 
 app = FastAPI(
     title="AI Job Description Generator API",
@@ -31,6 +38,12 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Charge LLM tokens to the endpoint and API key
+@app.middleware("http")
+async def attribute_usage(request: Request, call_next):
+    with usage_scope(request.url.path, api_key_id(request.headers)):
+        return await call_next(request)
+
 generator = None
 
 def get_generator():
@@ -193,7 +206,8 @@ async def http_exception_handler(request: Request, exc: HTTPException):
             "message": exc.detail,
             "status_code": exc.status_code,
             "timestamp": datetime.now().isoformat()
-        }
+        },
+        headers=getattr(exc, "headers", None)
     )
 
 @app.exception_handler(404)
@@ -266,6 +280,15 @@ async def health_check():
             detail=f"Service unhealthy: {str(e)}"
         )
 
+@app.get("/metrics")
+async def metrics():
+    """LLM concurrency limiter state and token usage per model"""
+    return {
+        "llm_limiters": limiter_snapshots(),
+        "token_usage": await asyncio.to_thread(usage_tracker.snapshot),
+        "timestamp": datetime.now().isoformat()
+    }
+
 @app.post("/api/v1/job-description/generate", response_model=JobDescriptionResponse)
 async def generate_job_description(request: JobDescriptionRequest):
     """
@@ -295,7 +318,7 @@ async def generate_job_description(request: JobDescriptionRequest):
     - HTTP 200: Successfully generated job description
     - HTTP 422: Validation error (e.g., empty job_title)
     - HTTP 500: Internal server error
-    - HTTP 503: Service unavailable (AI service issue)
+    - HTTP 503: Service unavailable (AI service issue or at capacity, with Retry-After)
     """
     try:
        
@@ -330,6 +353,17 @@ async def generate_job_description(request: JobDescriptionRequest):
         
     except HTTPException:
         raise
+    except LLMOverloadedError as e:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail={
+                "error": "Service Overloaded",
+                "message": "AI service is at capacity, please retry later",
+                "retry_after_seconds": e.retry_after,
+                "timestamp": datetime.now().isoformat()
+            },
+            headers={"Retry-After": str(e.retry_after)}
+        )
     except json.JSONDecodeError as e:
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
@@ -368,24 +402,35 @@ async def generate_job_description(request: JobDescriptionRequest):
         )
 
 @app.get("/api/v1/job-description/valid-options")
-async def get_valid_options():
+async def get_valid_options(request: Request):
     """
     Get valid options for job description parameters
     
+    Responses carry an ETag over the options; send it back in
+    `If-None-Match` to get a 304 while they are unchanged.
+    
     **Returns:**
     - HTTP 200: Successfully retrieved valid options
+    - HTTP 304: Options unchanged since the ETag in If-None-Match
     - HTTP 500: Internal server error
     """
     try:
-        return {
-            "success": True,
-            "data": {
-                "experience_levels": VALID_EXPERIENCE_LEVELS,
-                "location_types": VALID_LOCATION_TYPES,
-                "employment_types": VALID_EMPLOYMENT_TYPES
-            },
-            "timestamp": datetime.now().isoformat()
+        data = {
+            "experience_levels": VALID_EXPERIENCE_LEVELS,
+            "location_types": VALID_LOCATION_TYPES,
+            "employment_types": VALID_EMPLOYMENT_TYPES
         }
+        etag = make_etag(data)
+        if etag_matches(request, etag):
+            return not_modified(etag, OPTIONS_CACHE_CONTROL)
+        return JSONResponse(
+            content={
+                "success": True,
+                "data": data,
+                "timestamp": datetime.now().isoformat()
+            },
+            headers=cache_headers(etag, OPTIONS_CACHE_CONTROL)
+        )
     except Exception as e:
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
@@ -0,0 +1,293 @@
+import asyncio
+import atexit
+import hashlib
+import json
+import logging
+import math
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import date
+from typing import Callable, Dict, Iterator, List, Mapping, Optional, Tuple
+from uuid import UUID
+
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.outputs import LLMResult
+
+logger = logging.getLogger(__name__)
+
+USAGE_DB = os.getenv("USAGE_DB", "usage.db")
+USAGE_FLUSH_SECONDS = float(os.getenv("USAGE_FLUSH_SECONDS", "60"))
+
+# USD per million input and output tokens; Ollama models run locally and cost nothing.
+# Override or extend with MODEL_PRICES='{"gpt-4o-mini": [0.15, 0.6]}'.
+MODEL_PRICES: Dict[str, Tuple[float, float]] = {
+    "gpt-4o-mini": (0.15, 0.60),
+    "gpt-4o": (2.50, 10.00),
+    "gpt-4.1-mini": (0.40, 1.60),
+    "gpt-4.1": (2.00, 8.00),
+    **{model: tuple(price) for model, price in json.loads(os.getenv("MODEL_PRICES", "{}")).items()},
+}
+
+ANONYMOUS = "anonymous"
+UNATTRIBUTED = "internal"  # calls made outside a request, e.g. startup checks
+# For estimates when a callback has no tokenizer
+CHARS_PER_TOKEN = 4
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS usage (
+    day TEXT NOT NULL,
+    endpoint TEXT NOT NULL,
+    backend TEXT NOT NULL,
+    model TEXT NOT NULL,
+    api_key TEXT NOT NULL,
+    calls INTEGER NOT NULL,
+    input_tokens INTEGER NOT NULL,
+    output_tokens INTEGER NOT NULL,
+    estimated_calls INTEGER NOT NULL,
+    PRIMARY KEY (day, endpoint, backend, model, api_key)
+);
+"""
+
+# (endpoint, api key id) that LLM calls in the current request are charged to
+current_usage_scope: ContextVar[Tuple[str, str]] = ContextVar("usage_scope", default=(UNATTRIBUTED, ANONYMOUS))
+# Running [input + output tokens, LLM calls started] of the current request, when something is tallying them
+current_request_tokens: ContextVar[Optional[List[int]]] = ContextVar("request_tokens", default=None)
+
+
+def api_key_id(headers: Mapping[str, str]) -> str:
+    """Stable, non-reversible id of the request's API key (Bearer token or X-API-Key)."""
+    authorization = headers.get("authorization", "")
+    key = authorization[7:].strip() if authorization.lower().startswith("bearer ") else headers.get("x-api-key", "")
+    if not key:
+        return ANONYMOUS
+    return "key-" + hashlib.sha256(key.encode()).hexdigest()[:12]
+
+
+@contextmanager
+def usage_scope(endpoint: str, api_key: str = ANONYMOUS):
+    """Charge the enclosed LLM calls (including ones in threadpool workers and spawned tasks) to `endpoint` and `api_key`."""
+    token = current_usage_scope.set((endpoint, api_key))
+    try:
+        yield
+    finally:
+        current_usage_scope.reset(token)
+
+
+@contextmanager
+def tally_request_tokens() -> Iterator[List[int]]:
+    """Yield `[tokens, calls]`: the enclosed LLM calls add their input and output tokens, and count themselves when they start."""
+    tally = [0, 0]
+    token = current_request_tokens.set(tally)
+    try:
+        yield tally
+    finally:
+        current_request_tokens.reset(token)
+
+
+def cost_usd(model: str, input_tokens: int, output_tokens: int, backend: str) -> Optional[float]:
+    """Estimated cost of the tokens, or None for a hosted model with no known price."""
+    if backend.startswith("ollama"):
+        return 0.0
+    price = MODEL_PRICES.get(model)
+    if price is None:
+        return None
+    return (input_tokens * price[0] + output_tokens * price[1]) / 1e6
+
+
+class UsageTracker:
+    """Input and output tokens per day, endpoint, backend, model and API key.
+
+    Calls are added up in memory and flushed every USAGE_FLUSH_SECONDS (and
+    at exit) to a SQLite file, with one row per key and day. Workers of the
+    same service share the file, so the snapshot covers all of them.
+    """
+
+    def __init__(self, path: str = USAGE_DB, flush_seconds: float = USAGE_FLUSH_SECONDS):
+        self.path = path
+        self.flush_seconds = flush_seconds
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._pending: Dict[Tuple[str, str, str, str, str], list] = {}
+        self._flusher: Optional[threading.Thread] = None
+        self.flushed_at: Optional[float] = None
+        self.flush_errors = 0
+
+    def record(self, backend: str, model: str, input_tokens: int, output_tokens: int, estimated: bool = False):
+        """Add one LLM call to the current request's endpoint and API key."""
+        endpoint, api_key = current_usage_scope.get()
+        key = (date.today().isoformat(), endpoint, backend, model, api_key)
+        tally = current_request_tokens.get()
+        if tally is not None:
+            tally[0] += input_tokens + output_tokens
+        with self._lock:
+            totals = self._pending.setdefault(key, [0, 0, 0, 0])
+            totals[0] += 1
+            totals[1] += input_tokens
+            totals[2] += output_tokens
+            totals[3] += int(estimated)
+            if self._flusher is None:
+                self._start_flusher()
+
+    def _start_flusher(self):
+        self._flusher = threading.Thread(target=self._flush_loop, name="usage-flusher", daemon=True)
+        self._flusher.start()
+        atexit.register(self.flush)
+
+    def _flush_loop(self):
+        while True:
+            time.sleep(self.flush_seconds)
+            self.flush()
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, timeout=10)
+        conn.executescript(SCHEMA)
+        return conn
+
+    def flush(self):
+        """Write the pending totals to the store; on failure they are kept for the next flush."""
+        with self._flush_lock:
+            with self._lock:
+                pending, self._pending = self._pending, {}
+            if not pending:
+                return
+            try:
+                conn = self._connect()
+                try:
+                    with conn:
+                        conn.executemany(
+                            "INSERT INTO usage VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?) "
+                            "ON CONFLICT (day, endpoint, backend, model, api_key) DO UPDATE SET "
+                            "calls = calls + excluded.calls, input_tokens = input_tokens + excluded.input_tokens, "
+                            "output_tokens = output_tokens + excluded.output_tokens, "
+                            "estimated_calls = estimated_calls + excluded.estimated_calls",
+                            [(*key, *totals) for key, totals in pending.items()],
+                        )
+                finally:
+                    conn.close()
+                self.flushed_at = time.time()
+            except sqlite3.Error as e:
+                logger.error(f"Flushing token usage to {self.path} failed: {str(e)}")
+                self.flush_errors += 1
+                with self._lock:
+                    for key, totals in pending.items():
+                        merged = self._pending.setdefault(key, [0, 0, 0, 0])
+                        for i, value in enumerate(totals):
+                            merged[i] += value
+
+    def _rollup(self, conn: sqlite3.Connection, column: str) -> Dict[str, Dict]:
+        rollup: Dict[str, Dict] = {}
+        rows = conn.execute(
+            f"SELECT {column}, backend, model, SUM(calls), SUM(input_tokens), SUM(output_tokens), SUM(estimated_calls) "
+            f"FROM usage GROUP BY {column}, backend, model"
+        )
+        for name, backend, model, calls, input_tokens, output_tokens, estimated in rows:
+            entry = rollup.setdefault(name, {"calls": 0, "input_tokens": 0, "output_tokens": 0, "estimated_calls": 0,
+                                             "cost_usd": 0.0})
+            entry["calls"] += calls
+            entry["input_tokens"] += input_tokens
+            entry["output_tokens"] += output_tokens
+            entry["estimated_calls"] += estimated
+            cost = cost_usd(model, input_tokens, output_tokens, backend)
+            # Unknown prices make the total unknown rather than too low
+            entry["cost_usd"] = None if cost is None or entry["cost_usd"] is None else entry["cost_usd"] + cost
+        for entry in rollup.values():
+            if entry["cost_usd"] is not None:
+                entry["cost_usd"] = round(entry["cost_usd"], 6)
+        return rollup
+
+    def snapshot(self) -> Dict:
+        """All-time totals in the store by endpoint, model and API key, after flushing this worker."""
+        self.flush()
+        snapshot = {"store": self.path, "flush_seconds": self.flush_seconds, "flushed_at": self.flushed_at,
+                    "flush_errors": self.flush_errors}
+        try:
+            conn = self._connect()
+            try:
+                snapshot["by_endpoint"] = self._rollup(conn, "endpoint")
+                snapshot["by_model"] = self._rollup(conn, "backend || '/' || model")
+                snapshot["by_api_key"] = self._rollup(conn, "api_key")
+            finally:
+                conn.close()
+        except sqlite3.Error as e:
+            logger.error(f"Reading token usage from {self.path} failed: {str(e)}")
+        return snapshot
+
+
+usage_tracker = UsageTracker()
+
+
+def estimate_tokens(text: str) -> int:
+    """Rough token count of `text` from its length."""
+    return math.ceil(len(text) / CHARS_PER_TOKEN)
+
+
+class UsageCallback(BaseCallbackHandler):
+    """LangChain callback that records each call's tokens for one backend and model.
+
+    Token counts come from the provider's response: `usage_metadata` on chat
+    models, Ollama's `prompt_eval_count`/`eval_count` on completion models.
+    When a response has neither, `count_tokens` estimates them locally.
+    Ollama counts only the prompt tokens it prefilled, so a prompt prefix
+    reused from its KV cache is not in the input tokens.
+
+    A stream closed early (cut at the letter's end, a client disconnect, a
+    cancelled hedge) never gets the provider's counts; its prompt and the
+    text streamed so far are recorded as estimated tokens instead.
+    """
+
+    run_inline = True
+
+    def __init__(self, backend: str, model: str, count_tokens: Optional[Callable[[str], int]] = None,
+                 tracker: UsageTracker = usage_tracker):
+        self.backend = backend
+        self.model = model
+        self.count_tokens = count_tokens
+        self.tracker = tracker
+        self._prompts: Dict[UUID, str] = {}
+        self._streamed: Dict[UUID, List[str]] = {}
+
+    def _start(self, run_id: UUID, prompt: str):
+        self._prompts[run_id] = prompt
+        tally = current_request_tokens.get()
+        if tally is not None:
+            tally[1] += 1
+
+    def on_llm_start(self, serialized, prompts, *, run_id: UUID, **kwargs):
+        self._start(run_id, "\n".join(prompts))
+
+    def on_chat_model_start(self, serialized, messages, *, run_id: UUID, **kwargs):
+        self._start(run_id, "\n".join(str(m.content) for batch in messages for m in batch))
+
+    def on_llm_new_token(self, token: str, *, run_id: UUID, **kwargs):
+        self._streamed.setdefault(run_id, []).append(token)
+
+    def on_llm_error(self, error, *, run_id: UUID, **kwargs):
+        prompt = self._prompts.pop(run_id, "")
+        streamed = "".join(self._streamed.pop(run_id, []))
+        # A failed request (no output, not cancelled) used no tokens worth charging
+        if streamed or isinstance(error, (GeneratorExit, asyncio.CancelledError)):
+            count = self.count_tokens or estimate_tokens
+            self.tracker.record(self.backend, self.model, count(prompt), count(streamed), estimated=True)
+
+    def on_llm_end(self, response: LLMResult, *, run_id: UUID, **kwargs):
+        prompt = self._prompts.pop(run_id, "")
+        self._streamed.pop(run_id, None)
+        generation = response.generations[0][0] if response.generations and response.generations[0] else None
+        if generation is None:
+            return
+        message = getattr(generation, "message", None)
+        usage = getattr(message, "usage_metadata", None) or {}
+        info = generation.generation_info or {}
+        if usage:
+            self.tracker.record(self.backend, self.model, usage.get("input_tokens", 0), usage.get("output_tokens", 0))
+        elif info.get("prompt_eval_count") is not None or info.get("eval_count") is not None:
+            self.tracker.record(self.backend, self.model, info.get("prompt_eval_count") or 0, info.get("eval_count") or 0)
+        elif self.count_tokens:
+            self.tracker.record(self.backend, self.model, self.count_tokens(prompt),
+                                self.count_tokens(generation.text), estimated=True)
+        else:
+            self.tracker.record(self.backend, self.model, 0, 0, estimated=True)